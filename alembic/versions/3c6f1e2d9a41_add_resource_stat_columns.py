@@ -0,0 +1,30 @@
+"""Add Resource stat columns
+
+Revision ID: 3c6f1e2d9a41
+Revises: daa645fb1635
+Create Date: 2026-10-18 09:12:44.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c6f1e2d9a41'
+down_revision = 'daa645fb1635'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.add_column(sa.Column('size', sa.BigInteger))
+        batch_op.add_column(sa.Column('mtime_ns', sa.BigInteger))
+        batch_op.add_column(sa.Column('inode', sa.BigInteger))
+
+
+def downgrade():
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.drop_column('inode')
+        batch_op.drop_column('mtime_ns')
+        batch_op.drop_column('size')
@@ -0,0 +1,33 @@
+"""Create Directory table
+
+Revision ID: 5e8b7a0c4d12
+Revises: 3c6f1e2d9a41
+Create Date: 2026-10-18 10:03:27.104877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b7a0c4d12'
+down_revision = '3c6f1e2d9a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'directory',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('location', sa.String, nullable=False),
+        sa.Column('mtime_ns', sa.BigInteger),
+        sa.Column('entry_count', sa.Integer),
+        sa.Column('digest', sa.String(64)),
+        sa.UniqueConstraint('location', name='uix_directory_location'),
+        sa.Index('idx_directory_location', 'location', unique=True)
+    )
+
+
+def downgrade():
+    op.drop_table('directory')
@@ -0,0 +1,24 @@
+"""Add Resource hashval index
+
+Revision ID: 7a1d3f5b8c20
+Revises: 5e8b7a0c4d12
+Create Date: 2026-10-18 11:21:05.630419
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1d3f5b8c20'
+down_revision = '5e8b7a0c4d12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('idx_hashval', 'resource', ['hashval'])
+
+
+def downgrade():
+    op.drop_index('idx_hashval', 'resource')
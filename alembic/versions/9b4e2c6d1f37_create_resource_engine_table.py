@@ -0,0 +1,33 @@
+"""Create Resource_Engine table
+
+Revision ID: 9b4e2c6d1f37
+Revises: 7a1d3f5b8c20
+Create Date: 2026-10-18 12:40:52.917350
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4e2c6d1f37'
+down_revision = '7a1d3f5b8c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'resource_engine',
+        sa.Column('resource_id', sa.Integer, primary_key=True),
+        sa.Column('engine', sa.String(100), primary_key=True),
+        sa.Column('hashval', sa.String, nullable=False),
+        sa.Column('fingerprint', sa.String(64), nullable=False),
+        sa.Column('last_tagged', sa.DateTime, nullable=False),
+        sa.ForeignKeyConstraint(('resource_id',), ['resource.id']),
+        sa.Index('idx_resource_engine_hashval', 'hashval'),
+    )
+
+
+def downgrade():
+    op.drop_table('resource_engine')
@@ -0,0 +1,28 @@
+"""Add Resource tags_version column
+
+Revision ID: a6c3e9f1b702
+Revises: f3b9d1e6a724
+Create Date: 2026-10-18 19:05:41.618290
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c3e9f1b702'
+down_revision = 'f3b9d1e6a724'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.add_column(sa.Column('tags_version', sa.Integer))
+    op.create_index('idx_resource_tags_version', 'resource', ['tags_version'])
+
+
+def downgrade():
+    op.drop_index('idx_resource_tags_version', 'resource')
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.drop_column('tags_version')
@@ -25,7 +25,7 @@ def upgrade():
         sa.Column('hashval', sa.String, nullable=False),
         sa.Column('last_indexed', sa.DateTime, nullable=False),
         sa.Column('description', sa.String),
-        sa.UniqueConstraint('location', name='uix_1'),
+        sa.UniqueConstraint('location', name='uix_resource_location'),
         sa.Index('idx_location', 'location', unique=True)
     )
 
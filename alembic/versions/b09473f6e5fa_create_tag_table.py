@@ -23,7 +23,7 @@ def upgrade():
         sa.Column('name', sa.String(100), nullable=False),
         sa.Column('engine', sa.String(100), nullable=False),
         sa.Column('description', sa.String),
-        sa.UniqueConstraint('name', 'engine', name='uix_1'),
+        sa.UniqueConstraint('name', 'engine', name='uix_tag_name_engine'),
         sa.Index('idx_name', 'name', unique=True)
 
     )
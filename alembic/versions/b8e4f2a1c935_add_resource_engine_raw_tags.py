@@ -0,0 +1,26 @@
+"""Add ResourceEngine raw_tags column
+
+Revision ID: b8e4f2a1c935
+Revises: a6c3e9f1b702
+Create Date: 2026-10-18 19:31:07.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e4f2a1c935'
+down_revision = 'a6c3e9f1b702'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('resource_engine') as batch_op:
+        batch_op.add_column(sa.Column('raw_tags', sa.LargeBinary))
+
+
+def downgrade():
+    with op.batch_alter_table('resource_engine') as batch_op:
+        batch_op.drop_column('raw_tags')
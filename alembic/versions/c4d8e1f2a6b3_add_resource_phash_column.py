@@ -0,0 +1,26 @@
+"""Add Resource phash column
+
+Revision ID: c4d8e1f2a6b3
+Revises: 9b4e2c6d1f37
+Create Date: 2026-10-18 13:55:21.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8e1f2a6b3'
+down_revision = '9b4e2c6d1f37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.add_column(sa.Column('phash', sa.String(16)))
+
+
+def downgrade():
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.drop_column('phash')
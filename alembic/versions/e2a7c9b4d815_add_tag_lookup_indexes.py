@@ -0,0 +1,27 @@
+"""Add Resource_Tag tag_id and Tag engine indexes
+
+Revision ID: e2a7c9b4d815
+Revises: c4d8e1f2a6b3
+Create Date: 2026-10-18 15:32:10.274863
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c9b4d815'
+down_revision = 'c4d8e1f2a6b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Both cover their queries, so the table rows themselves are never read
+    op.create_index('idx_resource_tag_tag_id', 'resource_tag', ['tag_id', 'resource_id', 'confidence'])
+    op.create_index('idx_tag_engine', 'tag', ['engine', 'name', 'id'])
+
+
+def downgrade():
+    op.drop_index('idx_tag_engine', 'tag')
+    op.drop_index('idx_resource_tag_tag_id', 'resource_tag')
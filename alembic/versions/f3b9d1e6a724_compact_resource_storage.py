@@ -0,0 +1,244 @@
+"""Compact Resource storage
+
+Stores hashval as the 32 bytes of the digest, last_indexed as microseconds since 1970, and location
+as a directory id plus a basename.
+
+Revision ID: f3b9d1e6a724
+Revises: e2a7c9b4d815
+Create Date: 2026-10-18 16:48:37.902215
+
+"""
+import calendar
+import datetime
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b9d1e6a724'
+down_revision = 'e2a7c9b4d815'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 10000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+# Copies of the helpers in tigertag.db.models, so this migration keeps working when they change
+def split_location(location):
+    index = max(location.rfind('/'), location.rfind(os.sep))
+    return location[:index + 1], location[index + 1:]
+
+
+def location_constraint(connection):
+    # Databases created before the unique constraints had names of their own call it uix_1
+    for constraint in sa.inspect(connection).get_unique_constraints('resource'):
+        if constraint['column_names'] == ['location']:
+            return constraint['name']
+    return 'uix_resource_location'
+
+
+def encode_hash(value):
+    if len(value) == 64 and value == value.lower():
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    data = b'\0' + value.encode('utf-8')
+    if len(data) == 32:
+        data = b'\0' + data
+    return data
+
+
+def decode_hash(value):
+    value = bytes(value)
+    if len(value) == 32:
+        return value.hex()
+    if len(value) == 33 and value[1:2] == b'\0':
+        return value[2:].decode('utf-8')
+    return value[1:].decode('utf-8')
+
+
+def encode_datetime(value):
+    return calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+
+
+def decode_datetime(value):
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+directory = sa.Table(
+    'directory',
+    sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('location', sa.String),
+)
+
+
+def _chunks(connection, query, id_column):
+    # Rows in id order, a chunk at a time, so millions of resources never have to be in memory at once
+    last_id = None
+    while True:
+        chunk_query = query.order_by(id_column).limit(CHUNK_SIZE)
+        if last_id is not None:
+            chunk_query = chunk_query.where(id_column > last_id)
+        rows = connection.execute(chunk_query).fetchall()
+        if len(rows) == 0:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _directory_ids(connection):
+    rows = connection.execute(sa.select(directory.c.id, directory.c.location))
+    directory_ids = {row.location: row.id for row in rows}
+
+    def get(location):
+        if location not in directory_ids:
+            result = connection.execute(directory.insert().values(location=location))
+            directory_ids[location] = result.inserted_primary_key[0]
+        return directory_ids[location]
+    return get
+
+
+def upgrade():
+    connection = op.get_bind()
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.add_column(sa.Column('directory_id', sa.Integer))
+        batch_op.add_column(sa.Column('basename', sa.String))
+        batch_op.add_column(sa.Column('hashval_bin', sa.LargeBinary))
+        batch_op.add_column(sa.Column('last_indexed_us', sa.BigInteger))
+    with op.batch_alter_table('resource_engine') as batch_op:
+        batch_op.add_column(sa.Column('hashval_bin', sa.LargeBinary))
+
+    resource = sa.table(
+        'resource',
+        sa.column('id', sa.Integer),
+        sa.column('location', sa.String),
+        sa.column('hashval', sa.String),
+        sa.column('last_indexed', sa.DateTime),
+        sa.column('directory_id', sa.Integer),
+        sa.column('basename', sa.String),
+        sa.column('hashval_bin', sa.LargeBinary),
+        sa.column('last_indexed_us', sa.BigInteger),
+    )
+    get_directory_id = _directory_ids(connection)
+    query = sa.select(resource.c.id, resource.c.location, resource.c.hashval, resource.c.last_indexed)
+    for rows in _chunks(connection, query, resource.c.id):
+        values = []
+        for row in rows:
+            directory_location, basename = split_location(row.location)
+            values.append({
+                'b_id': row.id,
+                'directory_id': get_directory_id(directory_location),
+                'basename': basename,
+                'hashval_bin': encode_hash(row.hashval),
+                'last_indexed_us': encode_datetime(row.last_indexed),
+            })
+        connection.execute(resource.update().where(resource.c.id == sa.bindparam('b_id')), values)
+
+    resource_engine = sa.table(
+        'resource_engine',
+        sa.column('resource_id', sa.Integer),
+        sa.column('engine', sa.String),
+        sa.column('hashval', sa.String),
+        sa.column('hashval_bin', sa.LargeBinary),
+    )
+    for row in connection.execute(sa.select(resource_engine.c.hashval).distinct()).fetchall():
+        connection.execute(
+            resource_engine.update()
+            .where(resource_engine.c.hashval == row.hashval)
+            .values(hashval_bin=encode_hash(row.hashval)))
+
+    op.drop_index('idx_location', 'resource')
+    op.drop_index('idx_hashval', 'resource')
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.drop_constraint(location_constraint(connection), type_='unique')
+        batch_op.drop_column('location')
+        batch_op.drop_column('hashval')
+        batch_op.drop_column('last_indexed')
+        batch_op.alter_column('directory_id', existing_type=sa.Integer, nullable=False)
+        batch_op.alter_column('basename', existing_type=sa.String, nullable=False)
+        batch_op.alter_column('hashval_bin', new_column_name='hashval', existing_type=sa.LargeBinary,
+                              nullable=False)
+        batch_op.alter_column('last_indexed_us', new_column_name='last_indexed', existing_type=sa.BigInteger,
+                              nullable=False)
+        batch_op.create_foreign_key('fk_resource_directory', 'directory', ['directory_id'], ['id'])
+        batch_op.create_unique_constraint('uix_resource_location', ['directory_id', 'basename'])
+    op.create_index('idx_hashval', 'resource', ['hashval'])
+
+    op.drop_index('idx_resource_engine_hashval', 'resource_engine')
+    with op.batch_alter_table('resource_engine') as batch_op:
+        batch_op.drop_column('hashval')
+        batch_op.alter_column('hashval_bin', new_column_name='hashval', existing_type=sa.LargeBinary,
+                              nullable=False)
+    op.create_index('idx_resource_engine_hashval', 'resource_engine', ['hashval'])
+
+
+def downgrade():
+    connection = op.get_bind()
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.add_column(sa.Column('location', sa.String))
+        batch_op.add_column(sa.Column('hashval_text', sa.String))
+        batch_op.add_column(sa.Column('last_indexed_dt', sa.DateTime))
+    with op.batch_alter_table('resource_engine') as batch_op:
+        batch_op.add_column(sa.Column('hashval_text', sa.String))
+
+    resource = sa.table(
+        'resource',
+        sa.column('id', sa.Integer),
+        sa.column('directory_id', sa.Integer),
+        sa.column('basename', sa.String),
+        sa.column('hashval', sa.LargeBinary),
+        sa.column('last_indexed', sa.BigInteger),
+        sa.column('location', sa.String),
+        sa.column('hashval_text', sa.String),
+        sa.column('last_indexed_dt', sa.DateTime),
+    )
+    query = sa.select(resource.c.id, directory.c.location.label('directory_location'), resource.c.basename,
+                      resource.c.hashval, resource.c.last_indexed) \
+        .select_from(resource.join(directory, resource.c.directory_id == directory.c.id))
+    for rows in _chunks(connection, query, resource.c.id):
+        connection.execute(resource.update().where(resource.c.id == sa.bindparam('b_id')), [
+            {
+                'b_id': row.id,
+                'location': row.directory_location + row.basename,
+                'hashval_text': decode_hash(row.hashval),
+                'last_indexed_dt': decode_datetime(row.last_indexed),
+            } for row in rows
+        ])
+
+    resource_engine = sa.table(
+        'resource_engine',
+        sa.column('hashval', sa.LargeBinary),
+        sa.column('hashval_text', sa.String),
+    )
+    for row in connection.execute(sa.select(resource_engine.c.hashval).distinct()).fetchall():
+        connection.execute(
+            resource_engine.update()
+            .where(resource_engine.c.hashval == row.hashval)
+            .values(hashval_text=decode_hash(row.hashval)))
+
+    op.drop_index('idx_resource_engine_hashval', 'resource_engine')
+    with op.batch_alter_table('resource_engine') as batch_op:
+        batch_op.drop_column('hashval')
+        batch_op.alter_column('hashval_text', new_column_name='hashval', existing_type=sa.String, nullable=False)
+    op.create_index('idx_resource_engine_hashval', 'resource_engine', ['hashval'])
+
+    op.drop_index('idx_hashval', 'resource')
+    with op.batch_alter_table('resource') as batch_op:
+        batch_op.drop_constraint('uix_resource_location', type_='unique')
+        batch_op.drop_constraint('fk_resource_directory', type_='foreignkey')
+        batch_op.drop_column('directory_id')
+        batch_op.drop_column('basename')
+        batch_op.drop_column('hashval')
+        batch_op.drop_column('last_indexed')
+        batch_op.alter_column('location', existing_type=sa.String, nullable=False)
+        batch_op.alter_column('hashval_text', new_column_name='hashval', existing_type=sa.String, nullable=False)
+        batch_op.alter_column('last_indexed_dt', new_column_name='last_indexed', existing_type=sa.DateTime,
+                              nullable=False)
+        batch_op.create_unique_constraint('uix_resource_location', ['location'])
+    op.create_index('idx_location', 'resource', ['location'], unique=True)
+    op.create_index('idx_hashval', 'resource', ['hashval'])
@@ -0,0 +1,100 @@
+# Size of the database and cost of a hashval lookup before and after the compact Resource storage
+# migration (f3b9d1e6a724).  The resources are written with the schema before it, then a copy is upgraded,
+# which also times the migration itself.
+#
+#   python benchmarks/compact_storage.py --count 200000
+import argparse
+import datetime
+import hashlib
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from alembic import command
+from alembic.config import Config
+
+from tigertag.db.models import encode_hash
+
+BEFORE = 'e2a7c9b4d815'
+
+
+def config(path):
+    result = Config(os.path.join(ROOT, 'alembic.ini'))
+    result.set_main_option('script_location', os.path.join(ROOT, 'alembic'))
+    result.set_main_option('sqlalchemy.url', 'sqlite:///{}'.format(path))
+    return result
+
+
+def fill(path, count):
+    now = datetime.datetime.now()
+    db = sqlite3.connect(path)
+    db.executemany(
+        'INSERT INTO resource (name, location, hashval, last_indexed, size, mtime_ns, inode) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (('IMG_{:08d}.jpg'.format(i),
+          '/photos/{}/{:04d}-{:02d} {}/IMG_{:08d}.jpg'.format(
+              2000 + i % 24, 2000 + i % 24, 1 + i % 12, 'Holiday' if i % 3 else 'Family', i),
+          hashlib.sha256(str(i).encode()).hexdigest(),
+          str(now),
+          random.randrange(100000, 10000000),
+          1600000000000000000 + random.randrange(10 ** 17),
+          random.randrange(10 ** 8)) for i in range(count)))
+    db.commit()
+    db.close()
+
+
+def size(path):
+    db = sqlite3.connect(path)
+    db.execute('VACUUM')
+    db.close()
+    return os.path.getsize(path)
+
+
+def lookups(path, hashvals, encode):
+    db = sqlite3.connect(path)
+    start = time.perf_counter()
+    for hashval in hashvals:
+        db.execute('SELECT id FROM resource WHERE hashval = ?', (encode(hashval),)).fetchall()
+    elapsed = time.perf_counter() - start
+    db.close()
+    return elapsed / len(hashvals) * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    work = tempfile.mkdtemp()
+    try:
+        before = os.path.join(work, 'before.db')
+        after = os.path.join(work, 'after.db')
+        command.upgrade(config(before), BEFORE)
+        fill(before, args.count)
+        shutil.copy(before, after)
+        start = time.perf_counter()
+        command.upgrade(config(after), 'head')
+        migration = time.perf_counter() - start
+
+        hashvals = [hashlib.sha256(str(random.randrange(args.count)).encode()).hexdigest()
+                    for _ in range(args.lookups)]
+        for label, path, encode in (('text columns', before, lambda value: value),
+                                    ('compact', after, encode_hash)):
+            print('{:>13}: {:7.1f} MB for {} resources, {:.2f} us per hashval lookup'.format(
+                label, size(path) / 1024 / 1024, args.count, lookups(path, hashvals, encode)))
+        print('migration took {:.1f}s'.format(migration))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
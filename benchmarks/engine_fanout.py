@@ -0,0 +1,77 @@
+# Time per image of EngineManager.tag with engines that only wait, like engines waiting on their APIs do.
+# The default latencies are an Imagga upload plus tag call, and a CompreFace recognition.
+#
+#   python benchmarks/engine_fanout.py --images 20 --workers 4 --imagga-concurrency 2
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tigertag.engine import Engine
+from tigertag.engine import EngineListener
+from tigertag.engine import EngineManager
+from tigertag.engine import TagInfo
+
+
+class WaitingEngine(Engine):
+    def __init__(self, name, prefix, enabled, latency):
+        super().__init__(name, prefix, enabled)
+        self.latency = latency
+
+    def tag(self, path, temp=None, ext_id=None, data=None):
+        time.sleep(self.latency)
+        tag_info = TagInfo(path, {self.calc_tag_name('tree'): {'confidence': 90}})
+        for listener in self.listeners:
+            listener.on_tags(self, tag_info, ext_id)
+        return tag_info
+
+
+def run(workers, images, callers, imagga_latency, compreface_latency, imagga_concurrency):
+    em = EngineManager(workers)
+    imagga = WaitingEngine('IMAGGA', 'Tti', True, imagga_latency)
+    imagga.props['MAX_CONCURRENCY'] = str(imagga_concurrency)
+    em.add(imagga)
+    em.add(WaitingEngine('COMPREFACE', 'ttf', True, compreface_latency))
+    found = []
+    el = EngineListener()
+    el.on_tags = lambda engine, tag_info, ext_id: found.append(tag_info.path)
+    em.listeners.append(el)
+
+    def tag_images(first):
+        for i in range(first, images, callers):
+            em.tag('IMG_{:04d}.jpg'.format(i))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=tag_images, args=(first,)) for first in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    em.shutdown()
+    assert len(found) == images * 2
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--callers', type=int, default=1, help='threads calling tag, like a scan pipeline')
+    parser.add_argument('--imagga-latency', type=float, default=0.6)
+    parser.add_argument('--compreface-latency', type=float, default=0.3)
+    parser.add_argument('--imagga-concurrency', type=int, default=1)
+    args = parser.parse_args()
+
+    for label, workers in (('one after another', 0), ('{} workers'.format(args.workers), args.workers)):
+        elapsed = run(workers, args.images, args.callers, args.imagga_latency, args.compreface_latency,
+                      args.imagga_concurrency)
+        print('{:>18}: {:.2f}s for {} images, {:.0f} ms per image'.format(
+            label, elapsed, args.images, elapsed / args.images * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Lookup latency of tigertag.util.hamming.HammingIndex, against a BK-tree and a linear scan.
+#
+#   python benchmarks/hamming_index.py --count 1000000
+#
+# Random 64 bit hashes are close to the worst case for both indexes, real dHashes cluster more.
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tigertag.util.hamming import HammingIndex
+
+
+class BKTree:
+    def __init__(self):
+        self.root = None  # [hash, value, {distance: child}]
+
+    def add(self, value, hash_value):
+        node = [hash_value, value, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            d = (current[0] ^ hash_value).bit_count()
+            child = current[2].get(d)
+            if child is None:
+                current[2][d] = node
+                return
+            current = child
+
+    def find(self, hash_value, distance):
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ hash_value).bit_count()
+            if d <= distance:
+                results.append((d, node[1]))
+            for child_distance, child in node[2].items():
+                if d - distance <= child_distance <= d + distance:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+def linear_find(hashes, hash_value, distance):
+    return [(d, value) for value, d in enumerate((h ^ hash_value).bit_count() for h in hashes) if d <= distance]
+
+
+def queries(hashes, count, flips):
+    # Known hashes with a few bits flipped, so every lookup has at least one hit
+    result = []
+    for _ in range(count):
+        q = random.choice(hashes)
+        for bit in random.sample(range(64), flips):
+            q ^= 1 << bit
+        result.append(q)
+    return result
+
+
+def measure(find, qs):
+    timings = []
+    for q in qs:
+        start = time.perf_counter()
+        find(q)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--distances', default='0,2,4,6,8')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-bktree', action='store_true')
+    parser.add_argument('--no-linear', action='store_true')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    hashes = [random.getrandbits(64) for _ in range(args.count)]
+    distances = [int(d) for d in args.distances.split(',')]
+
+    bktree = None
+    if not args.no_bktree:
+        start = time.perf_counter()
+        bktree = BKTree()
+        for value, h in enumerate(hashes):
+            bktree.add(value, h)
+        print('bk-tree built in {:.1f}s'.format(time.perf_counter() - start))
+
+    print('{:>8} {:>16} {:>16} {:>16}'.format('distance', 'multi-index ms', 'bk-tree ms', 'linear ms'))
+    for distance in distances:
+        start = time.perf_counter()
+        index = HammingIndex(distance)
+        for value, h in enumerate(hashes):
+            index.add(value, h)
+        build = time.perf_counter() - start
+        qs = queries(hashes, args.queries, min(distance, 64))
+
+        columns = ['{:.3f} / {:.3f}'.format(*measure(lambda q: index.find(q, distance), qs))]
+        if bktree is not None:
+            columns.append('{:.3f} / {:.3f}'.format(*measure(lambda q: bktree.find(q, distance), qs)))
+        else:
+            columns.append('-')
+        if not args.no_linear:
+            columns.append('{:.3f} / {:.3f}'.format(
+                *measure(lambda q: linear_find(hashes, q, distance), qs[:max(len(qs) // 20, 1)])))
+        else:
+            columns.append('-')
+        print('{:>8} {:>16} {:>16} {:>16}   (index built in {:.1f}s)'.format(distance, *columns, build))
+        del index
+    print('Latencies are p50 / p99 over {} lookups in {} hashes'.format(args.queries, args.count))
+
+
+if __name__ == '__main__':
+    main()
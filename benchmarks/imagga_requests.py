@@ -0,0 +1,74 @@
+# Time and HTTP requests per image of ImaggaEngine.tag against a local stub of the Imagga API, with
+# SINGLE_REQUEST (one POST to /tags) and without (POST to /uploads, then GET /tags).  Every request waits
+# --latency seconds before answering, like the round trip and work of the real API.
+#
+#   python benchmarks/imagga_requests.py --images 20 --latency 0.1
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tigertag.engine.imagga import ImaggaEngine
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'data', 'images', 'input', 'boy.jpg')
+UPLOAD = {'result': {'upload_id': 'i05e1'}, 'status': {'text': '', 'type': 'success'}}
+TAGS = {'result': {'tags': [{'confidence': 61.5, 'tag': {'en': 'child'}}]}, 'status': {'text': '', 'type': 'success'}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        data = json.dumps(UPLOAD if self.path.startswith('/uploads') else TAGS).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = answer
+    do_POST = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds the stub takes per request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.latency = args.latency
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for label, single_request in (('upload then tag', 'False'), ('single request', 'True')):
+            engine = ImaggaEngine('IMAGGA', 'Tti', True)
+            engine.props.update({'API_KEY': 'key', 'API_SECRET': 'secret', 'SINGLE_REQUEST': single_request,
+                                 'API_URL': 'http://127.0.0.1:{}'.format(server.server_address[1])})
+            server.requests = 0
+            start = time.perf_counter()
+            for _ in range(args.images):
+                engine.tag(IMAGE)
+            elapsed = time.perf_counter() - start
+            print('{:>16}: {:.0f} ms and {:.1f} requests per image'.format(
+                label, elapsed / args.images * 1000, server.requests / args.images))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
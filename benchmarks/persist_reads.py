@@ -0,0 +1,97 @@
+# Cost of reading every resource with its tags, the way a report or a re-sync of a stasher would.
+# It compares walking ORM objects, whose tags load one resource at a time, with the ResourceRecord and
+# TagRecord reads of Persist.
+#
+#   python benchmarks/persist_reads.py --images 5000
+import argparse
+import datetime
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from alembic import command
+from alembic.config import Config
+
+from tigertag.db import DbEngine
+from tigertag.db import Persist
+from tigertag.db.models import Resource
+
+ENGINES = ['IMAGGA', 'COMPREFACE']
+TAGS = ['tree', 'sky', 'person', 'dog', 'beach', 'car', 'house', 'flower', 'child', 'mountain']
+
+
+def create_db(path):
+    url = 'sqlite:///{}'.format(path)
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'alembic'))
+    config.set_main_option('sqlalchemy.url', url)
+    command.upgrade(config, 'head')
+    return url
+
+
+def write_images(persist, count):
+    now = datetime.datetime.now()
+    persist.begin_batch(1000, 60)
+    for i in range(count):
+        location = '/photos/{:03d}/IMG_{:08d}.jpg'.format(i // 500, i)
+        persist.set_resource(location, os.path.basename(location),
+                             hashlib.sha256(location.encode()).hexdigest(), now)
+        for engine in ENGINES:
+            tags = {'{}{}'.format(engine.lower(), tag): {'confidence': 50 + (i + j) % 50}
+                    for j, tag in enumerate(TAGS)}
+            persist.set_resource(location, engine=engine, tags=tags, fingerprint='settings')
+    persist.end_batch()
+
+
+def read_orm(engine, persist):
+    count = 0
+    with engine.session() as session:
+        for resource in session.query(Resource).order_by(Resource.id):
+            resource_dict = Persist._resource_to_dict(resource)
+            tags = {resource_tag.tag.name: resource_tag.confidence for resource_tag in resource.tags}
+            count += len(tags) + len(resource_dict)
+    return count
+
+
+def read_records(engine, persist):
+    count = 0
+    tags = persist.iter_tag_records()
+    tag = next(tags, None)
+    for resource in persist.iter_resource_records():
+        resource_tags = {}
+        while tag is not None and tag.resource_id == resource.id:
+            resource_tags[tag.name] = tag.confidence
+            tag = next(tags, None)
+        count += len(resource_tags) + len(resource)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=5000)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    try:
+        engine = DbEngine(create_db(os.path.join(work, 'reads.db')))
+        persist = Persist(engine)
+        write_images(persist, args.images)
+        for label, read in (('ORM objects', read_orm), ('records', read_records)):
+            start = time.perf_counter()
+            read(engine, persist)
+            elapsed = time.perf_counter() - start
+            print('{:>12}: {:.1f} ms for {} resources with {} tags each, {:.1f} us per resource'.format(
+                label, elapsed * 1000, args.images, len(ENGINES) * len(TAGS), elapsed / args.images * 1000000))
+        engine.dispose()
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Write cost of Persist per image, committing every write on its own against batching them, with and
+# without the SQLite profile of DbEngine.  Each image is written the way main.py does it: the resource,
+# then the tags of every engine.
+#
+#   python benchmarks/persist_writes.py --images 2000
+#
+# What batching saves is mostly the fsync of every commit, so the gap depends on the disk the
+# database is on.  It is small on disks with a volatile write cache and large on ones without.
+import argparse
+import datetime
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from alembic import command
+from alembic.config import Config
+
+from tigertag.db import DbEngine
+from tigertag.db import Persist
+from tigertag.db import SQLITE_PRAGMAS
+
+ENGINES = ['IMAGGA', 'COMPREFACE']
+TAGS = ['tree', 'sky', 'person', 'dog', 'beach', 'car', 'house', 'flower', 'child', 'mountain']
+
+
+def create_db(path):
+    url = 'sqlite:///{}'.format(path)
+    config = Config(os.path.join(ROOT, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(ROOT, 'alembic'))
+    config.set_main_option('sqlalchemy.url', url)
+    command.upgrade(config, 'head')
+    return url
+
+
+def write_images(persist, count):
+    now = datetime.datetime.now()
+    for i in range(count):
+        location = '/photos/IMG_{:08d}.jpg'.format(i)
+        persist.set_resource(location, os.path.basename(location),
+                             hashlib.sha256(location.encode()).hexdigest(), now)
+        for engine in ENGINES:
+            tags = {'{}{}'.format(engine.lower(), tag): {'confidence': 50 + (i + j) % 50}
+                    for j, tag in enumerate(TAGS)}
+            persist.set_resource(location, engine=engine, tags=tags, fingerprint='settings')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    try:
+        modes = []
+        for pragmas, profile in ((None, 'no profile'), (SQLITE_PRAGMAS, 'sqlite profile')):
+            modes.append(('one commit per write, {}'.format(profile), 1, pragmas))
+            modes.append(('batch of {}, {}'.format(args.batch_size, profile), args.batch_size, pragmas))
+        for i, (label, batch_size, pragmas) in enumerate(modes):
+            url = create_db(os.path.join(work, '{}.db'.format(i)))
+            engine = DbEngine(url, sqlite_pragmas=pragmas)
+            persist = Persist(engine)
+            start = time.perf_counter()
+            if batch_size > 1:
+                persist.begin_batch(batch_size, 60)
+            write_images(persist, args.images)
+            persist.end_batch()
+            elapsed = time.perf_counter() - start
+            engine.dispose()
+            print('{:>40}: {:.2f} ms per image, {:.0f} images/s'.format(
+                label, elapsed / args.images * 1000, args.images / elapsed))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Memory and lookup cost of tigertag.db.index.ResourceIndex, against keeping the row dicts that
+# Persist.get_resource_by_location returns.
+#
+#   python benchmarks/resource_index.py --count 1000000
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tigertag.db.index import ResourceIndex
+
+
+def resources(count):
+    for i in range(count):
+        location = '/photos/{}/{:04d}-{:02d} {}/IMG_{:08d}.jpg'.format(
+            2000 + i % 24, 2000 + i % 24, 1 + i % 12, 'Holiday' if i % 3 else 'Family', i)
+        yield {
+            'id': i + 1,
+            'location': location,
+            'hashval': hashlib.sha256(location.encode()).hexdigest(),
+            'size': random.randrange(100000, 10000000),
+            'mtime_ns': 1600000000000000000 + random.randrange(10 ** 17),
+            'inode': random.randrange(10 ** 8),
+            'phash': '{:016x}'.format(random.getrandbits(64)),
+        }
+
+
+def measure(build, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(resources(count))
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+
+def build_index(rows):
+    index = ResourceIndex()
+    for row in rows:
+        index.put(row)
+    return index
+
+
+def build_dicts(rows):
+    return {row['location']: row for row in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    locations = [row['location'] for row in resources(args.count)]
+    probes = random.sample(locations, min(args.lookups, args.count))
+    del locations
+
+    for label, build, lookup in (
+            ('ResourceIndex', build_index, lambda structure, location: structure.get(location)),
+            ('row dicts', build_dicts, lambda structure, location: structure.get(location))):
+        structure, memory, elapsed = measure(build, args.count)
+        start = time.perf_counter()
+        for location in probes:
+            lookup(structure, location)
+        per_lookup = (time.perf_counter() - start) / len(probes) * 1000000
+        print('{:>14}: {:7.1f} MB for {} rows, loaded in {:.1f}s, {:.2f} us per lookup'.format(
+            label, memory / 1024 / 1024, args.count, elapsed, per_lookup))
+        del structure
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Load time, memory and query time of tigertag.db.search.TagIndex over a synthetic library.  The postings
+# come straight from memory instead of a database, so only the index itself is measured.
+#
+#   python benchmarks/tag_search.py --resources 1000000 --tags-per-resource 20
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tigertag.db.search import TagIndex
+
+QUERIES = [
+    'tag0',
+    'tag0>=60',
+    'tag1 AND tag2>=60',
+    'ttf_alice AND tag3>=60',
+    '(tag4 OR tag5) AND NOT tag6<50',
+    'NOT tag7',
+]
+
+
+class Source:
+    # The few Persist methods TagIndex.load reads
+    def __init__(self, resources, tags, tags_per_resource):
+        self.resources = resources
+        self.names = {tag_id: 'tag{}'.format(tag_id) for tag_id in range(tags)}
+        self.names[tags] = 'ttf_alice'
+        random.seed(1)
+        # Tag popularity follows a power law, like real tags do
+        self.postings = {tag_id: [] for tag_id in self.names}
+        weights = [1 / (tag_id + 1) for tag_id in range(tags)]
+        for resource_id in range(1, resources + 1):
+            for tag_id in set(random.choices(range(tags), weights, k=tags_per_resource)):
+                self.postings[tag_id].append(resource_id)
+            if resource_id % 500 == 0:
+                self.postings[tags].append(resource_id)
+        self.confidences = {tag_id: sorted(random.randrange(30, 101) for _ in ids)
+                            for tag_id, ids in self.postings.items()}
+
+    def get_last_tags_version(self):
+        return 0
+
+    def get_tag_names(self):
+        return self.names
+
+    def iter_postings(self):
+        for tag_id, ids in self.postings.items():
+            yield from zip(itertools.repeat(tag_id), ids, self.confidences[tag_id])
+
+    def get_resource_ids(self, after_id=0):
+        return list(range(after_id + 1, self.resources + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resources', type=int, default=1000000)
+    parser.add_argument('--tags', type=int, default=2000)
+    parser.add_argument('--tags-per-resource', type=int, default=20)
+    args = parser.parse_args()
+
+    source = Source(args.resources, args.tags, args.tags_per_resource)
+    tracemalloc.start()
+    index = TagIndex(source)
+    start = time.perf_counter()
+    index.load()
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    postings = sum(len(ids) for ids in source.postings.values())
+    print('loaded {} postings of {} resources in {:.1f}s, {:.0f} MB'.format(
+        postings, args.resources, elapsed, memory / 1024 / 1024))
+
+    for query in QUERIES:
+        start = time.perf_counter()
+        count = index.count(query)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        index.count(query)
+        warm = time.perf_counter() - start
+        start = time.perf_counter()
+        index.search(query, limit=100)
+        first_page = time.perf_counter() - start
+        print('{:>32}: {:7d} matches, {:7.1f} ms cold, {:5.2f} ms cached, {:5.2f} ms for the first 100 ids'.format(
+            query, count, cold * 1000, warm * 1000, first_page * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import datetime
 import logging
 import logging.handlers
+import os
 import sys
+import threading
 import traceback
 
 from tigertag.db import EnvironmentDbEngineBuilder
@@ -22,10 +24,49 @@ from tigertag.notifier import NotifierManager
 from tigertag.notifier import EnvironmentNotifierManagerBuilder
 from tigertag.notifier import NotificationInfo
 from tigertag.notifier.email import EmailNotifier
+from tigertag.util import str2bool
+from tigertag.util.hamming import HammingIndex
+from tigertag.util.pipeline import Pipeline
 
 # SCANNER_DIRECTORY_NAME=tigertag.scanner.directory.DirectoryScanner
 # SCANNER_DIRECTORY_ENABLED=True
 # SCANNER_DIRECTORY_PATH=data/images/input
+# SCANNER_DIRECTORY_FAST=<True|False - skip hashing files whose size, mtime and inode are unchanged>
+# SCANNER_DIRECTORY_DEEP_VERIFY=<True|False - hash every file even when FAST is on>
+# SCANNER_DIRECTORY_WORKERS=<number of threads sniffing and hashing files, default 1>
+# SCANNER_DIRECTORY_MAX_IN_FLIGHT=<files queued ahead of the listeners, default WORKERS * 4>
+# SCANNER_DIRECTORY_INCREMENTAL=<True|False - skip directories whose mtime and entry names are unchanged.
+#     Files edited in place are then only picked up by a DEEP_VERIFY scan>
+# SCANNER_DIRECTORY_WATCH=<True|False - after the scan, keep tagging files as they change (Linux only)>
+# SCANNER_DIRECTORY_WATCH_SETTLE=<seconds without changes before a batch of changes is handled, default 2>
+# SCANNER_DIRECTORY_WATCH_MAX_DELAY=<seconds a change may wait while changes keep coming, default 30>
+
+# PHASH_DISTANCE=<reuse the tags of an image whose perceptual hash differs by at most this many bits, ex: 4.
+#     Catches resized and recompressed copies.  Unset to only reuse the tags of byte for byte copies>
+# PRELOAD_RESOURCES=<True|False - load every resource into memory before scanning, instead of a query per file.
+#     About 220 MB per million resources.  Default True>
+# DB_BATCH_SIZE=<writes committed together in one transaction, default 500.  1 commits every write on its own>
+# DB_BATCH_DELAY_MS=<longest a write waits for the rest of its batch, default 1000>
+# RESPONSE_CACHE_PATH=<file keeping what the engines returned by content and engine settings, ex:
+#     data/db/responses.db.  Content tagged before costs no engine call, even after the database is rebuilt>
+# RESPONSE_CACHE_MAX_MB=<size of the cached responses before the least recently used are evicted, default 512>
+# PIPELINE=<True|False - run the scan as stages on their own threads, connected by bounded queues: the scanner
+#     finds and hashes the files, check drops the unchanged ones, preprocess works out perceptual hashes, persist
+#     records the files and their tags, tag runs the engines and stash the stashers.  A slow stage then
+#     only slows down the stages feeding it, and disk, CPU and network work overlap.  Default False>
+# PIPELINE_CHECK_WORKERS=<default 2>
+# PIPELINE_PREPROCESS_WORKERS=<default 2>
+# PIPELINE_TAG_WORKERS=<images tagged at the same time, default 4.  See MAX_CONCURRENCY of the engines>
+# PIPELINE_STASH_WORKERS=<default 1>
+# PIPELINE_ASYNC=<True|False - run the tag and stash stages on an event loop each, with the async HTTP clients of
+#     the engines and stashers, so the PIPELINE_TAG_WORKERS images in flight do not take a thread each.  Images
+#     are then tagged one by one, without ENGINE_BATCH_SIZE.  Default False>
+# PIPELINE_QUEUE_SIZE=<items waiting in front of each stage before the stages feeding it wait, default 100>
+# PIPELINE_METRICS_INTERVAL=<seconds between logs of the stage queue depths, default 60>
+# MIN_CONFIDENCE=<tags of any engine below this confidence, 0-100, are not kept, default 30>
+# RETHRESHOLD=<True|False - instead of scanning, work the tags out again from the engine results kept in the
+#     database, with the current thresholds, and stash the ones that changed.  No engine is called.
+#     Run it after changing MIN_CONFIDENCE or the MIN_CONFIDENCE of an engine>
 
 # SCANNER_PLEX_NAME=tigertag.scanner.plex.PlexScanner
 # SCANNER_PLEX_ENABLED=True
@@ -38,6 +79,13 @@ from tigertag.notifier.email import EmailNotifier
 # ENGINE_IMAGGA_API_KEY=<VALUE>
 # ENGINE_IMAGGA_API_SECRET=<VALUE>
 # ENGINE_IMAGGA_API_URL=https://api.imagga.com/v2
+# ENGINE_IMAGGA_SINGLE_REQUEST=<True posts each image straight to /tags.  False uploads it to /uploads first,
+#     twice the requests, and leaves the upload on Imagga's side.  Default True>
+# ENGINE_IMAGGA_MAX_CONCURRENCY=<images an engine tags at the same time when ENGINE_WORKERS is set, default 1>
+# ENGINE_WORKERS=<threads running the engines of an image at the same time instead of one after another.
+#     Unset or 0 runs them one after another>
+# ENGINE_BATCH_SIZE=<images handed to the engines at once, so an engine can share a session or send every upload
+#     before asking for the tags.  Default 1>
 # STASHER_CONSOLE_NAME=tigertag.stasher.console.ConsoleStasher
 # STASHER_CONSOLE_ENABLED=True
 # STASHER_PLEX_NAME=tigertag.stasher.plex.PlexStasher
@@ -46,6 +94,9 @@ from tigertag.notifier.email import EmailNotifier
 # STASHER_PLEX_URL=<VALUE ex: http://127.0.0.1:32400>
 # STASHER_PLEX_SECTION=<VALUE ex: TEST Family Photos>
 # DB_URL=sqlite:///data/db/tigertag.db
+# DB_SQLITE_PROFILE=<True|False - WAL, synchronous=NORMAL and a bigger cache for SQLite databases, default True>
+# DB_POOL_SIZE=<connections kept open to a PostgreSQL database, default 5>
+# DB_MAX_OVERFLOW=<extra connections opened to a PostgreSQL database under load, default 10>
 # ENGINE_COMPREFACE_NAME=tigertag.engine.compreface.ComprefaceEngine
 # ENGINE_COMPREFACE_PREFIX=ttf
 # ENGINE_COMPREFACE_ENABLED=True
@@ -54,6 +105,7 @@ from tigertag.notifier.email import EmailNotifier
 # ENGINE_COMPREFACE_API_URL=http://localhost
 # ENGINE_COMPREFACE_FACES_FOLDER=data/faces
 # ENGINE_COMPREFACE_FACES_CONFIG=data/faces/faces.yaml
+# ENGINE_COMPREFACE_MIN_CONFIDENCE=<faces at or below this similarity, 0-100, are not tagged, default 85>
 # NOTIFIER_EMAIL_NAME=tigertag.notifier.email.EmailNotifier
 # NOTIFIER_EMAIL_ENABLED=True
 # NOTIFIER_EMAIL_FROM=<ex: your-from-address@gmail.com>
@@ -66,49 +118,398 @@ from tigertag.notifier.email import EmailNotifier
 # NOTIFIER_EMAIL_PASSWORD=<email account password>
 
 
-MIN_CONFIDENCE = 30
+MIN_CONFIDENCE = float(os.environ.get('MIN_CONFIDENCE', 30))
 
 logger = logging.getLogger(__name__)
 FOUND_TAGS: dict[str, TagInfo] = {}
 FOUND_FILES: dict[str, FileInfo] = {}
+SAVED_API_CALLS = 0  # engine calls avoided by reusing tags that are already in the database
 notifier_manager: NotifierManager = None
 engine_manager: EngineManager = None
 stasher_manager: StasherManager = None
 persist: Persist = None
+phash_index: HammingIndex = None  # resource id -> phash, only when PHASH_DISTANCE is set
+STALE_RESOURCES: dict[str, set] = {}  # engine name -> ids of the resources it has to tag again
+pipeline: Pipeline = None  # while a PIPELINE scan runs
+
+
+def begin_batch():
+    batch_size = int(os.environ.get('DB_BATCH_SIZE', 500))
+    if batch_size > 1:
+        persist.begin_batch(batch_size, int(os.environ.get('DB_BATCH_DELAY_MS', 1000)) / 1000)
+
+
+def stash(engine: Engine, path: str, tags: dict, ext_id: str):
+    if pipeline is None:
+        stasher_manager.stash(engine, path, tags, ext_id)
+    else:
+        pipeline.put('stash', (engine, path, tags, ext_id))
+
+
+def keep_tags(tags: dict):
+    return dict(filter(lambda elem: elem[1]['confidence'] >= MIN_CONFIDENCE, tags.items()))
 
 
 def on_tags(engine: Engine, tag_info: TagInfo, ext_id: str):
     if tag_info.tags is not None:
-        new_tags = dict(filter(lambda elem: elem[1]['confidence'] >= MIN_CONFIDENCE, tag_info.tags.items()))
-        new_tag_info = TagInfo(tag_info.path, new_tags)
+        new_tags = keep_tags(tag_info.tags)
+        new_tag_info = TagInfo(tag_info.path, new_tags, tag_info.raw)
         FOUND_TAGS[tag_info.path] = new_tag_info
         persist.set_resource(
             tag_info.path,
             engine=engine.name,
-            tags=new_tags
+            tags=new_tags,
+            fingerprint=engine.fingerprint(),
+            raw_tags=tag_info.raw
         )
-        stasher_manager.stash(engine, tag_info.path, new_tags, ext_id)
+        stash(engine, tag_info.path, new_tags, ext_id)
     else:
         persist.set_resource_rescan(tag_info.path)
 
 
+def stash_stored_tags(resource_id, path: str, ext_id: str):
+    # Send the tags already in the database to the stashers, without asking any engine
+    tags_by_engine = {}
+    for tag_name, tag_detail in persist.get_tags_by_resource_id(resource_id).items():
+        tags_by_engine.setdefault(tag_detail['engine'], {})[tag_name] = {
+            'confidence': tag_detail['confidence']
+        }
+    for engine_name, tags in tags_by_engine.items():
+        engine = engine_manager.engines.get(engine_name)
+        if engine is not None and engine.enabled:
+            stash(engine, path, tags, ext_id)
+
+
+def reconcile_move(file_info: FileInfo):
+    # A new location whose content belongs to a resource that has vanished from its old location
+    # is the same file, moved or renamed.  Only local files can be checked for having vanished.
+    if file_info.temp is not None:
+        return False
+    for resource in persist.get_resources_by_hash(file_info.hash):
+        if not os.path.exists(resource['location']):
+            logger.info('Moved {} to {}.  Will NOT tag'.format(resource['location'], file_info.path))
+            persist.move_resource(
+                resource['location'],
+                file_info.path,
+                file_info.name,
+                size=file_info.size,
+                mtime_ns=file_info.mtime_ns,
+                inode=file_info.inode
+            )
+            stash_stored_tags(resource['id'], file_info.path, file_info.ext_id)
+            return True
+    return False
+
+
+def find_copy(file_info: FileInfo):
+    # Byte for byte copies
+    def find_donor(engine_name, fingerprint):
+        return persist.find_tagged_resource(file_info.hash, engine_name, fingerprint, file_info.path)
+    return find_donor
+
+
+def find_similar(resource_id, phash: str):
+    # Images whose perceptual hash is within PHASH_DISTANCE, nearest first
+    neighbours = [value for distance, value in phash_index.find(int(phash, 16)) if value != resource_id]
+
+    def find_donor(engine_name, fingerprint):
+        if len(neighbours) == 0:
+            return None
+        tagged = persist.find_tagged_resources(neighbours, engine_name, fingerprint)
+        return next((neighbour for neighbour in neighbours if neighbour in tagged), None)
+    return find_donor
+
+
+def calc_phash(file_info: FileInfo):
+    try:
+        return file_info.data.dhash()
+    except (OSError, ValueError) as e:
+        logger.warning('Unable to calculate the perceptual hash of {}: {}'.format(file_info.path, e))
+        return None
+
+
+def reuse_tags(file_info: FileInfo, find_donor, engine_names=None):
+    # The file gets the tags of donors that every enabled engine, or every engine of engine_names, already
+    # tagged with its current settings.  If any engine has no donor, all of them tag the file.
+    global SAVED_API_CALLS
+    donors = {}
+    for engine_name, engine in engine_manager.engines.items():
+        if engine.enabled and (engine_names is None or engine_name in engine_names):
+            fingerprint = engine.fingerprint()
+            donor_id = find_donor(engine_name, fingerprint)
+            if donor_id is None:
+                return False
+            donors[engine_name] = (engine, fingerprint, donor_id)
+    if len(donors) == 0:
+        return False
+    for engine_name, (engine, fingerprint, donor_id) in donors.items():
+        # The donor may have been tagged with other thresholds, so its raw results are used when they were kept
+        raw_tags = persist.get_raw_tags(donor_id, engine_name)
+        if raw_tags is not None:
+            tags = keep_tags(engine.threshold(raw_tags))
+        else:
+            tags = {}
+            for tag_name, tag_detail in persist.get_tags_by_resource_id(donor_id, engine_name).items():
+                tags[tag_name] = {
+                    'confidence': tag_detail['confidence']
+                }
+        logger.debug('Reusing {} tags of resource {} for {}'.format(engine_name, donor_id, file_info.path))
+        persist.set_resource(
+            file_info.path,
+            engine=engine_name,
+            tags=tags,
+            fingerprint=fingerprint,
+            raw_tags=raw_tags
+        )
+        stash(engine, file_info.path, tags, file_info.ext_id)
+    SAVED_API_CALLS += len(donors)
+    return True
+
+
+def stale_engines(resource_id):
+    return [engine_name for engine_name, resource_ids in STALE_RESOURCES.items() if resource_id in resource_ids]
+
+
+def tag_file(file_info: FileInfo, resource_id, phash: str, engine_names=None):
+    # Reuses the tags of a copy, or of a similar image, when there is one for every engine to run.
+    # Otherwise the engines tag the file.
+    if not reuse_tags(file_info, find_copy(file_info), engine_names) and \
+            not (phash is not None and reuse_tags(file_info, find_similar(resource_id, phash), engine_names)):
+        if pipeline is None:
+            engine_manager.submit(file_info.path, file_info.temp, file_info.ext_id, file_info.data, file_info.hash,
+                                  engine_names)
+        else:
+            if file_info.data is not None:
+                file_info.data.keep()
+            pipeline.put('tag', (file_info, engine_names))
+    for resource_ids in STALE_RESOURCES.values():
+        resource_ids.discard(resource_id)
+
+
+def is_unchanged(resource, file_info: FileInfo):
+    # The file needs nothing: same content and stat values as its resource, a perceptual hash when those
+    # are kept, and no engine that has to tag it again
+    return resource is not None and resource['hashval'] == file_info.hash and \
+        (file_info.size is None or (resource['size'], resource['mtime_ns'], resource['inode']) ==
+         (file_info.size, file_info.mtime_ns, file_info.inode)) and \
+        (phash_index is None or resource['phash'] is not None or file_info.data is None) and \
+        len(stale_engines(resource['id'])) == 0
+
+
 def on_file(scanner: Scanner, file_info: FileInfo):
     tag_it = True
     temp_date_time = datetime.datetime.now()
-    resource = persist.get_resource_by_location(file_info.path)
-    if resource is not None:
-        if resource['hashval'] == file_info.hash:
+    resource = persist.lookup_resource(file_info.path)
+    if is_unchanged(resource, file_info):
+        logger.debug('Hash did not change.  Will NOT tag {}'.format(file_info.path))
+        return
+    if resource is None:
+        tag_it = not reconcile_move(file_info)
+    elif resource['hashval'] == file_info.hash:
+        tag_it = False
+        if file_info.size is not None and \
+                (resource['size'], resource['mtime_ns'], resource['inode']) != \
+                (file_info.size, file_info.mtime_ns, file_info.inode):
+            # Remember the stat values so the next FAST scan can skip hashing this file
+            persist.set_resource(
+                file_info.path,
+                size=file_info.size,
+                mtime_ns=file_info.mtime_ns,
+                inode=file_info.inode
+            )
+        phash = resource['phash'] if phash_index is not None else None
+        if phash_index is not None and phash is None and file_info.data is not None:
+            # Tagged before perceptual hashes were kept
+            phash = calc_phash(file_info)
+            if phash is not None:
+                persist.set_resource(file_info.path, phash=phash)
+                phash_index.add(resource['id'], int(phash, 16))
+        # Only the engines that were added or reconfigured since the file was tagged
+        engine_names = stale_engines(resource['id'])
+        if len(engine_names) > 0:
+            logger.debug('Hash did not change.  Will tag {} with {}'.format(file_info.path, ', '.join(engine_names)))
+            tag_file(file_info, resource['id'], phash, engine_names)
+        else:
             logger.debug('Hash did not change.  Will NOT tag {}'.format(file_info.path))
-            tag_it = False
     if tag_it:
         logger.debug('New file or hash changed.  Will tag {}'.format(file_info.path))
-        persist.set_resource(
+        phash = None
+        if phash_index is not None and file_info.data is not None:
+            phash = calc_phash(file_info)
+        resource = persist.set_resource(
             file_info.path,
             file_info.name,
             file_info.hash,
-            temp_date_time
+            temp_date_time,
+            size=file_info.size,
+            mtime_ns=file_info.mtime_ns,
+            inode=file_info.inode,
+            phash=phash
         )
-        engine_manager.tag(file_info.path, file_info.temp, file_info.ext_id)
+        tag_file(file_info, resource['id'], phash)
+        if phash is not None:
+            phash_index.add(resource['id'], int(phash, 16))
+        elif phash_index is not None:
+            phash_index.discard(resource['id'])
+
+
+def rethreshold():
+    # Works the tags of every resource out again from the kept engine results, with the current thresholds.
+    # Only the tags that change are written and stashed.  Returns how many that was.
+    return engine_manager.rethreshold(
+        persist,
+        keep_tags,
+        lambda engine, location, tags: stash(engine, location, tags, stasher_manager.find_ext_id(location))
+    )
+
+
+def on_delete(scanner: Scanner, path: str):
+    # Resources are kept.  If the file shows up somewhere else, reconcile_move gives it its tags back.
+    logger.debug('File removed {}'.format(path))
+
+
+def release(file_info: FileInfo):
+    if file_info.data is not None:
+        file_info.data.close()
+
+
+def queue_file(scanner: Scanner, file_info: FileInfo):
+    # The scanner closes the data once this returns, and the pipeline needs it for longer
+    if file_info.data is not None:
+        file_info.data.keep()
+    pipeline.feed('check', file_info)
+
+
+def check_file(file_info: FileInfo):
+    # Drops the files that need nothing, most of them in a scan, before they reach the persist stage.  The
+    # persist stage works out everything else, like on_file does.
+    if is_unchanged(persist.lookup_resource(file_info.path), file_info):
+        logger.debug('Hash did not change.  Will NOT tag {}'.format(file_info.path))
+        release(file_info)
+    else:
+        pipeline.put('preprocess', file_info)
+
+
+def preprocess_file(file_info: FileInfo):
+    # Works out the perceptual hash before the persist stage.  Only the hash is kept: a decoded image
+    # waiting in the queues after this stage would take many times the size of its file.
+    if file_info.data is not None and phash_index is not None:
+        calc_phash(file_info)
+        file_info.data.release_image()
+    pipeline.put('persist', file_info)
+
+
+def persist_item(item):
+    # The only stage writing to persist, so every write goes into the batch of its thread
+    if isinstance(item, FileInfo):
+        try:
+            on_file(None, item)
+        finally:
+            release(item)
+    else:
+        on_tags(*item)
+
+
+def tag_item(item):
+    file_info, engine_names = item
+    try:
+        engine_manager.submit(file_info.path, file_info.temp, file_info.ext_id, file_info.data, file_info.hash,
+                              engine_names)
+    finally:
+        release(file_info)
+
+
+async def atag_item(item):
+    file_info, engine_names = item
+    try:
+        await engine_manager.atag(file_info.path, file_info.temp, file_info.ext_id, file_info.data, file_info.hash,
+                                  engine_names)
+    finally:
+        release(file_info)
+
+
+def queue_tags(engine: Engine, tag_info: TagInfo, ext_id: str):
+    # Not bounded, since the persist stage may be waiting for room in the tag stage
+    pipeline.put('persist', (engine, tag_info, ext_id), bounded=False)
+
+
+def stash_item(item):
+    stasher_manager.stash(*item)
+
+
+async def astash_item(item):
+    await stasher_manager.astash(*item)
+
+
+class DeferredDirectories:
+    # What the scanners see of persist during a PIPELINE scan.  Their directory snapshots are only kept once
+    # every file has been through the pipeline, or an INCREMENTAL scan could skip files never tagged.
+    def __init__(self, target: Persist):
+        self.target = target
+        self.directories = []
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def set_directory(self, location, mtime_ns, entry_count, digest):
+        self.directories.append((location, mtime_ns, entry_count, digest))
+
+
+def log_metrics(level=logging.INFO):
+    for metrics in pipeline.metrics():
+        logger.log(level, '{} stage: {} waiting, at most {}, {} handled by {} workers in {:.1f}s, {} errors, '
+                          '{:.1f}s spent waiting for room'.format(
+                              metrics.name, metrics.depth, metrics.max_depth, metrics.processed, metrics.workers,
+                              metrics.busy, metrics.errors, metrics.waited))
+
+
+def scan_with_pipeline(sm: ScannerManager):
+    global pipeline
+    queue_size = int(os.environ.get('PIPELINE_QUEUE_SIZE', 100))
+    pipeline = Pipeline()
+    pipeline.add('check', check_file, int(os.environ.get('PIPELINE_CHECK_WORKERS', 2)), queue_size)
+    pipeline.add('preprocess', preprocess_file, int(os.environ.get('PIPELINE_PREPROCESS_WORKERS', 2)), queue_size)
+    pipeline.add('persist', persist_item, 1, queue_size, setup=begin_batch, teardown=persist.end_batch)
+    tag_workers = int(os.environ.get('PIPELINE_TAG_WORKERS', 4))
+    stash_workers = int(os.environ.get('PIPELINE_STASH_WORKERS', 1))
+    if str2bool(os.environ.get('PIPELINE_ASYNC', 'False')):
+        pipeline.add('tag', atag_item, tag_workers, queue_size, teardown=engine_manager.aclose)
+        pipeline.add('stash', astash_item, stash_workers, queue_size, teardown=stasher_manager.aclose)
+    else:
+        pipeline.add('tag', tag_item, tag_workers, queue_size)
+        pipeline.add('stash', stash_item, stash_workers, queue_size)
+
+    # The batch belongs to the thread that began it, so the persist stage begins its own
+    persist.end_batch()
+    directories = DeferredDirectories(persist)
+    scanner_listeners, scanner_persist, engine_listeners = sm.listeners, sm.persist, engine_manager.listeners
+    sl = ScannerListener()
+    sl.on_file = queue_file
+    sl.on_delete = on_delete
+    el = EngineListener()
+    el.on_tags = queue_tags
+    sm.listeners, sm.persist, engine_manager.listeners = [sl], directories, [el]
+    stopped = threading.Event()
+
+    def monitor():
+        while not stopped.wait(float(os.environ.get('PIPELINE_METRICS_INTERVAL', 60))):
+            log_metrics(logging.DEBUG)
+    threading.Thread(target=monitor, name='pipeline-metrics', daemon=True).start()
+    pipeline.start()
+    try:
+        sm.scan()
+        pipeline.join()
+        engine_manager.flush()  # its tags go through the persist and stash stages
+        pipeline.join()
+    finally:
+        stopped.set()
+        pipeline.stop()
+        log_metrics()
+        pipeline = None
+        sm.listeners, sm.persist, engine_manager.listeners = scanner_listeners, scanner_persist, engine_listeners
+        begin_batch()
+    for directory in directories.directories:
+        persist.set_directory(*directory)
 
 
 def add_smtp_logging_handler():
@@ -146,6 +547,15 @@ if __name__ == "__main__":
         deb = EnvironmentDbEngineBuilder()
         de = deb.build()
         persist = Persist(de)
+        if str2bool(os.environ.get('PRELOAD_RESOURCES', 'True')):
+            logger.info('Preloaded {} resources'.format(persist.preload()))
+        begin_batch()
+
+        if 'PHASH_DISTANCE' in os.environ:
+            phash_index = HammingIndex(int(os.environ['PHASH_DISTANCE']))
+            for resource_id, resource_phash in persist.get_phashes().items():
+                phash_index.add(resource_id, int(resource_phash, 16))
+            logger.info('Loaded {} perceptual hashes'.format(len(phash_index)))
 
         el = EngineListener()
         el.on_tags = on_tags
@@ -156,15 +566,52 @@ if __name__ == "__main__":
         stmb = EnvironmentStasherManagerBuilder(StasherManager)
         stasher_manager = stmb.build()
 
+        if str2bool(os.environ.get('RETHRESHOLD', 'False')):
+            changed = rethreshold()
+            persist.flush()
+            logger.info('Rethresholded the tags of {} resources'.format(changed))
+            notifier_manager.notify(NotificationInfo(
+                'TigerTag', 'Rethreshold Complete.  The tags of {} resources changed.'.format(changed)))
+            sys.exit(0)
+
+        for engine_name, engine in engine_manager.engines.items():
+            if engine.enabled:
+                STALE_RESOURCES[engine_name] = persist.get_stale_resource_ids(engine_name, engine.fingerprint())
+                if len(STALE_RESOURCES[engine_name]) > 0:
+                    logger.info('{} resources to tag with {}'.format(len(STALE_RESOURCES[engine_name]), engine_name))
+                    # INCREMENTAL scans would skip them in directories that have not changed
+                    persist.forget_directory_snapshots(STALE_RESOURCES[engine_name])
+
         sl = ScannerListener()
         sl.on_file = on_file
+        sl.on_delete = on_delete
         smb = EnvironmentScannerManagerBuilder(ScannerManager)
         sm = smb.build()
         sm.listeners.append(sl)
+        sm.persist = persist
 
-        sm.scan()
+        if str2bool(os.environ.get('PIPELINE', 'False')):
+            scan_with_pipeline(sm)
+        else:
+            sm.scan()
+            engine_manager.flush()
+        persist.flush()
+
+        logger.info('{} engine calls saved by reusing tags'.format(SAVED_API_CALLS))
+        if engine_manager.cache is not None:
+            logger.info('{} engine calls saved by the response cache, {} misses, {} evictions'.format(
+                engine_manager.cache.hits, engine_manager.cache.misses, engine_manager.cache.evictions))
+        notifier_manager.notify(NotificationInfo(
+            'TigerTag', 'Scan Complete.  {} engine calls saved by reusing tags.'.format(SAVED_API_CALLS)))
 
-        notifier_manager.notify(NotificationInfo('TigerTag', 'Scan Complete'))
+        if any(scanner.enabled and scanner.watches() for scanner in sm.scanners.values()):
+            engine_manager.batch_size = 1  # watched files come one at a time, and would wait for a full batch
+            sm.watch()
     except Exception as e:
         logger.error(f'{e}\n{traceback.format_exc()}')
         raise e
+    finally:
+        if engine_manager is not None:
+            engine_manager.shutdown()
+        if persist is not None:
+            persist.end_batch()
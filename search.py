@@ -0,0 +1,64 @@
+import argparse
+import logging
+import sys
+import time
+
+from tigertag.db import EnvironmentDbEngineBuilder
+from tigertag.db import Persist
+from tigertag.db.search import TagIndex
+
+# Finds the tagged resources that match a boolean expression of tags, reading the database in DB_URL.
+#
+#   python search.py "ttf_alice AND Tti_beach>=60"
+#   python search.py --count "(Tti_dog OR Tti_cat) AND NOT Tti_person"
+#   python search.py --interactive
+#
+# The confidence tests are >=, >, <=, < and =.  NOT binds tighter than AND, and AND tighter than OR.
+
+logger = logging.getLogger(__name__)
+
+
+def run(tag_index: TagIndex, persist: Persist, expression: str, count: bool, limit: int):
+    start = time.perf_counter()
+    if count:
+        print(tag_index.count(expression))
+    else:
+        ids = tag_index.search(expression, limit)
+        records = persist.get_resource_records(ids)
+        for resource_id in ids:
+            print(records[resource_id].location)
+    logger.info('Searched {!r} in {:.1f} ms'.format(expression, (time.perf_counter() - start) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the tagged resources')
+    parser.add_argument('expression', nargs='?')
+    parser.add_argument('--count', action='store_true', help='print the number of matches instead')
+    parser.add_argument('--limit', type=int, default=None, help='print at most this many matches')
+    parser.add_argument('--interactive', action='store_true',
+                        help='read one search per line, picking up new tags before each one')
+    args = parser.parse_args()
+    if args.expression is None and not args.interactive:
+        parser.error('an expression or --interactive is required')
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format='%(message)s')
+    persist = Persist(EnvironmentDbEngineBuilder().build())
+    tag_index = TagIndex(persist)
+    start = time.perf_counter()
+    logger.info('Loaded {} resources in {:.1f} s'.format(tag_index.load(), time.perf_counter() - start))
+
+    if args.expression is not None:
+        run(tag_index, persist, args.expression, args.count, args.limit)
+    if args.interactive:
+        for line in sys.stdin:
+            if line.strip() == '':
+                continue
+            tag_index.refresh()
+            try:
+                run(tag_index, persist, line.strip(), args.count, args.limit)
+            except ValueError as e:
+                logger.error(e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import datetime
+import os.path
+import unittest
+
+from alembic import command
+from alembicverify.util import make_alembic_config
+from sqlalchemydiff.util import destroy_database, new_db
+
+from tigertag.db import DbEngine
+from tigertag.db import Persist
+from tigertag.db.search import And, Not, Or, Term
+from tigertag.db.search import TagIndex
+from tigertag.db.search import parse
+
+DB_NAME = 'tigertag_search.db'
+DB_URL = os.environ.get('TEST_DB_URL', 'sqlite:///{}'.format(DB_NAME))
+ALEMBIC_ROOT = os.path.join(os.path.dirname(__file__), '..', '..', 'alembic')
+ALEMBIC_LOG_CONFIG = os.path.join(os.path.dirname(__file__), '..', '..', 'alembic.ini')
+
+
+class TestParse(unittest.TestCase):
+    def test_precedence(self):
+        self.assertEqual(
+            Or(Term('a', None, None), And(Term('b', '>=', 60), Not(Term('c', '<', 5)))),
+            parse('a OR b>=60 AND NOT c < 5'))
+        self.assertEqual(And(Or(Term('a', None, None), Term('b', None, None)), Term('c', '=', 1)),
+                         parse('(a or b) c=1'))
+
+    def test_errors(self):
+        for expression in ('', 'a AND', '(a', 'a)', 'a >= b', '>= 5', 'NOT'):
+            with self.assertRaises(ValueError, msg=expression):
+                parse(expression)
+
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
+        new_db(DB_URL)
+        alembic_config = make_alembic_config(DB_URL, ALEMBIC_ROOT)
+        alembic_config.config_file_name = ALEMBIC_LOG_CONFIG
+        command.upgrade(alembic_config, 'head')
+        self.e = DbEngine(DB_URL)
+        self.p = Persist(self.e)
+        self.tag('smile.png', 'IMAGGA', {'person': 90, 'smile': 60})
+        self.tag('smile.png', 'COMPREFACE', {'ttf_alice': 99})
+        self.tag('frown.png', 'IMAGGA', {'person': 40})
+        self.tag('beach.png', 'IMAGGA', {'beach': 75, 'person': 60})
+        self.tag('blank.png', 'IMAGGA', {})
+        self.index = TagIndex(self.p)
+        self.assertEqual(4, self.index.load())
+
+    def tag(self, name, engine, tags):
+        location = 'data/images/input/' + name
+        if self.p.get_resource_by_location(location) is None:
+            self.p.set_resource(location, name, 'abc', datetime.datetime.now())
+        self.p.set_resource(location, engine=engine,
+                            tags={tag: {'confidence': confidence} for tag, confidence in tags.items()})
+
+    def test_search(self):
+        self.assertEqual([1, 2, 3], self.index.search('person'))
+        self.assertEqual([1, 3], self.index.search('person>=60'))
+        self.assertEqual([1], self.index.search('person>60'))
+        self.assertEqual([2, 3], self.index.search('person<=60'))
+        self.assertEqual([2], self.index.search('person<60'))
+        self.assertEqual([3], self.index.search('person=60'))
+        self.assertEqual([1], self.index.search('ttf_alice AND person>=60'))
+        self.assertEqual([1, 3], self.index.search('ttf_alice OR beach'))
+        self.assertEqual([2, 4], self.index.search('NOT (ttf_alice OR beach)'))
+        self.assertEqual([], self.index.search('unknown'))
+        self.assertEqual([1], self.index.search('person', limit=1))
+        self.assertEqual(2, self.index.count('person AND NOT beach'))
+
+    def test_refresh(self):
+        self.assertEqual(0, self.index.refresh())
+        self.tag('frown.png', 'IMAGGA', {'person': 70, 'beach': 50})
+        self.tag('smile.png', 'COMPREFACE', {})
+        self.tag('new.png', 'IMAGGA', {'dog': 80})
+        self.assertEqual([1, 3], self.index.search('person>=60'))  # unchanged until the refresh
+        self.assertEqual(3, self.index.refresh())
+        self.assertEqual([1, 2, 3], self.index.search('person>=60'))
+        self.assertEqual([2, 3], self.index.search('beach'))
+        self.assertEqual([], self.index.search('ttf_alice'))
+        self.assertEqual([5], self.index.search('dog'))
+        self.assertEqual([4], self.index.search('NOT (person OR dog)'))
+        self.assertEqual(0, self.index.refresh())
+
+        # Loading everything again gives the same answers
+        self.index.max_overrides = 0
+        self.tag('beach.png', 'IMAGGA', {'beach': 75})
+        self.assertEqual(1, self.index.refresh())
+        self.assertEqual({}, self.index._overrides)
+        self.assertEqual([1, 2], self.index.search('person>=60'))
+        self.assertEqual([2, 3], self.index.search('beach'))
+
+    def tearDown(self):
+        self.e.dispose()
+        destroy_database(DB_URL)
+        if os.path.exists(DB_NAME):
+            os.remove(DB_NAME)
@@ -0,0 +1,50 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from tigertag.engine.cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.path = os.path.join(self.work, 'cache', 'responses.db')
+        self.c = ResponseCache(self.path)
+
+    def test_get_put(self):
+        key = ResponseCache.key('2b87de0a', 'settings')
+        self.assertIsNone(self.c.get(key))
+        self.c.put(key, [['tree', 46.97], ['sky', 100]])
+        self.assertEqual([['tree', 46.97], ['sky', 100]], self.c.get(key))
+        self.c.put(key, [])
+        self.assertEqual([], self.c.get(key))
+        self.assertEqual((2, 1, 1), (self.c.hits, self.c.misses, len(self.c)))
+
+        # Kept on disk
+        self.c.close()
+        self.c = ResponseCache(self.path)
+        self.assertEqual([], self.c.get(key))
+        self.assertEqual(1, len(self.c))
+
+    def test_eviction(self):
+        value = [['tag{}'.format(i), i] for i in range(20)]
+        self.c.put('a', value)
+        self.c.max_bytes = self.c.size * 7 // 2  # room for 3
+        self.c.put('b', value)
+        self.c.put('c', value)
+        self.assertEqual(value, self.c.get('a'))  # b is now the least recently used
+        self.c.put('d', value)
+        self.assertEqual(1, self.c.evictions)
+        self.assertIsNone(self.c.get('b'))
+        self.assertEqual(value, self.c.get('a'))
+        self.assertEqual(3, len(self.c))
+        self.assertLessEqual(self.c.size, self.c.max_bytes)
+
+        self.c.close()
+        self.c = ResponseCache(self.path, self.c.max_bytes)
+        self.assertEqual((3, self.c.size), (len(self.c), ResponseCache(self.path).size))
+
+    def tearDown(self):
+        self.c.close()
+        shutil.rmtree(self.work)
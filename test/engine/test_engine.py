@@ -1,3 +1,8 @@
+import asyncio
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 from tigertag.engine import *
@@ -15,6 +20,15 @@ class TestEngine(unittest.TestCase):
     def test_tag_not_implemented(self):
         self.assertRaises(NotImplementedError, self.e.tag, 'path_ex', 'temp_ex', 'ext_id_ex')
 
+    def test_threshold(self):
+        raw_tags = {'tst_a': {'confidence': 90}, 'tst_b': {'confidence': 1}}
+        self.assertEqual(raw_tags, self.e.threshold(raw_tags))
+        self.assertEqual((None, None), TagInfo('path_ex', None)[1:])
+
+    def test_fingerprint(self):
+        self.assertEqual(self.e.fingerprint(), Engine('other_name', 'tst', True).fingerprint())
+        self.assertNotEqual(self.e.fingerprint(), Engine('test_engine', 'tt2', False).fingerprint())
+
 
 class TestEngineManager(unittest.TestCase):
     def setUp(self):
@@ -33,7 +47,7 @@ class TestEngineManager(unittest.TestCase):
             'The {} engine has not implemented the tag method.'.format(self.e.name),
             self.em.tag, 'path_ex', 'temp_ex', 'ext_id_ex')
 
-    def _tag_stub(self, path: str, temp: str, ext_id: str):
+    def _tag_stub(self, path: str, temp: str, ext_id: str, data: ImageData = None):
         pass
 
     def test_duplicate_prefix(self):
@@ -47,6 +61,239 @@ class TestEngineManager(unittest.TestCase):
             'will resolve the issue.'.format(self.e3.prefix, self.e3.name),
             self.em.tag, 'Not Needed')
 
+    def test_cache(self):
+        work = tempfile.mkdtemp()
+        try:
+            self.em.cache = ResponseCache(os.path.join(work, 'responses.db'))
+            calls = []
+            found = []
+
+            def tag_stub(path, temp=None, ext_id=None, data=None):
+                calls.append(path)
+                raw = {self.e.calc_tag_name('tree'): {'confidence': 90}, self.e.calc_tag_name('sky'): {'confidence': 5}}
+                return TagInfo(path, {self.e.calc_tag_name('tree'): {'confidence': 90}}, raw)
+            self.e.tag = tag_stub
+            self.e.threshold = lambda raw_tags: {name: tag_detail for name, tag_detail in raw_tags.items()
+                                                 if tag_detail['confidence'] >= 50}
+            el = EngineListener()
+            el.on_tags = lambda engine, tag_info, ext_id: found.append(tag_info)
+            self.em.listeners.append(el)
+
+            self.em.tag('a.jpg', hashval='abc')
+            self.em.tag('copy_of_a.jpg', hashval='abc')
+            self.em.tag('b.jpg', hashval='def')
+            self.em.tag('c.jpg')
+            self.assertEqual(['a.jpg', 'b.jpg', 'c.jpg'], calls)
+            self.assertEqual(TagInfo('copy_of_a.jpg', {'tst_tree': {'confidence': 90}},
+                                     {'tst_tree': {'confidence': 90}, 'tst_sky': {'confidence': 5}}), found[0])
+            self.assertEqual((1, 2), (self.em.cache.hits, self.em.cache.misses))
+
+            # A new prefix still uses the cached response
+            self.e.prefix = 'new'
+            self.em.tag('d.jpg', hashval='abc')
+            self.assertEqual({'new_tree', 'new_sky'}, set(found[-1].raw.keys()))
+            self.assertEqual(3, len(calls))
+            self.em.cache.close()
+        finally:
+            shutil.rmtree(work)
+
+    def test_tag_engines(self):
+        calls = []
+        self.e.tag = lambda path, temp=None, ext_id=None, data=None: calls.append(('test_engine_2', path))
+        self.e3 = Engine('test_engine_3', 'ts3', True)
+        self.e3.tag = lambda path, temp=None, ext_id=None, data=None: calls.append(('test_engine_3', path))
+        self.em.add(self.e3)
+        self.em.tag('a.jpg', engines=['test_engine_3'])
+        self.em.tag('b.jpg')
+        self.assertEqual([('test_engine_3', 'a.jpg'), ('test_engine_2', 'b.jpg'), ('test_engine_3', 'b.jpg')], calls)
+
+        self.e3.prefix = 'tst'
+        self.assertRaises(ValueError, self.em.tag, 'c.jpg', engines=['test_engine_3'])
+
+    def test_tag_concurrent(self):
+        active = {'test_engine_2': 0, 'test_engine_3': 0}
+        most_active = dict(active)
+        most_active_engines = []
+        both_tagging = threading.Barrier(2, timeout=5)  # broken unless both engines tag a.jpg at once
+        lock = threading.Lock()
+        found = []
+
+        def tag_stub(engine):
+            def tag(path, temp=None, ext_id=None, data=None):
+                with lock:
+                    active[engine.name] += 1
+                    most_active[engine.name] = max(most_active[engine.name], active[engine.name])
+                    most_active_engines.append(len([count for count in active.values() if count > 0]))
+                if path == 'a.jpg':
+                    both_tagging.wait()
+                time.sleep(0.05)
+                with lock:
+                    active[engine.name] -= 1
+                if path == 'fail.jpg':
+                    raise OSError('Unable to tag')
+                tag_info = TagInfo(path, {engine.calc_tag_name('tree'): {'confidence': 90}})
+                for listener in engine.listeners:
+                    listener.on_tags(engine, tag_info, ext_id)
+                return tag_info
+            return tag
+
+        self.e.tag = tag_stub(self.e)
+        self.e3 = Engine('test_engine_3', 'ts3', True)
+        self.e3.tag = tag_stub(self.e3)
+        self.e3.props['MAX_CONCURRENCY'] = '2'
+        self.em.add(self.e3)
+        self.em.workers = 4
+        el = EngineListener()
+        el.on_tags = lambda engine, tag_info, ext_id: found.append((engine.name, tag_info.path, ext_id,
+                                                                    threading.current_thread()))
+        self.em.listeners.append(el)
+
+        self.em.tag('a.jpg', ext_id='1')
+        self.assertEqual(2, max(most_active_engines))  # not one engine after the other
+        self.assertEqual([('test_engine_2', 'a.jpg', '1', threading.current_thread()),
+                          ('test_engine_3', 'a.jpg', '1', threading.current_thread())], found)
+
+        threads = [threading.Thread(target=self.em.tag, args=('{}.jpg'.format(i),)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({'test_engine_2': 1, 'test_engine_3': 2}, most_active)
+        self.assertEqual(10, len(found))
+
+        self.assertRaises(OSError, self.em.tag, 'fail.jpg')
+        self.em.shutdown()
+
+    def test_tag_batch(self):
+        calls = []
+        found = []
+
+        def tag_stub(engine):
+            def tag(path, temp=None, ext_id=None, data=None):
+                calls.append((engine.name, path))
+                tag_info = TagInfo(path, {engine.calc_tag_name('tree'): {'confidence': 90}})
+                for listener in engine.listeners:
+                    listener.on_tags(engine, tag_info, ext_id)
+                return tag_info
+            return tag
+
+        class BatchEngine(Engine):
+            def tag_batch(self, items):
+                calls.append((self.name, [item.path for item in items]))
+                return [TagInfo(item.path, {}) for item in items]
+
+        self.e.tag = tag_stub(self.e)
+        self.e3 = BatchEngine('test_engine_3', 'ts3', True)
+        self.em.add(self.e3)
+        self.em.batch_size = 2
+        work = tempfile.mkdtemp()
+        try:
+            image_path = os.path.join(work, 'a.jpg')
+            shutil.copy(os.path.join(os.getcwd(), 'data', 'images', 'input', 'boy.jpg'), image_path)
+            with ImageData(image_path) as data:
+                self.em.submit('a.jpg', data=data, engines=['test_engine_3'])
+            self.assertEqual([], calls)
+            self.assertIsNotNone(data.buffer)  # kept open for the batch
+            self.em.submit('b.jpg')
+            self.assertEqual([('test_engine_2', 'b.jpg'), ('test_engine_3', ['a.jpg', 'b.jpg'])], calls)
+            self.assertIsNone(data.buffer)
+        finally:
+            shutil.rmtree(work)
+
+        calls.clear()
+        self.em.submit('c.jpg')
+        self.em.flush()
+        self.em.flush()
+        self.assertEqual([('test_engine_2', 'c.jpg'), ('test_engine_3', ['c.jpg'])], calls)
+
+        # The cache answers for the images it knows, the engine gets the others
+        calls.clear()
+        self.em.cache = ResponseCache(os.path.join(tempfile.mkdtemp(), 'responses.db'))
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.em.cache.path))
+        self.addCleanup(self.em.cache.close)
+        el = EngineListener()
+        el.on_tags = lambda engine, tag_info, ext_id: found.append((engine.name, tag_info.path))
+        self.em.listeners.append(el)
+        self.em.tag_batch([TagRequest('d.jpg', hashval='abc')])
+        self.em.tag_batch([TagRequest('copy_of_d.jpg', hashval='abc'), TagRequest('e.jpg', hashval='def')])
+        self.assertEqual([('test_engine_2', 'd.jpg'), ('test_engine_3', ['d.jpg']),
+                          ('test_engine_2', 'e.jpg'), ('test_engine_3', ['e.jpg'])], calls)
+        self.assertEqual([('test_engine_2', 'd.jpg'), ('test_engine_2', 'copy_of_d.jpg'),
+                          ('test_engine_2', 'e.jpg'), ('test_engine_3', 'copy_of_d.jpg')], found)
+        items = [TagRequest('copy_of_d.jpg', hashval='abc'), TagRequest('g.jpg', hashval='ghi'),
+                 TagRequest('e.jpg', hashval='def')]
+        self.assertEqual(['copy_of_d.jpg', 'g.jpg', 'e.jpg'],
+                         [tag_info.path for tag_info in self.em._tag_batch(self.e3, items)])
+
+        found.clear()
+        self.em.workers = 2
+        self.em.tag_batch([TagRequest('f.jpg')])
+        self.assertEqual([('test_engine_2', 'f.jpg')], found)
+        self.em.shutdown()
+
+    def test_atag(self):
+        found = []
+        # Calls of both engines being tagged.  Each call waits, at most 5 seconds, until all 10 calls of the
+        # images below are in flight, so they only get there if no image, or engine, waits for another.
+        active = {'now': 0, 'most': 0}
+        all_active = threading.Condition()
+
+        def enter():
+            with all_active:
+                active['now'] += 1
+                active['most'] = max(active['most'], active['now'])
+                all_active.notify_all()
+
+        def leave():
+            with all_active:
+                active['now'] -= 1
+
+        class AsyncEngine(Engine):
+            async def atag(self, path, temp=None, ext_id=None, data=None):
+                enter()
+                deadline = time.monotonic() + 5
+                while active['most'] < 10 and path != 'fail.jpg' and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+                leave()
+                if path == 'fail.jpg':
+                    raise OSError('Unable to tag')
+                return TagInfo(path, {self.calc_tag_name('tree'): {'confidence': 90}})
+
+        def tag_stub(path, temp=None, ext_id=None, data=None):
+            enter()
+            with all_active:
+                all_active.wait_for(lambda: active['most'] >= 10 or path == 'fail.jpg', timeout=5)
+            leave()
+            tag_info = TagInfo(path, {self.e.calc_tag_name('sky'): {'confidence': 80}})
+            for listener in self.e.listeners:
+                listener.on_tags(self.e, tag_info, ext_id)  # atag passes it on instead
+            return tag_info
+
+        self.e.tag = tag_stub
+        self.e.props['MAX_CONCURRENCY'] = '5'
+        self.e3 = AsyncEngine('test_engine_3', 'ts3', True)
+        self.e3.props['MAX_CONCURRENCY'] = '5'
+        self.em.add(self.e3)
+        el = EngineListener()
+        el.on_tags = lambda engine, tag_info, ext_id: found.append((engine.name, tag_info.path, ext_id,
+                                                                    threading.current_thread()))
+        self.em.listeners.append(el)
+
+        async def tag_all():
+            await asyncio.gather(*[self.em.atag('{}.jpg'.format(i), ext_id=str(i)) for i in range(5)])
+
+        asyncio.run(tag_all())
+        self.assertEqual(10, active['most'])  # not one image, or one engine, after the other
+        self.assertEqual(10, len(found))
+        self.assertEqual([('test_engine_2', '0.jpg', '0', threading.current_thread()),
+                          ('test_engine_3', '0.jpg', '0', threading.current_thread())],
+                         [call for call in found if call[1] == '0.jpg'])
+
+        found.clear()
+        self.assertRaises(OSError, asyncio.run, self.em.atag('fail.jpg'))
+        self.assertEqual([('test_engine_2', 'fail.jpg', None, threading.current_thread())], found)
+        asyncio.run(self.em.aclose())
+
     def test_missing_prefix(self):
         self.e.prefix = None
         self.assertRaisesRegex(
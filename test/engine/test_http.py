@@ -0,0 +1,248 @@
+import asyncio
+import json
+import os
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from tigertag.engine import EngineListener
+from tigertag.engine import TagInfo
+from tigertag.engine import TagRequest
+from tigertag.engine.compreface import ComprefaceEngine
+from tigertag.engine.imagga import ImaggaEngine
+
+
+class StubServer(ThreadingHTTPServer):
+    # Answers every request to a path with the JSON in routes, and keeps the requests.  A list of answers is
+    # given in turn, the last one for every request after.  A bytes answer is sent as it is.
+    def __init__(self, routes):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.routes = routes
+        self.requests = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def answer(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests.append((self.command, url.path, parse_qs(url.query), dict(self.headers), body,
+                                         self.client_address))
+        with self.server.lock:
+            answers = self.server.routes.get(url.path, (404, {'message': 'not found'}))
+            if isinstance(answers, list):
+                answers = answers.pop(0) if len(answers) > 1 else answers[0]
+        status, result = answers
+        data = result if isinstance(result, bytes) else json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html' if isinstance(result, bytes) else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = answer
+    do_POST = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+def image_path(name):
+    return os.path.normpath(os.path.join(os.getcwd(), 'data', 'images', 'input', name))
+
+
+class TestImaggaEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer({
+            '/uploads': (200, {'result': {'upload_id': 'i05e1'}, 'status': {'text': '', 'type': 'success'}}),
+            '/tags': (200, {'result': {'tags': [{'confidence': 61.5, 'tag': {'en': 'child'}},
+                                                {'confidence': 7.2, 'tag': {'en': 'toy'}}]}}),
+        })
+        self.e = ImaggaEngine('imagga_engine', 'tti', True)
+        self.e.props['API_KEY'] = 'key'
+        self.e.props['API_SECRET'] = 'secret'
+        self.e.props['API_URL'] = self.server.url
+        self.found_tags = []
+        el = EngineListener()
+        el.on_tags = lambda engine, tag_info, ext_id: self.found_tags.append(tag_info)
+        self.e.listeners.append(el)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_tag(self):
+        tags = {'tti_child': {'confidence': 61.5}, 'tti_toy': {'confidence': 7.2}}
+        self.assertEqual(TagInfo(image_path('boy.jpg'), tags, tags), self.e.tag(image_path('boy.jpg')))
+        self.assertEqual(1, len(self.found_tags))
+        self.assertEqual([('POST', '/tags')], [request[:2] for request in self.server.requests])
+        self.assertEqual({'verbose': ['False'], 'language': ['en']}, self.server.requests[0][2])
+        self.assertIn(b'filename="boy.jpg"', self.server.requests[0][4])
+
+    def test_tag_two_steps(self):
+        self.e.props['SINGLE_REQUEST'] = 'False'
+        tags = {'tti_child': {'confidence': 61.5}, 'tti_toy': {'confidence': 7.2}}
+        self.assertEqual(TagInfo(image_path('boy.jpg'), tags, tags), self.e.tag(image_path('boy.jpg')))
+        self.assertEqual([('POST', '/uploads'), ('GET', '/tags')], [request[:2] for request in self.server.requests])
+        self.assertEqual({'image_upload_id': ['i05e1'], 'verbose': ['False'], 'language': ['en']},
+                         self.server.requests[1][2])
+
+    def test_tag_batch(self):
+        items = [TagRequest(image_path('boy.jpg'), ext_id='1'), TagRequest(image_path('girl.jpg'))]
+        tag_infos = self.e.tag_batch(items)
+        self.assertEqual([image_path('boy.jpg'), image_path('girl.jpg')], [tag_info.path for tag_info in tag_infos])
+        self.assertEqual(tag_infos, self.found_tags)
+        self.assertEqual([('POST', '/tags')] * 2, [request[:2] for request in self.server.requests])
+        self.assertEqual(1, len({request[5] for request in self.server.requests}))  # one connection
+
+        self.server.requests.clear()
+        self.e.props['SINGLE_REQUEST'] = 'False'
+        self.assertEqual(tag_infos, self.e.tag_batch(items))
+        self.assertEqual(['/uploads', '/uploads', '/tags', '/tags'], [request[1] for request in self.server.requests])
+        self.assertEqual(1, len({request[5] for request in self.server.requests}))
+
+    def test_atag(self):
+        async def tag_all():
+            try:
+                return await asyncio.gather(*[self.e.atag(image_path(name)) for name in ('boy.jpg', 'girl.jpg')])
+            finally:
+                await self.e.aclose()
+
+        boy, girl = asyncio.run(tag_all())
+        self.assertEqual({'tti_child': {'confidence': 61.5}, 'tti_toy': {'confidence': 7.2}}, boy.tags)
+        self.assertEqual(image_path('girl.jpg'), girl.path)
+        self.assertEqual([], self.found_tags)  # EngineManager.atag calls the listeners
+        self.assertEqual([('POST', '/tags')] * 2, [request[:2] for request in self.server.requests])
+        self.assertEqual({'verbose': ['False'], 'language': ['en']}, self.server.requests[0][2])
+        self.assertEqual('Basic a2V5OnNlY3JldA==', self.server.requests[0][3]['Authorization'])
+
+        self.server.requests.clear()
+        self.e.props['SINGLE_REQUEST'] = 'False'
+        self.assertEqual([boy, girl], asyncio.run(tag_all()))
+        uploads = [request for request in self.server.requests if request[1] == '/uploads']
+        tags = [request for request in self.server.requests if request[1] == '/tags']
+        self.assertEqual(2, len(uploads))
+        self.assertEqual('POST', uploads[0][0])
+        self.assertIn(b'filename="boy.jpg"', uploads[0][4] + uploads[1][4])
+        self.assertEqual({'image_upload_id': ['i05e1'], 'verbose': ['False'], 'language': ['en']}, tags[0][2])
+        self.assertEqual('Basic a2V5OnNlY3JldA==', tags[0][3]['Authorization'])
+
+    @mock.patch('tigertag.engine.imagga.RETRY_BACKOFF', 0)
+    def test_tag_gateway_timeout(self):
+        timeout = (504, b'<html><body>504 Gateway Time-out</body></html>')
+        tags = self.server.routes['/tags']
+        self.server.routes['/tags'] = [timeout, tags]
+        self.assertEqual({'tti_child': {'confidence': 61.5}, 'tti_toy': {'confidence': 7.2}},
+                         self.e.tag(image_path('boy.jpg')).tags)
+        self.assertEqual([('POST', '/tags')] * 2, [request[:2] for request in self.server.requests])
+
+        self.server.requests.clear()
+        self.e.props['SINGLE_REQUEST'] = 'False'
+        self.server.routes['/uploads'] = [timeout, self.server.routes['/uploads']]
+        self.server.routes['/tags'] = [timeout, tags]
+        self.e.tag(image_path('boy.jpg'))
+        self.assertEqual(['/uploads', '/uploads', '/tags', '/tags'], [request[1] for request in self.server.requests])
+
+        # Given up after the tries
+        self.server.routes['/tags'] = timeout
+        with self.assertRaises(KeyError):
+            self.e.tag(image_path('boy.jpg'))
+
+    @mock.patch('tigertag.engine.imagga.RETRY_BACKOFF', 0)
+    def test_atag_gateway_timeout(self):
+        async def tag():
+            try:
+                return await self.e.atag(image_path('boy.jpg'))
+            finally:
+                await self.e.aclose()
+
+        timeout = (504, b'<html><body>504 Gateway Time-out</body></html>')
+        tags = self.server.routes['/tags']
+        self.server.routes['/tags'] = [timeout, tags]
+        self.assertEqual({'tti_child': {'confidence': 61.5}, 'tti_toy': {'confidence': 7.2}}, asyncio.run(tag()).tags)
+        self.assertEqual([('POST', '/tags')] * 2, [request[:2] for request in self.server.requests])
+
+        self.server.requests.clear()
+        self.e.props['SINGLE_REQUEST'] = 'False'
+        self.server.routes['/uploads'] = [timeout, self.server.routes['/uploads']]
+        self.server.routes['/tags'] = [timeout, tags]
+        asyncio.run(tag())
+        self.assertEqual(['/uploads', '/uploads', '/tags', '/tags'], [request[1] for request in self.server.requests])
+
+    def test_atag_without_aiohttp(self):
+        # tag runs on a thread instead
+        with mock.patch('tigertag.engine.imagga.aiohttp', None):
+            self.e.listeners = []
+            tag_info = asyncio.run(self.e.atag(image_path('boy.jpg')))
+        self.assertEqual({'tti_child': {'confidence': 61.5}, 'tti_toy': {'confidence': 7.2}}, tag_info.tags)
+        self.assertEqual(1, len(self.server.requests))
+
+
+class TestComprefaceEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer({
+            '/api/v1/recognition/recognize': (200, {'result': [
+                {'subjects': [{'subject': 'Roman', 'similarity': 0.99}, {'subject': 'Poppy', 'similarity': 0.2}]},
+                {'subjects': [{'subject': 'Roman', 'similarity': 0.5}]},
+            ]}),
+        })
+        self.e = ComprefaceEngine('compreface_engine', 'ttf', True)
+        self.e.props['API_KEY'] = 'key'
+        self.e.props['API_URL'] = 'http://127.0.0.1'
+        self.e.props['API_PORT'] = str(self.server.server_address[1])
+        self.e._setup_compre_api()
+        self.e.uploaded_faces = True
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_tag(self):
+        tag_info = self.e.tag(image_path('boy.jpg'))
+        self.assertEqual({'ttf_Roman': {'confidence': 99}}, tag_info.tags)
+        self.assertEqual('key', self.server.requests[0][3]['x-api-key'])
+
+    def test_threshold(self):
+        raw_tags = {'ttf_Roman': {'confidence': 99}, 'ttf_Poppy': {'confidence': 60}}
+        self.e.props['MIN_CONFIDENCE'] = '50'
+        self.assertEqual(raw_tags, self.e.threshold(raw_tags))
+        self.assertEqual(50.0, self.e.min_confidence)
+        self.e.props['MIN_CONFIDENCE'] = '90'  # read once
+        self.assertEqual(raw_tags, self.e.threshold(raw_tags))
+
+    def test_tag_batch(self):
+        tag_infos = self.e.tag_batch([TagRequest(image_path('boy.jpg')), TagRequest(image_path('girl.jpg'))])
+        self.assertEqual([{'ttf_Roman': {'confidence': 99}}] * 2, [tag_info.tags for tag_info in tag_infos])
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(1, len({request[5] for request in self.server.requests}))  # one connection
+        self.assertEqual('key', self.server.requests[0][3]['x-api-key'])
+
+    def test_atag(self):
+        async def tag():
+            try:
+                return await self.e.atag(image_path('boy.jpg'))
+            finally:
+                await self.e.aclose()
+
+        tag_info = asyncio.run(tag())
+        self.assertEqual({'ttf_Roman': {'confidence': 99}}, tag_info.tags)
+        self.assertEqual({'ttf_Roman': {'confidence': 99}, 'ttf_Poppy': {'confidence': 20}}, tag_info.raw)
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual('key', self.server.requests[0][3]['x-api-key'])
+
+        self.server.routes['/api/v1/recognition/recognize'] = (400, {'message': 'No face is found in the given image'})
+        self.assertEqual(TagInfo(image_path('boy.jpg'), {}, {}), asyncio.run(tag()))
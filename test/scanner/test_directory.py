@@ -1,5 +1,9 @@
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from tigertag.scanner import *
@@ -57,4 +61,198 @@ class TestDirectoryScanner(unittest.TestCase):
                          file_info.hash)
         self.assertEqual('sunflower.jpg', file_info.name)
 
+    def test_run_workers(self):
+        self.s.scan()
+        expected = [(path, file_info.hash) for path, file_info in self.found_files.items()]
+
+        self.found_files = {}
+        self.s.props['WORKERS'] = '4'
+        self.s.props['MAX_IN_FLIGHT'] = '2'
+        self.s.scan()
+        self.assertEqual(expected, [(path, file_info.hash) for path, file_info in self.found_files.items()])
+
+
+class StubPersist:
+    def __init__(self):
+        self.resources = {}
+        self.directories = {}
+
+    def lookup_resource(self, location):
+        return self.resources.get(location)
+
+    def get_directory(self, location):
+        return self.directories.get(location)
+
+    def get_locations_under(self, location):
+        return sorted(path for path in self.resources if path.startswith(location))
+
+    def flush(self):
+        pass
+
+    def set_directory(self, location, mtime_ns, entry_count, digest):
+        self.directories[location] = {
+            'location': location,
+            'mtime_ns': mtime_ns,
+            'entry_count': entry_count,
+            'digest': digest,
+        }
+
+
+class TestDirectoryScannerFast(unittest.TestCase):
+    def on_file(self, scanner: Scanner, file_info: FileInfo):
+        self.found_files[file_info.path] = file_info
+
+    def setUp(self):
+        self.scan_path = os.path.join(os.getcwd(), 'data')
+        self.found_files: dict[str, FileInfo] = {}
+        self.s = DirectoryScanner('directory_scanner', True)
+        self.s.props['PATH'] = self.scan_path
+        self.s.props['FAST'] = 'True'
+        self.s.persist = StubPersist()
+        sl = ScannerListener()
+        sl.on_file = self.on_file
+        self.s.listeners.append(sl)
+        self.boy_path = os.path.normpath(os.path.join(os.getcwd(), 'data', 'images', 'input', 'boy.jpg'))
+        stat = os.stat(self.boy_path)
+        self.s.persist.resources[self.boy_path] = {
+            'hashval': 'stored hash',
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+        }
+
+    def test_unchanged_stat_skips_hash(self):
+        self.s.scan()
+        self.assertEqual(12, len(self.found_files))
+        file_info = self.found_files[self.boy_path]
+        self.assertEqual('stored hash', file_info.hash)
+        self.assertEqual(os.stat(self.boy_path).st_size, file_info.size)
+
+    def test_changed_stat_hashes(self):
+        self.s.persist.resources[self.boy_path]['mtime_ns'] -= 1
+        self.s.scan()
+        self.assertEqual('2b87de0a02694a0448471066fe0bff79b1ab555da4d16c36560e14b18d22e42a',
+                         self.found_files[self.boy_path].hash)
+
+    def test_rescan_hashes(self):
+        self.s.persist.resources[self.boy_path]['hashval'] = 'rescan'
+        self.s.scan()
+        self.assertEqual('2b87de0a02694a0448471066fe0bff79b1ab555da4d16c36560e14b18d22e42a',
+                         self.found_files[self.boy_path].hash)
+
+    def test_deep_verify_hashes(self):
+        self.s.props['DEEP_VERIFY'] = 'True'
+        self.s.scan()
+        self.assertEqual('2b87de0a02694a0448471066fe0bff79b1ab555da4d16c36560e14b18d22e42a',
+                         self.found_files[self.boy_path].hash)
+
+
+class TestDirectoryScannerIncremental(unittest.TestCase):
+    def on_file(self, scanner: Scanner, file_info: FileInfo):
+        self.found_files[file_info.path] = file_info
+
+    def setUp(self):
+        self.scan_path = tempfile.mkdtemp()
+        shutil.copytree(os.path.join(os.getcwd(), 'data', 'images'), os.path.join(self.scan_path, 'images'))
+        self.found_files: dict[str, FileInfo] = {}
+        self.s = DirectoryScanner('directory_scanner', True)
+        self.s.props['PATH'] = self.scan_path
+        self.s.props['INCREMENTAL'] = 'True'
+        self.s.persist = StubPersist()
+        sl = ScannerListener()
+        sl.on_file = self.on_file
+        self.s.listeners.append(sl)
+
+    def tearDown(self):
+        shutil.rmtree(self.scan_path)
+
+    def test_unchanged_directories_skipped(self):
+        self.s.scan()
+        self.assertEqual(12, len(self.found_files))
+        self.assertIn(os.path.join(self.scan_path, 'images', 'input', ''), self.s.persist.directories)
+
+        self.found_files = {}
+        self.s.scan()
+        self.assertEqual(0, len(self.found_files))
+
+    def test_changed_directory_rescanned(self):
+        self.s.scan()
+        self.found_files = {}
+        faces_path = os.path.join(self.scan_path, 'images', 'faces')
+        shutil.copy(os.path.join(faces_path, 'boy.jpg'), os.path.join(faces_path, 'boy_copy.jpg'))
+        self.s.props['WORKERS'] = '2'
+        self.s.scan()
+        self.assertEqual(4, len(self.found_files))
+        self.assertIn(os.path.join(faces_path, 'boy_copy.jpg'), self.found_files)
+
+    def test_deep_verify_ignores_snapshots(self):
+        self.s.scan()
+        self.found_files = {}
+        self.s.props['DEEP_VERIFY'] = 'True'
+        self.s.scan()
+        self.assertEqual(12, len(self.found_files))
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is only available on Linux')
+class TestDirectoryScannerWatch(unittest.TestCase):
+    def on_file(self, scanner: Scanner, file_info: FileInfo):
+        self.found_files[file_info.path] = file_info
+
+    def on_delete(self, scanner: Scanner, path: str):
+        self.deleted_files.append(path)
+
+    def setUp(self):
+        self.scan_path = tempfile.mkdtemp()
+        self.found_files: dict[str, FileInfo] = {}
+        self.deleted_files = []
+        self.s = DirectoryScanner('directory_scanner', True)
+        self.s.props['PATH'] = self.scan_path
+        self.s.props['WATCH'] = 'True'
+        self.s.props['WATCH_SETTLE'] = '0.2'
+        self.s.persist = StubPersist()
+        sl = ScannerListener()
+        sl.on_file = self.on_file
+        sl.on_delete = self.on_delete
+        self.s.listeners.append(sl)
+        self.stop = threading.Event()
+        self.watcher = threading.Thread(target=self.s.watch, args=(self.stop,))
+        self.watcher.start()
+        time.sleep(0.2)
+
+    def tearDown(self):
+        self.stop.set()
+        self.watcher.join()
+        shutil.rmtree(self.scan_path)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 10
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def test_watch(self):
+        input_path = os.path.join(os.getcwd(), 'data', 'images', 'input')
+        new_file_path = os.path.join(self.scan_path, 'boy.jpg')
+        shutil.copy(os.path.join(input_path, 'boy.jpg'), new_file_path)
+        os.makedirs(os.path.join(self.scan_path, 'album'))
+        shutil.copy(os.path.join(input_path, 'girl.jpg'), os.path.join(self.scan_path, 'album', 'girl.jpg'))
+        self.assertTrue(self.wait_for(lambda: len(self.found_files) == 2))
+        self.assertEqual('2b87de0a02694a0448471066fe0bff79b1ab555da4d16c36560e14b18d22e42a',
+                         self.found_files[new_file_path].hash)
+
+        os.remove(new_file_path)
+        self.assertTrue(self.wait_for(lambda: self.deleted_files == [new_file_path]))
+
+    def test_watch_directory_moved_out(self):
+        album_path = os.path.join(self.scan_path, 'album')
+        os.makedirs(os.path.join(album_path, 'sub'))
+        time.sleep(0.2)
+        girl_path = os.path.join(album_path, 'sub', 'girl.jpg')
+        shutil.copy(os.path.join(os.getcwd(), 'data', 'images', 'input', 'girl.jpg'), girl_path)
+        self.assertTrue(self.wait_for(lambda: girl_path in self.found_files))
+        self.s.persist.resources[girl_path] = {'hashval': self.found_files[girl_path].hash}
 
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        shutil.move(album_path, os.path.join(outside, 'album'))
+        self.assertTrue(self.wait_for(lambda: self.deleted_files == [girl_path]))
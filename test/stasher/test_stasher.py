@@ -1,3 +1,4 @@
+import asyncio
 import os
 import unittest
 
@@ -15,6 +16,12 @@ class TestStasher(unittest.TestCase):
     def test_stash_not_implemented(self):
         self.assertRaises(NotImplementedError, self.s.stash, None, 'path_ex', {}, 'ext_id_ex')
 
+    def test_find_ext_id(self):
+        self.assertIsNone(self.s.find_ext_id('path_ex'))
+
+    def test_astash_not_implemented(self):
+        self.assertRaises(NotImplementedError, asyncio.run, self.s.astash(None, 'path_ex', {}, 'ext_id_ex'))
+
 
 class TestStasherManager(unittest.TestCase):
     def setUp(self):
@@ -38,6 +45,24 @@ class TestStasherManager(unittest.TestCase):
             'ext_id_ex'
         )
 
+    def test_astash(self):
+        stashed = []
+        self.s.stash = lambda engine, path, tags, ext_id: stashed.append((self.s.name, path, tags, ext_id))
+        s3 = Stasher('test_stasher_3', True)
+
+        async def astash(engine, path, tags, ext_id):
+            stashed.append((s3.name, path, tags, ext_id))
+        s3.astash = astash
+        self.sm.add(s3)
+        self.sm.add(Stasher('test_stasher_4', False))
+        asyncio.run(self.sm.astash(None, 'path_ex', {'tst_a': {'confidence': 90}}, 'ext_id_ex'))
+        self.assertEqual([('test_stasher_2', 'path_ex', {'tst_a': {'confidence': 90}}, 'ext_id_ex'),
+                          ('test_stasher_3', 'path_ex', {'tst_a': {'confidence': 90}}, 'ext_id_ex')],
+                         sorted(stashed))
+
+        del self.s.stash
+        self.assertRaises(NotImplementedError, asyncio.run, self.sm.astash(None, 'path_ex', {}, 'ext_id_ex'))
+
 
 class TestEnvironmentStasherManagerBuilder(unittest.TestCase):
     def setUp(self):
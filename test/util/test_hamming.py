@@ -0,0 +1,43 @@
+import random
+import unittest
+
+from tigertag.util.hamming import HammingIndex
+
+
+class TestHammingIndex(unittest.TestCase):
+    def setUp(self):
+        random.seed(8)
+        self.hashes = [random.getrandbits(64) for _ in range(2000)]
+        self.index = HammingIndex(6)
+        for value, h in enumerate(self.hashes):
+            self.index.add(value, h)
+
+    def _linear(self, hash_value, distance):
+        return sorted((d, value) for value, d in enumerate((h ^ hash_value).bit_count() for h in self.hashes)
+                      if d <= distance)
+
+    def test_find(self):
+        for value in range(0, 2000, 100):
+            query = self.hashes[value]
+            for bit in random.sample(range(64), 5):
+                query ^= 1 << bit
+            for distance in (0, 3, 5, 6):
+                self.assertEqual(self._linear(query, distance), sorted(self.index.find(query, distance)))
+            self.assertEqual((5, value), self.index.find(query)[0])
+
+    def test_add_replaces(self):
+        self.index.add(7, self.hashes[7] ^ 0xffffffff)
+        self.assertEqual([(0, 7)], self.index.find(self.hashes[7] ^ 0xffffffff, 0))
+        self.assertNotIn((0, 7), self.index.find(self.hashes[7], 0))
+        self.assertEqual(2000, len(self.index))
+
+    def test_discard(self):
+        self.index.discard(3)
+        self.assertEqual([], self.index.find(self.hashes[3], 0))
+        self.assertNotIn(3, self.index)
+
+    def test_distance_limits(self):
+        with self.assertRaises(ValueError):
+            self.index.find(self.hashes[0], 7)
+        with self.assertRaises(ValueError):
+            HammingIndex(64)
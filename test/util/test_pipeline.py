@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from tigertag.util.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = Pipeline()
+        self.results = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.pipeline.stop()
+
+    def collect(self, item):
+        with self.lock:
+            self.results.append(item)
+
+    def test_stages(self):
+        self.pipeline.add('double', lambda item: self.pipeline.put('collect', item * 2), workers=3)
+        self.pipeline.add('collect', self.collect)
+        self.pipeline.start()
+        for item in range(100):
+            self.pipeline.feed('double', item)
+        self.pipeline.join()
+        self.assertEqual([item * 2 for item in range(100)], sorted(self.results))
+        metrics = {m.name: m for m in self.pipeline.metrics()}
+        self.assertEqual(100, metrics['double'].processed)
+        self.assertEqual(3, metrics['double'].workers)
+        self.assertEqual(0, metrics['collect'].depth)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        self.pipeline.add('slow', lambda item: release.wait(), queue_size=2)
+        self.pipeline.start()
+        fed = []
+        feeder = threading.Thread(target=lambda: [fed.append(self.pipeline.feed('slow', item)) for item in range(5)])
+        feeder.start()
+        time.sleep(0.2)
+        self.assertEqual(3, len(fed))  # one being handled and two queued, the fourth waits for room
+        self.assertEqual(2, self.pipeline.metrics()[0].max_depth)
+        release.set()
+        feeder.join()
+        self.pipeline.join()
+        self.assertEqual(5, self.pipeline.metrics()[0].processed)
+        self.assertGreater(self.pipeline.metrics()[0].waited, 0)
+
+    def test_unbounded(self):
+        # A stage sending results back to a full earlier stage does not wait for room
+        self.pipeline.add('first', lambda item: self.collect(item) if item < 0 else self.pipeline.put('second', item),
+                          queue_size=1)
+        self.pipeline.add('second', lambda item: self.pipeline.put('first', -item, bounded=False), queue_size=1)
+        self.pipeline.start()
+        for item in range(1, 20):
+            self.pipeline.feed('first', item)
+        self.pipeline.join()
+        self.assertEqual(list(range(-19, 0)), sorted(self.results))
+
+    def test_setup(self):
+        calls = []
+        self.pipeline.add('work', self.collect, workers=2, setup=lambda: calls.append('setup'),
+                          teardown=lambda: calls.append('teardown'))
+        self.pipeline.start()
+        self.pipeline.stop()
+        self.assertEqual(['setup', 'setup', 'teardown', 'teardown'], sorted(calls))
+
+    def test_coroutine_stage(self):
+        active = [0]
+        most_active = [0]
+        calls = []
+
+        async def handle(item):
+            active[0] += 1
+            most_active[0] = max(most_active[0], active[0])
+            await asyncio.sleep(0.05)
+            active[0] -= 1
+            if item == 3:
+                raise ValueError('bad item')
+            self.collect((item, threading.current_thread().name))
+
+        async def teardown():
+            calls.append('teardown')
+
+        self.pipeline.add('work', handle, workers=10, queue_size=0, setup=lambda: calls.append('setup'),
+                          teardown=teardown)
+        for item in range(20):
+            self.pipeline.feed('work', item)
+        self.pipeline.start()
+        with self.assertRaises(ValueError):
+            self.pipeline.join()
+        self.pipeline.stop()
+        self.assertEqual([item for item in range(20) if item != 3], sorted(item for item, name in self.results))
+        self.assertEqual({'work'}, {name for item, name in self.results})  # one thread
+        self.assertEqual(10, most_active[0])
+        self.assertEqual(['setup', 'teardown'], calls)
+        metrics = self.pipeline.metrics()[0]
+        self.assertEqual((20, 1), (metrics.processed, metrics.errors))
+
+    def test_error(self):
+        def fail(item):
+            if item == 3:
+                raise ValueError('bad item')
+            self.collect(item)
+
+        self.pipeline.add('work', fail)
+        self.pipeline.start()
+        for item in range(5):
+            self.pipeline.feed('work', item)
+        with self.assertRaises(ValueError):
+            self.pipeline.join()
+        with self.assertRaises(ValueError):
+            self.pipeline.feed('work', 5)
+        self.assertEqual([0, 1, 2, 4], sorted(self.results))
+        self.assertEqual(1, self.pipeline.metrics()[0].errors)
+        with self.assertRaises(ValueError):
+            self.pipeline.add('work', fail)
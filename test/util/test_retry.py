@@ -0,0 +1,50 @@
+import asyncio
+import unittest
+
+from tigertag.util.retry import awith_tries
+from tigertag.util.retry import with_tries
+
+
+class TestRetry(unittest.TestCase):
+    def setUp(self):
+        self.tries = []
+
+    def attempt(self, failures, error=KeyError):
+        def attempt():
+            self.tries.append(len(self.tries) + 1)
+            if len(self.tries) <= failures:
+                raise error('no result')
+            return 'result'
+        return attempt
+
+    def test_with_tries(self):
+        self.assertEqual('result', with_tries(self.attempt(2), 3, 'tag a.jpg', KeyError))
+        self.assertEqual([1, 2, 3], self.tries)
+
+        self.tries.clear()
+        with self.assertRaises(KeyError):
+            with_tries(self.attempt(3), 3, 'tag a.jpg', KeyError)
+        self.assertEqual([1, 2, 3], self.tries)
+
+        # Other errors are not tried again
+        self.tries.clear()
+        with self.assertRaises(ValueError):
+            with_tries(self.attempt(1, ValueError), 3, 'tag a.jpg', KeyError)
+        self.assertEqual([1], self.tries)
+
+    def test_awith_tries(self):
+        def aattempt(failures):
+            attempt = self.attempt(failures)
+
+            async def aattempt():
+                await asyncio.sleep(0)
+                return attempt()
+            return aattempt
+
+        self.assertEqual('result', asyncio.run(awith_tries(aattempt(2), 3, 'tag a.jpg', KeyError)))
+        self.assertEqual([1, 2, 3], self.tries)
+
+        self.tries.clear()
+        with self.assertRaises(KeyError):
+            asyncio.run(awith_tries(aattempt(3), 3, 'tag a.jpg', (KeyError, ValueError)))
+        self.assertEqual([1, 2, 3], self.tries)
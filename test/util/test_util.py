@@ -4,6 +4,9 @@ import unittest
 
 from tigertag.util import str2bool
 from tigertag.util import calc_hash
+from tigertag.util import dhash
+from tigertag.util import ImageData
+from tigertag.util import scale_image
 
 
 class TestStr2Bool(unittest.TestCase):
@@ -45,3 +48,71 @@ class TestStr2Bool(unittest.TestCase):
 
     def tearDown(self):
         os.remove(self.file_path)
+
+
+class TestImageData(unittest.TestCase):
+    def setUp(self):
+        self.file_path = os.path.normpath(os.path.join(os.getcwd(), 'data', 'images', 'input', 'boy.jpg'))
+
+    def test_read_once(self):
+        with ImageData(self.file_path) as image_data:
+            self.assertEqual('jpeg', image_data.what())
+            self.assertEqual(calc_hash(self.file_path), image_data.hash())
+            self.assertEqual(os.stat(self.file_path).st_size, image_data.size)
+            self.assertEqual('JPEG', image_data.image().format)
+
+    def test_mmap(self):
+        with ImageData(self.file_path, mmap_threshold=1) as image_data:
+            self.assertEqual('jpeg', image_data.what())
+            self.assertEqual(calc_hash(self.file_path), image_data.hash())
+
+    def test_not_an_image(self):
+        path = self._write(b'%PDF-1.7' + b'x' * 1000)
+        with ImageData(path) as data:
+            self.assertIsNone(data.what())
+            self.assertIsNone(data.buffer)  # only the header was read
+            self.assertEqual(1008, data.size)
+            self.assertEqual(calc_hash(path), data.hash())
+
+    def test_keep(self):
+        with ImageData(self.file_path, mmap_threshold=1) as image_data:
+            image_data.keep()
+        self.assertEqual('jpeg', image_data.what())  # still open for the one that kept it
+        image_data.close()
+        self.assertIsNone(image_data.buffer)
+
+    def test_scale_image(self):
+        with ImageData(self.file_path) as image_data:
+            width, height = image_data.image().size
+            scaled = scale_image(image_data, 100)
+            original = scale_image(image_data, max(width, height))
+        with ImageData(self._write(scaled)) as scaled_data:
+            self.assertEqual(100, min(scaled_data.image().size))
+        self.assertEqual(os.stat(self.file_path).st_size, len(original))
+
+    def test_dhash(self):
+        with ImageData(self.file_path) as image_data:
+            phash = image_data.dhash()
+            image = image_data.image()
+            smaller = image.resize((image.width // 2, image.height // 2))
+        self.assertEqual(16, len(phash))
+        distance = (int(phash, 16) ^ int(dhash(smaller), 16)).bit_count()
+        self.assertLessEqual(distance, 4)
+        with ImageData(os.path.join(os.path.dirname(self.file_path), 'girl.jpg')) as other_data:
+            self.assertGreater((int(phash, 16) ^ int(other_data.dhash(), 16)).bit_count(), 10)
+
+    def test_release_image(self):
+        with ImageData(self.file_path) as image_data:
+            phash = image_data.dhash()
+            image = image_data.image()
+            image_data.release_image()
+            self.assertIsNone(image_data._image)
+            self.assertEqual(phash, image_data.dhash())  # kept
+            self.assertIsNot(image, image_data.image())  # decoded again when asked for
+
+    def _write(self, data):
+        file, path = tempfile.mkstemp(suffix='.jpg')
+        with os.fdopen(file, 'wb') as f:
+            f.write(data)
+        self.addCleanup(os.remove, path)
+        return path
@@ -1,24 +1,131 @@
+import contextlib
 import datetime
+import functools
 import logging
 import os
+import random
+import threading
+import time
+from collections import namedtuple
 
-from sqlalchemy import create_engine, select
+from sqlalchemy import and_, bindparam, create_engine, delete, event, func, or_, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from tigertag import Pluggable
+from tigertag.db.index import ResourceIndex
 from tigertag.db.models import *
+from tigertag.util import str2bool
 
 logger = logging.getLogger(__name__)
 
+RESCAN = 'rescan'  # hashval marker for a resource that needs to be tagged again
+ID_CHUNK_SIZE = 500  # ids per IN (...), well below the 999 parameters older SQLite builds allow
+
+# What the read methods return, built straight from Core rows instead of ORM objects
+ResourceRecord = namedtuple('ResourceRecord', 'id name location hashval last_indexed description size mtime_ns '
+                                              'inode phash')
+TagRecord = namedtuple('TagRecord', 'resource_id tag_id name engine confidence')
+RawTagsRecord = namedtuple('RawTagsRecord', 'resource_id location engine raw_tags')
+
+_RESOURCE_COLUMNS = (
+    Resource.id,
+    Resource.name,
+    (Directory.location + Resource.basename).label('location'),
+    Resource.hashval,
+    Resource.last_indexed,
+    Resource.description,
+    Resource.size,
+    Resource.mtime_ns,
+    Resource.inode,
+    Resource.phash,
+)
+
+# Applied to every SQLite connection.  With WAL, readers no longer wait for the writer, and a commit
+# appends to the log instead of rewriting pages.  synchronous=NORMAL only syncs at checkpoints, so a power
+# cut can lose the last commits but never corrupts the file.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # in KiB when negative
+    'temp_store': 'MEMORY',
+}
+
+
+def _select_resources():
+    return select(*_RESOURCE_COLUMNS).join(Resource.directory)
+
+
+def _select_tags():
+    return select(ResourceTag.resource_id, Tag.id, Tag.name, Tag.engine, ResourceTag.confidence) \
+        .join(Tag, Tag.id == ResourceTag.tag_id)
+
+
+def _id_chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        yield ids[start:start + ID_CHUNK_SIZE]
+
+
+def _is_retryable(error):
+    # Errors after which the whole transaction was rolled back and can simply be run again: a serialization
+    # failure or a deadlock in PostgreSQL, a database still locked after the busy timeout in SQLite, or a
+    # connection that was lost
+    if not isinstance(error, DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    if getattr(error.orig, 'pgcode', None) in ('40001', '40P01'):
+        return True
+    return isinstance(error, OperationalError) and 'database is locked' in str(error.orig)
+
 
 class DbEngine(Pluggable):
-    RESERVED_PROPS = ['DB_URL']
+    RESERVED_PROPS = ['DB_URL', 'DB_SQLITE_PROFILE', 'DB_POOL_SIZE', 'DB_MAX_OVERFLOW']
 
-    def __init__(self, db_url):
+    def __init__(self, db_url, sqlite_pragmas=SQLITE_PRAGMAS, pool_size=5, max_overflow=10):
         self.db_url = db_url
-        self.engine = create_engine(db_url)
+        url = make_url(db_url)
+        kwargs = {}
+        if url.get_backend_name() == 'sqlite':
+            # A batch transaction may be committed by its flush timer, on another thread than the one it was
+            # begun on
+            kwargs['connect_args'] = {'check_same_thread': False}
+            if sqlite_pragmas and url.database not in (None, '', ':memory:'):
+                # Keep the connections open, and with them their pragmas and page cache, instead of opening
+                # the file again for every session
+                kwargs['poolclass'] = QueuePool
+        elif url.get_backend_name() == 'postgresql':
+            # One connection per scanner thread and one for the batch.  Connections are checked before use
+            # and replaced every half hour, so a restarted server or a firewall dropping idle connections
+            # costs a reconnect instead of a failed write.  LIFO lets the extra connections sit idle and
+            # time out after a burst.
+            kwargs.update(
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_pre_ping=True,
+                pool_recycle=1800,
+                pool_use_lifo=True
+            )
+        self.engine = create_engine(db_url, **kwargs)
+        if url.get_backend_name() == 'sqlite' and sqlite_pragmas:
+            event.listen(self.engine, 'connect', DbEngine._pragmas_listener(sqlite_pragmas))
         self.Session = sessionmaker(self.engine)
 
+    @staticmethod
+    def _pragmas_listener(pragmas):
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+            cursor.close()
+        return on_connect
+
     def connect(self, **kwargs):
         return self.engine.connect(**kwargs)
 
@@ -44,13 +151,198 @@ class EnvironmentDbEngineBuilder(DbEngineBuilder):
     def build(self):
         if 'DB_URL' in os.environ:
             db_url = os.environ.get('DB_URL')
-            return DbEngine(db_url)
+            kwargs = {
+                'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+                'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            }
+            if str2bool(os.environ.get('DB_SQLITE_PROFILE', 'True')):
+                return DbEngine(db_url, **kwargs)
+            return DbEngine(db_url, sqlite_pragmas=None, **kwargs)
         raise ValueError("DB_URL environment variable missing.")
 
 
+class _Batch:
+    # The writes of one thread, kept in a single transaction until Persist.flush
+    def __init__(self, session, size, delay):
+        self.session = session
+        self.size = size
+        self.delay = delay
+        self.thread = threading.get_ident()
+        self.writes = []  # (method, args, kwargs) of every write in the open transaction
+        self.started = None
+        self.timer = None  # commits the transaction once it is delay seconds old, if no write did before
+        self.lock = threading.RLock()  # taken by whoever uses the session, the thread or the timer
+        self.index_undo = {}  # location -> its ResourceIndex entry before the open transaction, or None
+        self.recovering = None  # the thread making the writes of a failed transaction again
+
+
+def _batched(method):
+    # While the calling thread has a batch open, the write goes into the batch transaction, which is
+    # committed once it holds batch.size writes or is batch.delay seconds old.  Otherwise it is a
+    # transaction of its own, run again when it fails in a way that is worth retrying.
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        batch = self._current_batch()
+        if batch is None:
+            return self._retry(method, args, kwargs)
+        with batch.lock:
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception as e:
+                self._recover(batch)
+                if not _is_retryable(e):
+                    raise
+                # The batch transaction is gone, so the write is run again in one of its own
+                return self._retry_alone(batch, method, args, kwargs)
+            batch.writes.append((method, args, kwargs))
+            if batch.started is None:
+                batch.started = time.monotonic()
+                batch.timer = threading.Timer(batch.delay, self._flush_due, (batch,))
+                batch.timer.daemon = True
+                batch.timer.start()
+            if len(batch.writes) >= batch.size or time.monotonic() - batch.started >= batch.delay:
+                self._flush(batch)
+        return result
+    return wrapper
+
+
 class Persist:
-    def __init__(self, dbengine):
+    def __init__(self, dbengine, retries=5, retry_delay=0.05):
         self.engine = dbengine
+        self.retries = retries
+        self.retry_delay = retry_delay  # doubled after every attempt
+        self.index = None  # ResourceIndex, once preload has been called
+        self._batch = None
+        self._tag_ids = None  # (name, engine) -> id of every committed tag, loaded on first use
+
+    def _current_batch(self):
+        batch = self._batch
+        thread = threading.get_ident()
+        if batch is not None and batch.thread == thread and batch.recovering != thread:
+            return batch
+        return None
+
+    @contextlib.contextmanager
+    def _session(self):
+        # The batch transaction of the calling thread, so it reads its own queued writes, or else a
+        # transaction of its own
+        batch = self._current_batch()
+        if batch is None:
+            with self.engine.session() as session, session.begin():
+                yield session
+            self._commit_tag_ids(session)
+        else:
+            with batch.lock:
+                yield batch.session
+
+    def _commit_tag_ids(self, session):
+        # The tags inserted by a transaction only go into the shared cache once it has been committed
+        tag_ids = session.info.pop('tag_ids', None)
+        if tag_ids and self._tag_ids is not None:
+            self._tag_ids.update(tag_ids)
+
+    def begin_batch(self, size=500, delay=1.0):
+        # Only writes made by the calling thread are batched.  Other threads keep writing straight through.
+        if self._batch is not None:
+            raise ValueError('A batch has already been started.')
+        self._batch = _Batch(self.engine.session(), size, delay)
+
+    def flush(self):
+        batch = self._current_batch()
+        if batch is not None:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        with batch.lock:
+            if len(batch.writes) == 0:
+                return
+            try:
+                batch.session.commit()
+            except Exception as e:
+                # The writes are then made again one transaction each, so there is nothing left to fail when
+                # they all are
+                if self._recover(batch) > 0 or not _is_retryable(e):
+                    raise
+                return
+            self._commit_tag_ids(batch.session)
+            logger.debug('Committed {} writes'.format(len(batch.writes)))
+            self._reset(batch)
+
+    def _flush_due(self, batch):
+        # Runs on the timer thread, for writes that no other write followed within the delay
+        with batch.lock:
+            if self._batch is not batch:
+                return
+            try:
+                self._flush(batch)
+            except Exception:
+                logger.exception('Failed to commit the batch')
+
+    @staticmethod
+    def _reset(batch):
+        batch.writes = []
+        batch.started = None
+        batch.index_undo = {}
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+
+    def end_batch(self):
+        batch = self._current_batch()
+        if batch is None:
+            return
+        try:
+            self.flush()
+        finally:
+            with batch.lock:
+                self._reset(batch)
+                batch.session.close()
+                self._batch = None
+
+    def _retry(self, method, args, kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except DBAPIError as e:
+                attempt += 1
+                if attempt > self.retries or not _is_retryable(e):
+                    raise
+                delay = self.retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                logger.warning('Retrying {} in {:.2f}s after: {}'.format(method.__name__, delay, e.orig))
+                time.sleep(delay)
+
+    def _retry_alone(self, batch, method, args, kwargs):
+        # Runs the write in a transaction of its own, outside the batch of the calling thread
+        recovering = batch.recovering
+        batch.recovering = threading.get_ident()
+        try:
+            return self._retry(method, args, kwargs)
+        finally:
+            batch.recovering = recovering
+
+    def _recover(self, batch):
+        # Rolls the failed batch back and makes the writes queued before the failure again, one transaction
+        # each.  A write failing again is logged and skipped, so the caller still raises the first error.
+        # Returns how many failed again.
+        batch.session.rollback()
+        batch.session.info.pop('tag_ids', None)
+        if self.index is not None:
+            for location, entry in batch.index_undo.items():
+                if entry is None:
+                    self.index.discard(location)
+                else:
+                    self.index.put(entry)
+        writes = batch.writes
+        self._reset(batch)
+        failed = 0
+        for method, args, kwargs in writes:
+            try:
+                self._retry_alone(batch, method, args, kwargs)
+            except Exception:
+                failed += 1
+                logger.exception('Failed to write again {}{!r}'.format(method.__name__, args))
+        return failed
 
     @staticmethod
     def _row_to_dict(row):
@@ -63,6 +355,20 @@ class Persist:
             #     d[column.name] = str(getattr(row, column.name))
         return d
 
+    @staticmethod
+    def _resource_to_dict(resource):
+        # The same keys as ResourceRecord, whether the resource comes from an ORM object or a Core row
+        return {field: getattr(resource, field) for field in ResourceRecord._fields}
+
+    @staticmethod
+    def _select_resource(location):
+        # Resources are stored as a directory row plus a basename
+        directory_location, basename = split_location(location)
+        return select(Resource) \
+            .join(Resource.directory) \
+            .options(contains_eager(Resource.directory)) \
+            .where(Directory.location == directory_location, Resource.basename == basename)
+
     # @staticmethod
     # def _rows_to_dict(rows):
     #     results = []
@@ -71,108 +377,522 @@ class Persist:
     #     return results
 
     @staticmethod
-    def _clear_resource_engine_tags(session, resource, engine):
-        res_tags = session.query(ResourceTag).filter(
-            ResourceTag.resource_id == resource.id,
-            Tag.engine == engine,
-            ResourceTag.tag_id == Tag.id
+    def _get_resource_engine_tags(session, resource, engine):
+        # tag id -> confidence of the tags engine set on resource
+        rows = session.execute(
+            select(ResourceTag.tag_id, ResourceTag.confidence)
+            .join(Tag, ResourceTag.tag_id == Tag.id)
+            .where(ResourceTag.resource_id == resource.id, Tag.engine == engine)
         )
-        for res_tag in res_tags:
-            session.delete(res_tag)
+        return {row.tag_id: row.confidence for row in rows}
 
-    @staticmethod
-    def _handle_tags(session, resource, engine, tags):
+    def _get_tag_ids(self, session, engine, names):
+        # name -> tag id for the tags of engine.  The missing tags are inserted together, so this costs the
+        # same few statements however many tags there are.
+        if self._tag_ids is None:
+            self._tag_ids = {(row.name, row.engine): row.id
+                             for row in session.execute(select(Tag.id, Tag.name, Tag.engine))}
+        pending = session.info.setdefault('tag_ids', {})  # inserted by the open transaction
+        result = {}
+        missing = []
+        for name in names:
+            tag_id = self._tag_ids.get((name, engine))
+            if tag_id is None:
+                tag_id = pending.get((name, engine))
+            if tag_id is None:
+                missing.append(name)
+            else:
+                result[name] = tag_id
+        if len(missing) > 0:
+            session.execute(insert_ignore(session, Tag.__table__, ['name', 'engine']), [
+                {'name': name, 'engine': engine} for name in missing
+            ])
+            rows = session.execute(select(Tag.id, Tag.name).where(Tag.engine == engine, Tag.name.in_(missing)))
+            for row in rows:
+                pending[(row.name, engine)] = row.id
+                result[row.name] = row.id
+            for name in missing:
+                if name not in result:
+                    raise ValueError(f'The tag {name} already exists for another engine than {engine}')
+        return result
+
+    def _handle_tags(self, session, resource, engine, tags):
         if engine is not None:
             if tags is not None:
-                Persist._clear_resource_engine_tags(session, resource, engine)
-                # temp_resource_tags = []
-                for tag_name, tag_values in tags.items():
-                    existing_tag = session.execute(select(Tag).filter_by(name=tag_name, engine=engine)).one_or_none()
-                    if existing_tag is None:
-                        tag = Tag(
-                            name=tag_name,
-                            engine=engine,
+                # Only the differences are written, so tagging an image again with the same results
+                # writes nothing
+                session.flush()
+                tag_ids = self._get_tag_ids(session, engine, list(tags.keys()))
+                new = {tag_ids[tag_name]: tag_values['confidence'] for tag_name, tag_values in tags.items()}
+                old = Persist._get_resource_engine_tags(session, resource, engine)
+                removed = [tag_id for tag_id in old if tag_id not in new]
+                added = [tag_id for tag_id in new if tag_id not in old]
+                changed = [tag_id for tag_id in new if tag_id in old and old[tag_id] != new[tag_id]]
+                if len(removed) > 0:
+                    session.execute(delete(ResourceTag.__table__).where(
+                        ResourceTag.resource_id == resource.id,
+                        ResourceTag.tag_id.in_(removed)
+                    ))
+                if len(added) > 0:
+                    # An upsert, in case another writer tagged the same resource meanwhile
+                    statement = upsert(session, ResourceTag.__table__, ['resource_id', 'tag_id', 'confidence'],
+                                       ['resource_id', 'tag_id'], ['confidence'])
+                    session.execute(statement, [
+                        {'resource_id': resource.id, 'tag_id': tag_id, 'confidence': new[tag_id]}
+                        for tag_id in added
+                    ])
+                if len(changed) > 0:
+                    session.execute(
+                        update(ResourceTag.__table__)
+                        .where(
+                            ResourceTag.resource_id == bindparam('b_resource_id'),
+                            ResourceTag.tag_id == bindparam('b_tag_id')
                         )
-                    else:
-                        tag = existing_tag.Tag
-                    resource_tag = ResourceTag(
-                        resource=resource,
-                        tag=tag,
-                        confidence=tag_values['confidence'],
+                        .values(confidence=bindparam('b_confidence')),
+                        [
+                            {'b_resource_id': resource.id, 'b_tag_id': tag_id, 'b_confidence': new[tag_id]}
+                            for tag_id in changed
+                        ]
                     )
-                    session.add(tag)
-                    session.add(resource_tag)
-                #     temp_resource_tags.append(tag)
-                # resource.tags = temp_resource_tags
+                if len(removed) + len(added) + len(changed) > 0:
+                    # The writer holds the database lock until it commits, so with SQLite the versions grow
+                    # in commit order and a reader only needs the ones past the last it has seen
+                    session.execute(
+                        update(Resource.__table__)
+                        .where(Resource.id == resource.id)
+                        .values(tags_version=select(func.coalesce(func.max(Resource.tags_version), 0) + 1)
+                                .scalar_subquery())
+                    )
+                    session.expire(resource, ['tags', 'tags_version'])
             else:
                 raise ValueError('While trying to set a resource, the tags were None.')
         else:
             if tags is not None:
                 raise ValueError('While trying to set a resource, the engine was None.')
 
+    @staticmethod
+    def _handle_engine(session, resource, engine, fingerprint, raw_tags):
+        # Remember which content and which engine settings produced the tags that were just set, and
+        # everything the engine returned, so the tags can be worked out again for other thresholds
+        if fingerprint is None:
+            if raw_tags is not None:
+                raise ValueError('While trying to set a resource, the fingerprint was None.')
+            return
+        if engine is None:
+            raise ValueError('While trying to set a resource, the engine was None.')
+        session.flush()
+        values = {
+            'hashval': resource.hashval,
+            'fingerprint': fingerprint,
+            'last_tagged': datetime.datetime.now(),
+            'raw_tags': raw_tags,
+        }
+        resource_engine = session.get(ResourceEngine, (resource.id, engine))
+        if resource_engine is None:
+            statement = upsert(session, ResourceEngine.__table__, ['resource_id', 'engine'] + list(values.keys()),
+                               ['resource_id', 'engine'], list(values.keys()))
+            session.execute(statement, dict(values, resource_id=resource.id, engine=engine))
+        else:
+            for key, value in values.items():
+                setattr(resource_engine, key, value)
+
+    @_batched
     def set_resource(self, location, name=None, hashval=None, last_indexed=None, description=None, engine=None,
-                     tags=None):
-        with self.engine.session() as session, session.begin():
-            existing_resource = session.execute(select(Resource).filter_by(location=location)).one_or_none()
-            new_record = False
+                     tags=None, size=None, mtime_ns=None, inode=None, fingerprint=None, phash=None,
+                     raw_tags=None):
+        with self._session() as session:
+            existing_resource = session.execute(Persist._select_resource(location)).one_or_none()
             if existing_resource is None:
                 logger.debug('Adding new resource {}'.format(location))
-                resource = Resource()
-                new_record = True
+                # Inserted unless another writer just did, and then updated like any existing resource
+                directory_location, basename = split_location(location)
+                values = {
+                    'directory_id': get_or_insert_id(session, Directory.__table__, location=directory_location),
+                    'basename': basename,
+                    'name': name,
+                    'hashval': hashval,
+                    'last_indexed': last_indexed,
+                    'description': description,
+                    'size': size,
+                    'mtime_ns': mtime_ns,
+                    'inode': inode,
+                    'phash': phash,
+                }
+                session.execute(insert_ignore(session, Resource.__table__, values.keys()), values)
+                existing_resource = session.execute(Persist._select_resource(location)).one()
             else:
                 logger.debug('Updating existing resource {}'.format(location))
-                resource = existing_resource.Resource
+            resource = existing_resource.Resource
 
             if name is not None:
                 resource.name = name
-            if location is not None:
+            if location is not None and location != resource.location:
                 resource.location = location
             if hashval is not None:
+                if hashval != resource.hashval:
+                    resource.phash = None  # belongs to the old content
                 resource.hashval = hashval
             if last_indexed is not None:
                 resource.last_indexed = last_indexed
 
             if description is not None:
                 resource.description = description
-            if new_record:
-                session.add(resource)
-            Persist._handle_tags(session, resource, engine, tags)
+            if size is not None:
+                resource.size = size
+            if mtime_ns is not None:
+                resource.mtime_ns = mtime_ns
+            if inode is not None:
+                resource.inode = inode
+            if phash is not None:
+                resource.phash = phash
+            self._handle_tags(session, resource, engine, tags)
+            Persist._handle_engine(session, resource, engine, fingerprint, raw_tags)
+            session.flush()
 
-            return Persist._row_to_dict(resource)
+            result = Persist._resource_to_dict(resource)
+        self._index_put(result)
+        return result
 
+    @_batched
     def set_resource_rescan(self, location):
-        with self.engine.session() as session, session.begin():
-            existing_resource = session.execute(select(Resource).filter_by(location=location)).one_or_none()
+        with self._session() as session:
+            existing_resource = session.execute(Persist._select_resource(location)).one_or_none()
             if existing_resource is None:
                 raise ValueError(f'Existing resource not found: {location}')
             logger.debug('Set existing resource to rescan {}'.format(location))
             resource = existing_resource.Resource
-            resource.hashval = 'rescan'
+            resource.hashval = RESCAN
             resource.last_indexed = datetime.datetime.now()
-            return Persist._row_to_dict(resource)
+            result = Persist._resource_to_dict(resource)
+        self._index_put(result)
+        return result
+
+    def _index_put(self, resource, discard=None):
+        # Called once the write has been committed, or queued in the batch of the calling thread, which keeps
+        # the entries it replaces until then so a rollback can put them back
+        if self.index is None:
+            return
+        batch = self._current_batch()
+        if batch is not None:
+            for location in (discard, resource['location']):
+                if location is not None and location not in batch.index_undo:
+                    batch.index_undo[location] = self.index.get(location)
+        if discard is not None:
+            self.index.discard(discard)
+        self.index.put(resource)
+
+    def preload(self):
+        # Loads every resource into a ResourceIndex, so lookup_resource no longer needs a query
+        index = ResourceIndex()
+        with self._session() as session:
+            rows = session.execute(select(
+                Resource.id,
+                (Directory.location + Resource.basename).label('location'),
+                Resource.hashval,
+                Resource.size,
+                Resource.mtime_ns,
+                Resource.inode,
+                Resource.phash
+            ).join(Resource.directory).execution_options(yield_per=10000))
+            for row in rows:
+                index.put(row._mapping)
+        self.index = index
+        logger.debug('Preloaded {} resources'.format(len(index)))
+        return len(index)
+
+    def lookup_resource(self, location):
+        # The id, location, hashval, size, mtime_ns, inode and phash of a resource.  Comes from the
+        # preloaded index when there is one, which is kept up to date by the set and move methods.
+        if self.index is not None:
+            return self.index.get(location)
+        return self.get_resource_by_location(location)
 
     def get_resource_by_id(self, id):
-        with self.engine.session() as session, session.begin():
-            row = session.query(Resource).get(id)
-            return Persist._row_to_dict(row)
+        with self._session() as session:
+            row = session.execute(_select_resources().where(Resource.id == id)).one_or_none()
+            return None if row is None else Persist._resource_to_dict(row)
 
     def get_resource_by_location(self, location):
-        with self.engine.session() as session, session.begin():
-            row = session.query(Resource) \
-                .filter(Resource
-                .location == location) \
-                .one_or_none()
+        directory_location, basename = split_location(location)
+        with self._session() as session:
+            row = session.execute(_select_resources().where(
+                Directory.location == directory_location,
+                Resource.basename == basename
+            )).one_or_none()
             if row is None:
                 return None
             else:
-                return Persist._row_to_dict(row)
+                return Persist._resource_to_dict(row)
+
+    def get_locations_under(self, location):
+        # The locations of the resources in the directory location, which ends with a separator, and below it
+        with self._session() as session:
+            rows = session.execute(select((Directory.location + Resource.basename).label('location'))
+                                   .join(Resource.directory)
+                                   .where(Directory.location.startswith(location, autoescape=True))
+                                   .order_by(Directory.location, Resource.basename))
+            return [row.location for row in rows]
+
+    def get_resources_by_hash(self, hashval):
+        with self._session() as session:
+            rows = session.execute(_select_resources()
+                                   .where(Resource.hashval == hashval)
+                                   .order_by(Resource.id))
+            return [Persist._resource_to_dict(row) for row in rows]
+
+    def get_resource_records(self, ids):
+        # id -> ResourceRecord of the ids that exist, with one query per ID_CHUNK_SIZE ids
+        result = {}
+        with self._session() as session:
+            for chunk in _id_chunks(ids):
+                for row in session.execute(_select_resources().where(Resource.id.in_(chunk))):
+                    result[row.id] = ResourceRecord(*row)
+        return result
+
+    def iter_resource_records(self, chunk_size=10000):
+        # Every resource in id order, fetched chunk_size rows at a time
+        with self._session() as session:
+            rows = session.execute(_select_resources()
+                                   .order_by(Resource.id)
+                                   .execution_options(yield_per=chunk_size))
+            for row in rows:
+                yield ResourceRecord(*row)
+
+    def get_tag_records(self, resource_ids, engine=None):
+        # resource id -> [TagRecord], with one JOIN per ID_CHUNK_SIZE ids.  Resources without tags are left out.
+        result = {}
+        with self._session() as session:
+            for chunk in _id_chunks(resource_ids):
+                query = _select_tags().where(ResourceTag.resource_id.in_(chunk))
+                if engine is not None:
+                    query = query.where(Tag.engine == engine)
+                for row in session.execute(query.order_by(ResourceTag.resource_id, Tag.id)):
+                    result.setdefault(row.resource_id, []).append(TagRecord(*row))
+        return result
+
+    def iter_tag_records(self, engine=None, chunk_size=10000):
+        # Every TagRecord ordered by resource id, fetched chunk_size rows at a time
+        query = _select_tags()
+        if engine is not None:
+            query = query.where(Tag.engine == engine)
+        with self._session() as session:
+            rows = session.execute(query
+                                   .order_by(ResourceTag.resource_id, Tag.id)
+                                   .execution_options(yield_per=chunk_size))
+            for row in rows:
+                yield TagRecord(*row)
+
+    def get_raw_tags(self, resource_id, engine):
+        # Everything engine returned for the resource, or None when it was not kept
+        with self._session() as session:
+            return session.execute(select(ResourceEngine.raw_tags).where(
+                ResourceEngine.resource_id == resource_id,
+                ResourceEngine.engine == engine
+            )).scalar()
+
+    def iter_raw_tags(self, engine=None, chunk_size=1000):
+        # A RawTagsRecord for every resource and engine whose results were kept, ordered by resource id
+        query = select(
+            ResourceEngine.resource_id,
+            (Directory.location + Resource.basename).label('location'),
+            ResourceEngine.engine,
+            ResourceEngine.raw_tags
+        ) \
+            .join(Resource, Resource.id == ResourceEngine.resource_id) \
+            .join(Resource.directory) \
+            .where(ResourceEngine.raw_tags.isnot(None))
+        if engine is not None:
+            query = query.where(ResourceEngine.engine == engine)
+        with self._session() as session:
+            rows = session.execute(query
+                                   .order_by(ResourceEngine.resource_id, ResourceEngine.engine)
+                                   .execution_options(yield_per=chunk_size))
+            for row in rows:
+                yield RawTagsRecord(*row)
+
+    def iter_raw_and_current_tags(self, engine=None):
+        # Every RawTagsRecord of iter_raw_tags, with the set of names of the tags its resource has from its
+        # engine.  Both are ordered by resource id, so the tags are merged in instead of queried per resource.
+        tag_records = self.iter_tag_records(engine)
+        tag_record = next(tag_records, None)
+        resource_id, current_tags = None, {}  # engine -> names of the tags resource_id has
+        for record in self.iter_raw_tags(engine):
+            if record.resource_id != resource_id:
+                resource_id, current_tags = record.resource_id, {}
+                while tag_record is not None and tag_record.resource_id <= resource_id:
+                    if tag_record.resource_id == resource_id:
+                        current_tags.setdefault(tag_record.engine, set()).add(tag_record.name)
+                    tag_record = next(tag_records, None)
+            yield record, current_tags.get(record.engine, set())
+
+    @_batched
+    def move_resource(self, location, new_location, name=None, size=None, mtime_ns=None, inode=None):
+        # The resource keeps its id, so its ResourceTag rows move along with it
+        with self._session() as session:
+            existing_resource = session.execute(Persist._select_resource(location)).one_or_none()
+            if existing_resource is None:
+                raise ValueError(f'Existing resource not found: {location}')
+            if session.execute(Persist._select_resource(new_location)).one_or_none() is not None:
+                raise ValueError(f'A resource already exists at {new_location}')
+            logger.debug('Moving resource {} to {}'.format(location, new_location))
+            resource = existing_resource.Resource
+            resource.location = new_location
+            if name is not None:
+                resource.name = name
+            if size is not None:
+                resource.size = size
+            if mtime_ns is not None:
+                resource.mtime_ns = mtime_ns
+            if inode is not None:
+                resource.inode = inode
+            result = Persist._resource_to_dict(resource)
+        self._index_put(result, discard=location)
+        return result
+
+    def find_tagged_resource(self, hashval, engine, fingerprint, exclude_location=None):
+        # Another resource with the same content, already tagged by the same engine with the same settings
+        with self._session() as session:
+            query = session.query(Resource.id) \
+                .join(ResourceEngine, ResourceEngine.resource_id == Resource.id) \
+                .filter(
+                    Resource.hashval == hashval,
+                    ResourceEngine.hashval == hashval,
+                    ResourceEngine.engine == engine,
+                    ResourceEngine.fingerprint == fingerprint
+                )
+            if exclude_location is not None:
+                directory_location, basename = split_location(exclude_location)
+                query = query \
+                    .join(Directory, Directory.id == Resource.directory_id) \
+                    .filter(or_(Directory.location != directory_location, Resource.basename != basename))
+            row = query.order_by(Resource.id).first()
+            return None if row is None else row.id
+
+    def find_tagged_resources(self, ids, engine, fingerprint):
+        # The resources among ids whose tags from engine are current and were made with the same settings, with
+        # one query per ID_CHUNK_SIZE ids
+        result = set()
+        with self._session() as session:
+            for chunk in _id_chunks(ids):
+                rows = session.query(Resource.id) \
+                    .join(ResourceEngine, ResourceEngine.resource_id == Resource.id) \
+                    .filter(
+                        Resource.id.in_(chunk),
+                        ResourceEngine.hashval == Resource.hashval,
+                        ResourceEngine.engine == engine,
+                        ResourceEngine.fingerprint == fingerprint
+                    ) \
+                    .all()
+                result.update(row.id for row in rows)
+        return result
+
+    def get_stale_resource_ids(self, engine, fingerprint):
+        # The resources engine has to tag again, because it never tagged them or tagged them with other
+        # content or other settings.  Resources tagged before resource_engine was kept count as current
+        # when they have tags from engine.
+        has_tags = select(ResourceTag.resource_id) \
+            .join(Tag, Tag.id == ResourceTag.tag_id) \
+            .where(ResourceTag.resource_id == Resource.id, Tag.engine == engine) \
+            .exists()
+        with self._session() as session:
+            rows = session.execute(
+                select(Resource.id)
+                .outerjoin(ResourceEngine, and_(ResourceEngine.resource_id == Resource.id,
+                                                ResourceEngine.engine == engine))
+                .where(or_(
+                    and_(ResourceEngine.resource_id.is_(None), ~has_tags),
+                    ResourceEngine.hashval != Resource.hashval,
+                    ResourceEngine.fingerprint != fingerprint
+                ))
+            )
+            return set(rows.scalars())
+
+    @_batched
+    def forget_directory_snapshots(self, resource_ids):
+        # The next INCREMENTAL scan goes through the directories of the resources again, even if they have
+        # not changed
+        with self._session() as session:
+            for chunk in _id_chunks(resource_ids):
+                session.execute(
+                    update(Directory.__table__)
+                    .where(Directory.id.in_(select(Resource.directory_id).where(Resource.id.in_(chunk))))
+                    .values(digest=None)
+                )
+
+    def get_phashes(self):
+        # resource id -> phash of every resource that has one, to fill a HammingIndex at startup
+        with self._session() as session:
+            rows = session.query(Resource.id, Resource.phash).filter(Resource.phash.isnot(None))
+            return {row.id: row.phash for row in rows}
+
+    def get_last_resource_id(self):
+        with self._session() as session:
+            return session.execute(select(func.max(Resource.id))).scalar() or 0
 
-    def get_tags_by_resource_id(self, id):
+    def get_resource_ids(self, after_id=0):
+        with self._session() as session:
+            return session.execute(select(Resource.id).where(Resource.id > after_id)).scalars().all()
+
+    def get_last_tags_version(self):
+        with self._session() as session:
+            return session.execute(select(func.max(Resource.tags_version))).scalar() or 0
+
+    def get_tags_changed(self, after_version):
+        # resource id -> tags_version of the resources whose tags changed after after_version
+        with self._session() as session:
+            rows = session.execute(select(Resource.id, Resource.tags_version)
+                                   .where(Resource.tags_version > after_version))
+            return {row.id: row.tags_version for row in rows}
+
+    def get_tag_names(self):
+        # tag id -> name
+        with self._session() as session:
+            return {row.id: row.name for row in session.execute(select(Tag.id, Tag.name))}
+
+    def iter_postings(self, chunk_size=10000):
+        # (tag id, resource id, confidence) of every resource tag, by tag and then by confidence
+        with self._session() as session:
+            rows = session.execute(select(ResourceTag.tag_id, ResourceTag.resource_id, ResourceTag.confidence)
+                                   .order_by(ResourceTag.tag_id, ResourceTag.confidence)
+                                   .execution_options(yield_per=chunk_size))
+            for row in rows:
+                yield tuple(row)
+
+    def get_tags_by_resource_id(self, id, engine=None):
         result = {}
-        with self.engine.session() as session, session.begin():
-            row = session.query(Resource).get(id)
-            for resource_tag in row.tags:
-                tag_detail = Persist._row_to_dict(resource_tag.tag)
-                tag_detail['confidence'] = resource_tag.confidence
-                result[resource_tag.tag.name] = tag_detail
+        with self._session() as session:
+            # Plain rows rather than Tag and ResourceTag objects, which could also be stale in a batch
+            # session after the bulk updates of _handle_tags
+            query = select(Tag.id, Tag.name, Tag.engine, Tag.description, ResourceTag.confidence) \
+                .join(ResourceTag, ResourceTag.tag_id == Tag.id) \
+                .where(ResourceTag.resource_id == id)
+            if engine is not None:
+                query = query.where(Tag.engine == engine)
+            for row in session.execute(query):
+                result[row.name] = dict(row._mapping)
         return result
+
+    def get_directory(self, location):
+        with self._session() as session:
+            row = session.query(Directory).filter(Directory.location == location).one_or_none()
+            if row is None:
+                return None
+            else:
+                return Persist._row_to_dict(row)
+
+    @_batched
+    def set_directory(self, location, mtime_ns, entry_count, digest):
+        with self._session() as session:
+            pending_rescan = session.query(Resource.id).join(Resource.directory).filter(
+                Directory.location.startswith(location, autoescape=True),
+                Resource.hashval == RESCAN
+            ).first()
+            if pending_rescan is not None:
+                # Never let a snapshot hide a file that still has to be tagged again
+                logger.debug('Not keeping a snapshot of {}, it has resources to rescan'.format(location))
+                digest = None
+            directory = session.get(Directory, get_or_insert_id(session, Directory.__table__, location=location))
+            directory.mtime_ns = mtime_ns
+            directory.entry_count = entry_count
+            directory.digest = digest
+            return Persist._row_to_dict(directory)
@@ -1,10 +1,171 @@
+import calendar
+import datetime
+import json
+import os
+import zlib
+
+from sqlalchemy import bindparam, event, insert, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import ForeignKey, UniqueConstraint
-from sqlalchemy import Table, Column, Integer, String, DateTime
+from sqlalchemy.orm import Session
+from sqlalchemy import ForeignKey, Index, UniqueConstraint
+from sqlalchemy import Table, Column, BigInteger, Integer, String, DateTime, LargeBinary
+from sqlalchemy.types import TypeDecorator
 
 Base = declarative_base()
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def split_location(location):
+    # 'a/b/c.jpg' -> ('a/b/', 'c.jpg').  The directory keeps its separator, like Directory.location does.
+    # A backslash is only a separator where the OS says so; elsewhere it can be part of a file name.
+    index = max(location.rfind('/'), location.rfind(os.sep))
+    return location[:index + 1], location[index + 1:]
+
+
+def encode_hash(value):
+    # A lower case sha256 hex digest is stored as its 32 bytes.  Anything else, like the rescan marker,
+    # is stored as its text after a zero byte, so it never looks like a digest.
+    if value is None:
+        return None
+    if len(value) == 64 and value == value.lower():
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            pass
+    data = b'\0' + value.encode('utf-8')
+    if len(data) == 32:
+        data = b'\0' + data
+    return data
+
+
+def decode_hash(value):
+    if value is None:
+        return None
+    value = bytes(value)
+    if len(value) == 32:
+        return value.hex()
+    if len(value) == 33 and value[1:2] == b'\0':
+        return value[2:].decode('utf-8')
+    return value[1:].decode('utf-8')
+
+
+def encode_datetime(value):
+    # Microseconds since 1970 of a naive datetime, read back as the same naive datetime
+    if value is None:
+        return None
+    return calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+
+
+def decode_datetime(value):
+    if value is None:
+        return None
+    return _EPOCH + datetime.timedelta(microseconds=value)
+
+
+def encode_raw_tags(tags):
+    # Everything an engine returned, {name: {'confidence': c}}, as zlib compressed [[name, c], ...] with
+    # the confidences rounded to 2 decimals.  About a third of the size of the same tags as resource_tag rows.
+    if tags is None:
+        return None
+    pairs = sorted(([name, round(detail['confidence'], 2)] for name, detail in tags.items()),
+                   key=lambda pair: -pair[1])
+    return zlib.compress(json.dumps(pairs, separators=(',', ':')).encode('utf-8'), 9)
+
+
+def decode_raw_tags(value):
+    if value is None:
+        return None
+    return {name: {'confidence': confidence} for name, confidence in json.loads(zlib.decompress(bytes(value)))}
+
+
+_INSERTS = {}  # (dialect, table, columns, conflict clause) -> statement
+_DIALECT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def _insert(session, table, columns, on_conflict):
+    # SQLAlchemy 1.4 cannot cache the ON CONFLICT inserts of the dialects, so it would compile them again for
+    # every execution, which takes longer than running them.  Each one is compiled once into a text statement.
+    dialect = session.get_bind().dialect
+    key = (dialect.name, table.name, tuple(columns), on_conflict)
+    statement = _INSERTS.get(key)
+    if statement is None:
+        values = {column: bindparam(column) for column in columns}
+        if dialect.name not in _DIALECT_INSERTS:
+            # A plain INSERT, which fails on a row that is already there
+            statement = insert(table).values(values)
+        else:
+            statement = _DIALECT_INSERTS[dialect.name](table).values(values)
+            if on_conflict[0] == 'nothing':
+                statement = statement.on_conflict_do_nothing()
+            else:
+                statement = statement.on_conflict_do_update(
+                    index_elements=list(on_conflict[1]),
+                    set_={column: statement.excluded[column] for column in on_conflict[2]}
+                )
+            sql = str(statement.compile(dialect=type(dialect)(paramstyle='named')))
+            statement = text(sql).bindparams(*[bindparam(column, type_=table.c[column].type) for column in columns])
+        _INSERTS[key] = statement
+    return statement
+
+
+def insert_ignore(session, table, columns):
+    # An INSERT of columns that skips the rows that would break a unique constraint, including rows a
+    # concurrent transaction has just inserted
+    return _insert(session, table, columns, ('nothing',))
+
+
+def upsert(session, table, columns, index_elements, update_columns):
+    # An INSERT of columns that updates update_columns of the row that is already there instead of failing
+    return _insert(session, table, columns, ('update', tuple(index_elements), tuple(update_columns)))
+
+
+def get_or_insert_id(session, table, **values):
+    # The id of the row with values, inserted first when there is none.  When two writers insert the same
+    # row at once, the second one gets the id of the first one's row instead of failing.
+    query = select(table.c.id).filter_by(**values)
+    row_id = session.execute(query).scalar()
+    if row_id is None:
+        session.execute(insert_ignore(session, table, values.keys()), values)
+        row_id = session.execute(query).scalar_one()
+    return row_id
+
+
+class HashType(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encode_hash(value)
+
+    def process_result_value(self, value, dialect):
+        return decode_hash(value)
+
+
+class RawTagsType(TypeDecorator):
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encode_raw_tags(value)
+
+    def process_result_value(self, value, dialect):
+        return decode_raw_tags(value)
+
+
+class EpochMicroseconds(TypeDecorator):
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return encode_datetime(value)
+
+    def process_result_value(self, value, dialect):
+        return decode_datetime(value)
+
 # resource_tag_table = Table(
 #     'resource_tag',
 #     Base.metadata,
@@ -22,27 +183,91 @@ class ResourceTag(Base):
     confidence = Column(Integer, nullable=False)  # 0-100.  Percent likelihood the tag is correct
     resource = relationship('Resource', back_populates='tags')
     tag = relationship('Tag', back_populates='resources')
+    __table_args__ = (Index('idx_resource_tag_tag_id', 'tag_id', 'resource_id', 'confidence'),)
+
+
+class ResourceEngine(Base):
+    # What an engine last tagged a resource with: the content (hashval) and the engine settings (fingerprint)
+    __tablename__ = 'resource_engine'
+    resource_id = Column(ForeignKey('resource.id'), primary_key=True)
+    engine = Column(String(100), primary_key=True)
+    hashval = Column(HashType, nullable=False)
+    fingerprint = Column(String(64), nullable=False)
+    last_tagged = Column(DateTime, nullable=False)
+    raw_tags = Column(RawTagsType)  # every tag the engine returned, even those below the thresholds
+    resource = relationship('Resource', back_populates='engines')
+    __table_args__ = (Index('idx_resource_engine_hashval', 'hashval'),)
+
+    def __repr__(self):
+        return f"ResourceEngine(resource_id={self.resource_id!r}, engine={self.engine!r}, " \
+               f"hashval={self.hashval!r}, fingerprint={self.fingerprint!r}, last_tagged={self.last_tagged!r})"
 
 
 class Resource(Base):
     __tablename__ = 'resource'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    location = Column(String, nullable=False)
-    hashval = Column(String, nullable=False)
-    last_indexed = Column(DateTime, nullable=False)
+    directory_id = Column(ForeignKey('directory.id'), nullable=False)  # location is split in two, so the
+    basename = Column(String, nullable=False)  # directories are only stored once
+    hashval = Column(HashType, nullable=False)
+    last_indexed = Column(EpochMicroseconds, nullable=False)
     description = Column(String)
-    __table_args__ = (UniqueConstraint('location', name='uix_1'),)  # _location _uc
+    size = Column(BigInteger)  # st_size, st_mtime_ns and st_ino of the file when hashval was calculated
+    mtime_ns = Column(BigInteger)
+    inode = Column(BigInteger)
+    phash = Column(String(16))  # 64 bit dHash in hex, to find resized and recompressed copies
+    tags_version = Column(Integer)  # bumped past every other resource whenever the tags change
+    __table_args__ = (
+        UniqueConstraint('directory_id', 'basename', name='uix_resource_location'),  # _location _uc
+        Index('idx_hashval', 'hashval'),
+        Index('idx_resource_tags_version', 'tags_version'),
+    )
+
+    directory = relationship('Directory', lazy='joined', innerjoin=True)
 
     tags = relationship(
         "ResourceTag",
         back_populates="resource"
     )
+    engines = relationship(
+        "ResourceEngine",
+        back_populates="resource"
+    )
+
+    @property
+    def location(self):
+        pending = getattr(self, '_location', None)
+        if pending is not None:
+            return pending
+        if self.directory is None:
+            return None
+        return self.directory.location + self.basename
+
+    @location.setter
+    def location(self, location):
+        # The directory is looked up, or added, when the session is flushed.  See _resolve_locations.
+        self._location = location
+        self.basename = split_location(location)[1]
 
     def __repr__(self):
         return f"Tag(id={self.id!r}, name={self.name!r}, location={self.location!r}, " \
                f"hashval={self.hashval!r}, last_indexed={self.last_indexed!r}, " \
-               f"description={self.description!r})"
+               f"description={self.description!r}, size={self.size!r}, mtime_ns={self.mtime_ns!r}, " \
+               f"inode={self.inode!r}, phash={self.phash!r})"
+
+
+class Directory(Base):
+    __tablename__ = 'directory'
+    id = Column(Integer, primary_key=True)
+    location = Column(String, nullable=False)  # always ends with a path separator
+    mtime_ns = Column(BigInteger)  # snapshot of the directory when all of its files were last scanned
+    entry_count = Column(Integer)
+    digest = Column(String(64))  # sha256 of the entry names
+    __table_args__ = (UniqueConstraint('location', name='uix_directory_location'),)
+
+    def __repr__(self):
+        return f"Directory(id={self.id!r}, location={self.location!r}, mtime_ns={self.mtime_ns!r}, " \
+               f"entry_count={self.entry_count!r}, digest={self.digest!r})"
 
 
 class Tag(Base):
@@ -51,7 +276,10 @@ class Tag(Base):
     name = Column(String(100), nullable=False)
     engine = Column(String(100), nullable=False)
     description = Column(String)
-    __table_args__ = (UniqueConstraint('name', 'engine', name='uix_1'),)  # _name_engine_uc
+    __table_args__ = (
+        UniqueConstraint('name', 'engine', name='uix_tag_name_engine'),  # _name_engine_uc
+        Index('idx_tag_engine', 'engine', 'name', 'id'),
+    )
 
     resources = relationship(
         "ResourceTag",
@@ -61,3 +289,24 @@ class Tag(Base):
     def __repr__(self):
         return f"Tag(id={self.id!r}, name={self.name!r}, description={self.description!r}, " \
                f"confidence={self.confidence!r})"
+
+
+@event.listens_for(Session, 'before_flush')
+def _resolve_locations(session, flush_context, instances):
+    directories = {}
+    for obj in list(session.new) + list(session.dirty):
+        location = getattr(obj, '_location', None)
+        if not isinstance(obj, Resource) or location is None:
+            continue
+        directory_location = split_location(location)[0]
+        directory = directories.get(directory_location)
+        if directory is None:
+            directory = next((d for d in session.new if isinstance(d, Directory) and
+                              d.location == directory_location), None)
+        if directory is None:
+            with session.no_autoflush:
+                directory = session.get(Directory, get_or_insert_id(session, Directory.__table__,
+                                                                    location=directory_location))
+        directories[directory_location] = directory
+        obj.directory = directory
+        obj._location = None
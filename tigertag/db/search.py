@@ -0,0 +1,271 @@
+import bisect
+import itertools
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from collections import deque
+from collections import namedtuple
+
+# A search is a boolean expression of tags, each with an optional confidence test:
+#
+#   ttf_alice AND tti_beach>=60
+#   (dog OR cat) AND NOT person<50
+#
+# NOT binds tighter than AND, and AND tighter than OR.  Two terms next to each other are ANDed.
+Term = namedtuple('Term', 'name op confidence')
+And = namedtuple('And', 'left right')
+Or = namedtuple('Or', 'left right')
+Not = namedtuple('Not', 'operand')
+
+_TOKEN = re.compile(r'\s*(?:(\()|(\))|(>=|<=|>|<|=)|([^\s()<>=]+))')
+_KEYWORDS = ('AND', 'OR', 'NOT')
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError('Unable to parse the search {!r} at {}'.format(expression, position))
+        position = match.end()
+        if match.group(1) or match.group(2):
+            tokens.append(match.group(1) or match.group(2))
+        elif match.group(3):
+            tokens.append(('OP', match.group(3)))
+        elif match.group(4).upper() in _KEYWORDS:
+            tokens.append(match.group(4).upper())
+        else:
+            tokens.append(('NAME', match.group(4)))
+    return tokens
+
+
+def parse(expression):
+    tokens = _tokenize(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise ValueError('The search {!r} ended too soon'.format(expression))
+        position += 1
+        return token
+
+    def parse_or():
+        node = parse_and()
+        while peek() == 'OR':
+            take()
+            node = Or(node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() == 'AND' or peek() == 'NOT' or peek() == '(' or isinstance(peek(), tuple):
+            if peek() == 'AND':
+                take()
+            node = And(node, parse_not())
+        return node
+
+    def parse_not():
+        if peek() == 'NOT':
+            take()
+            return Not(parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        token = take()
+        if token == '(':
+            node = parse_or()
+            if take() != ')':
+                raise ValueError('Missing ) in the search {!r}'.format(expression))
+            return node
+        if not isinstance(token, tuple) or token[0] != 'NAME':
+            raise ValueError('Expected a tag in the search {!r}, not {!r}'.format(expression, token))
+        if isinstance(peek(), tuple) and peek()[0] == 'OP':
+            op = take()[1]
+            value = take()
+            if not isinstance(value, tuple) or not value[1].isdigit():
+                raise ValueError('Expected a confidence after {}{} in the search {!r}'.format(
+                    token[1], op, expression))
+            return Term(token[1], op, int(value[1]))
+        return Term(token[1], None, None)
+
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError('Unexpected {!r} in the search {!r}'.format(peek(), expression))
+    return node
+
+
+def _confidence_range(confidences, op, confidence):
+    # The slice of confidences, sorted ascending, that pass the test
+    if op is None:
+        return 0, len(confidences)
+    if op == '>=':
+        return bisect.bisect_left(confidences, confidence), len(confidences)
+    if op == '>':
+        return bisect.bisect_right(confidences, confidence), len(confidences)
+    if op == '<=':
+        return 0, bisect.bisect_right(confidences, confidence)
+    if op == '<':
+        return 0, bisect.bisect_left(confidences, confidence)
+    return bisect.bisect_left(confidences, confidence), bisect.bisect_right(confidences, confidence)
+
+
+def _passes(value, op, confidence):
+    if op is None:
+        return True
+    if op == '>=':
+        return value >= confidence
+    if op == '>':
+        return value > confidence
+    if op == '<=':
+        return value <= confidence
+    if op == '<':
+        return value < confidence
+    return value == confidence
+
+
+# Sets of resource ids are Python ints holding one byte per resource, 1 when the resource is in the set.
+# AND, OR and NOT over millions of resources are then single C loops over a few MB, and so are building a
+# set from ids and listing the ids of a set.  Packing 8 resources per byte would need a Python loop per id.
+def _bitmap(ids):
+    if len(ids) == 0:
+        return 0
+    bits = bytearray(max(ids) + 1)
+    deque(map(bits.__setitem__, ids, itertools.repeat(1)), maxlen=0)
+    return int.from_bytes(bits, 'little')
+
+
+def _bitmap_ids(bitmap, limit=None):
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) >> 3, 'little')
+    if limit is None:
+        return list(itertools.compress(range(len(data)), data))
+    # find skips the runs of zeros in C, which matters when the matches are sparse
+    ids = []
+    position = data.find(1)
+    while position != -1 and len(ids) < limit:
+        ids.append(position)
+        position = data.find(1, position + 1)
+    return ids
+
+
+class TagIndex:
+    # An inverted index of resource_tag: for every tag, the ids of its resources sorted by confidence, so
+    # a confidence test is a bisect.  Memory is about 10 bytes per resource tag, 170 MB for 17M, plus up to
+    # cache_size sets of search terms at 1 byte per resource each.
+    #
+    # refresh() keeps it current without loading everything again.  The tags of resources changed since
+    # the load, found by Resource.tags_version, are kept on the side and override what was loaded.  Once
+    # more than max_overrides resources have changed, the whole index is loaded again.
+    def __init__(self, persist, cache_size=64, max_overrides=100000):
+        self.persist = persist
+        self.cache_size = cache_size
+        self.max_overrides = max_overrides
+        self._tag_ids = {}  # name -> tag id
+        self._postings = {}  # tag id -> (array of resource ids, array of their confidences, ascending)
+        self._overrides = {}  # resource id -> tag id -> confidence, for resources changed since the load
+        self._overridden = 0  # bitmap of the resources in _overrides
+        self._resources = 0  # bitmap of every resource, for NOT
+        self._last_resource_id = 0
+        self._last_tags_version = 0
+        self._cache = OrderedDict()  # Term -> bitmap
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return self._resources.bit_count()
+
+    def load(self):
+        with self._lock:
+            # Read the marks first.  Whatever changes while loading is picked up again by the next refresh.
+            last_tags_version = self.persist.get_last_tags_version()
+            self._tag_ids = {name: tag_id for tag_id, name in self.persist.get_tag_names().items()}
+            self._postings = {}
+            current = None
+            for tag_id, resource_id, confidence in self.persist.iter_postings():
+                if tag_id != current:
+                    ids, confidences = array('q'), array('h')
+                    self._postings[tag_id] = (ids, confidences)
+                    current = tag_id
+                ids.append(resource_id)
+                confidences.append(confidence)
+            resource_ids = self.persist.get_resource_ids()
+            self._resources = _bitmap(resource_ids)
+            self._last_resource_id = max(resource_ids, default=0)
+            self._last_tags_version = last_tags_version
+            self._overrides = {}
+            self._overridden = 0
+            self._cache.clear()
+            return len(resource_ids)
+
+    def refresh(self):
+        # Applies the changes made since the last load or refresh.  Returns how many resources changed.
+        with self._lock:
+            resource_ids = self.persist.get_resource_ids(self._last_resource_id)
+            changed = self.persist.get_tags_changed(self._last_tags_version)
+            if len(resource_ids) == 0 and len(changed) == 0:
+                return 0
+            if len(self._overrides) + len(changed) > self.max_overrides:
+                self.load()
+                return len(resource_ids) + len(changed)
+            if len(resource_ids) > 0:
+                self._resources |= _bitmap(resource_ids)
+                self._last_resource_id = max(self._last_resource_id, max(resource_ids))
+            if len(changed) > 0:
+                records = self.persist.get_tag_records(changed.keys())
+                for resource_id in changed:
+                    tags = {}
+                    for record in records.get(resource_id, ()):
+                        self._tag_ids[record.name] = record.tag_id
+                        tags[record.tag_id] = record.confidence
+                    self._overrides[resource_id] = tags
+                self._overridden |= _bitmap(list(changed.keys()))
+                self._last_tags_version = max(self._last_tags_version, max(changed.values()))
+            self._cache.clear()
+            return len(set(resource_ids) | set(changed))
+
+    def _term(self, term):
+        bitmap = self._cache.get(term)
+        if bitmap is not None:
+            self._cache.move_to_end(term)
+            return bitmap
+        bitmap = 0
+        tag_id = self._tag_ids.get(term.name)
+        if tag_id is not None:
+            if tag_id in self._postings:
+                ids, confidences = self._postings[tag_id]
+                start, end = _confidence_range(confidences, term.op, term.confidence)
+                bitmap = _bitmap(ids[start:end]) & ~self._overridden
+            bitmap |= _bitmap([resource_id for resource_id, tags in self._overrides.items()
+                               if tag_id in tags and _passes(tags[tag_id], term.op, term.confidence)])
+        self._cache[term] = bitmap
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return bitmap
+
+    def _evaluate(self, node):
+        if isinstance(node, Term):
+            return self._term(node)
+        if isinstance(node, And):
+            return self._evaluate(node.left) & self._evaluate(node.right)
+        if isinstance(node, Or):
+            return self._evaluate(node.left) | self._evaluate(node.right)
+        return self._resources & ~self._evaluate(node.operand)
+
+    def bitmap(self, expression):
+        node = parse(expression) if isinstance(expression, str) else expression
+        with self._lock:
+            return self._evaluate(node)
+
+    def search(self, expression, limit=None):
+        # The ids of the matching resources, smallest first
+        return _bitmap_ids(self.bitmap(expression), limit)
+
+    def count(self, expression):
+        return self.bitmap(expression).bit_count()
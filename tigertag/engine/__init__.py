@@ -1,14 +1,26 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
 import re
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from tigertag import Pluggable
+from tigertag.engine.cache import MAX_BYTES
+from tigertag.engine.cache import ResponseCache
+from tigertag.util import ImageData
 from tigertag.util import str2bool
 
 logger = logging.getLogger(__name__)
 
-TagInfo = namedtuple('TagInfo', 'path tags')
+# tags are the ones the engine kept.  raw, when the engine gives it, is everything it returned, even below its
+# thresholds, so the tags can be worked out again with other thresholds without tagging the image again.
+TagInfo = namedtuple('TagInfo', 'path tags raw', defaults=(None,))
+# An image to tag in a batch, with the arguments of tag.  hashval and engines are those of EngineManager.tag.
+TagRequest = namedtuple('TagRequest', 'path temp ext_id data hashval engines', defaults=(None, None, None, None, None))
 
 
 class Engine(Pluggable):
@@ -21,28 +33,183 @@ class Engine(Pluggable):
         self.prefix = prefix
         self.listeners = []  # EngineListeners
 
-    def tag(self, path: str, temp: str = None, ext_id: str = None):
+    def tag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None):
+        # data, when given, already holds the bytes of temp (or path) so the engine does not have to read them again
         raise NotImplementedError('The {} engine has not implemented the tag method.'.format(self.name))
 
+    def tag_batch(self, items: list) -> list:
+        # tag for each TagRequest, returning the TagInfos in the same order.  Engines override it to share the
+        # cost of a call, like a session, across the batch.
+        return [self.tag(item.path, item.temp, item.ext_id, item.data) for item in items]
+
+    async def atag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None):
+        # tag for asyncio, returning the TagInfo without calling the listeners; EngineManager.atag passes it
+        # on.  Engines with an async HTTP client override it, the others run tag on a thread.
+        return await asyncio.to_thread(self.tag, path, temp, ext_id, data)
+
+    async def aclose(self):
+        # Closes what atag opened, like its HTTP session
+        pass
+
     def calc_tag_name(self, tag_name):
         return '{}_{}'.format(self.prefix, tag_name)
 
+    def strip_tag_name(self, tag_name):
+        # The name the engine returned, before calc_tag_name added the prefix
+        return tag_name[len(self.prefix) + 1:]
+
+    def threshold(self, raw_tags: dict) -> dict:
+        # The tags the engine keeps out of everything it returned.  It is applied again to the kept raw
+        # results whenever the thresholds change, so thresholds do not belong in settings.
+        return dict(raw_tags)
+
+    def settings(self) -> dict:
+        # Everything besides the image itself that changes what tag returns.  Credentials and URLs do not.
+        return {}
+
+    def fingerprint(self) -> str:
+        settings = {
+            'engine': '{}.{}'.format(type(self).__module__, type(self).__name__),
+            'prefix': self.prefix,
+        }
+        settings.update(self.settings())
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def cache_key(self) -> str:
+        # Like fingerprint, but without the prefix, which the cached responses are kept without
+        settings = {
+            'engine': '{}.{}'.format(type(self).__module__, type(self).__name__),
+        }
+        settings.update(self.settings())
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
 
 class EngineListener:
     def on_tags(self, engine: Engine, tag_info: TagInfo, ext_id: str):
         pass
 
 
-class EngineManager:
+class _Collector(EngineListener):
+    # Keeps the on_tags calls an engine makes while running on a worker thread, so EngineManager can pass
+    # them on to its listeners from the thread that called it
     def __init__(self):
+        self._local = threading.local()
+
+    def on_tags(self, engine: Engine, tag_info: TagInfo, ext_id: str):
+        self._local.calls.append((engine, tag_info, ext_id))
+
+    def collect(self, method, *args):
+        self._local.calls = []
+        try:
+            method(*args)
+            return self._local.calls
+        finally:
+            del self._local.calls
+
+
+class EngineManager:
+    def __init__(self, workers=0):
         self.engines = {}
         self.listeners = []  # EngineListener array
+        self.cache = None  # ResponseCache shared by the engines, when configured
+        # With workers, the engines of an image run at the same time, on a pool of that many threads.  The
+        # listeners are still called one at a time, in engine order, on the thread that called tag.  Either
+        # way, each engine runs at most its MAX_CONCURRENCY prop times at once, default 1, however many
+        # threads call tag.
+        self.workers = workers
+        self._executor = None
+        self._semaphores = {}  # engine name -> BoundedSemaphore
+        self._lock = threading.Lock()
+        self._collector = _Collector()
+        self._async_semaphores = {}  # engine name -> asyncio.Semaphore of _async_loop
+        self._async_loop = None
+        # submit holds up to batch_size images before tagging them with tag_batch.  1 tags them right away.
+        self.batch_size = 1
+        self._batch = []  # TagRequests
 
     def add(self, engine):
         self.engines[engine.name] = engine
 
-    def tag(self, path: str, temp: str = None, ext_id: str = None):
+    @staticmethod
+    def _cached_tag_info(engine, path: str, response: list):
+        logger.debug('Using the cached {} response for {}'.format(engine.name, path))
+        raw_tags = {engine.calc_tag_name(name): {'confidence': confidence} for name, confidence in response}
+        return TagInfo(path, engine.threshold(raw_tags), raw_tags)
+
+    def _cache_tag_info(self, key: str, engine, tag_info: TagInfo):
+        if tag_info is not None and tag_info.tags is not None:
+            raw_tags = tag_info.raw if tag_info.raw is not None else tag_info.tags
+            self.cache.put(key, [[engine.strip_tag_name(name), tag_detail['confidence']]
+                                 for name, tag_detail in raw_tags.items()])
+
+    def _tag_cached(self, engine, path: str, temp: str, ext_id: str, data: ImageData, hashval: str):
+        key = ResponseCache.key(hashval, engine.cache_key())
+        response = self.cache.get(key)
+        if response is not None:
+            tag_info = self._cached_tag_info(engine, path, response)
+            for listener in engine.listeners:
+                listener.on_tags(engine, tag_info, ext_id)
+            return tag_info
+        tag_info = engine.tag(path, temp, ext_id, data)
+        self._cache_tag_info(key, engine, tag_info)
+        return tag_info
+
+    def _tag(self, engine, path: str, temp: str, ext_id: str, data: ImageData, hashval: str):
+        if self.cache is None or hashval is None:
+            return engine.tag(path, temp, ext_id, data)
+        return self._tag_cached(engine, path, temp, ext_id, data, hashval)
+
+    def _tag_batch(self, engine, items: list):
+        # A TagInfo for each item, in order, whether the cache or the engine answered
+        if self.cache is None:
+            return engine.tag_batch(items)
+        tag_infos = [None] * len(items)
+        uncached = []  # indexes of the items the engine tags
+        for index, item in enumerate(items):
+            response = None if item.hashval is None else \
+                self.cache.get(ResponseCache.key(item.hashval, engine.cache_key()))
+            if response is None:
+                uncached.append(index)
+            else:
+                tag_infos[index] = self._cached_tag_info(engine, item.path, response)
+                for listener in engine.listeners:
+                    listener.on_tags(engine, tag_infos[index], item.ext_id)
+        if len(uncached) > 0:
+            for index, tag_info in zip(uncached, engine.tag_batch([items[index] for index in uncached])):
+                tag_infos[index] = tag_info
+                if items[index].hashval is not None:
+                    self._cache_tag_info(ResponseCache.key(items[index].hashval, engine.cache_key()), engine,
+                                         tag_info)
+        return tag_infos
+
+    def _semaphore(self, engine):
+        with self._lock:
+            semaphore = self._semaphores.get(engine.name)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(int(engine.props.get('MAX_CONCURRENCY', 1)))
+                self._semaphores[engine.name] = semaphore
+            return semaphore
+
+    def _tag_limited(self, engine, *args):
+        # Runs on a worker thread
+        with self._semaphore(engine):
+            return self._collector.collect(self._tag, engine, *args)
+
+    def _tag_batch_limited(self, engine, items: list):
+        # Runs on a worker thread
+        with self._semaphore(engine):
+            return self._collector.collect(self._tag_batch, engine, items)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='engine')
+            return self._executor
+
+    def _select(self, engines: list):
+        # The enabled engines to call, after checking the prefixes of all of them
         prefixes = []
+        selected = []
         if len(self.engines) == 0:
             logger.warning('No tag engines configured.  Please check your configuration')
         for engine_name, engine in self.engines.items():
@@ -52,11 +219,162 @@ class EngineManager:
                 raise ValueError('Duplicate prefix {} found in {} engine.  Removing the engine or changing the '
                                  'prefix will resolve the issue.'.format(engine.prefix, engine_name))
             if engine.enabled:
-                engine.listeners = []
-                for engine_listener in self.listeners:
-                    engine.listeners.append(engine_listener)
-                engine.tag(path, temp, ext_id)
+                if engines is None or engine_name in engines:
+                    selected.append(engine)
                 prefixes.append(engine.prefix)
+        return selected
+
+    def tag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None, hashval: str = None,
+            engines: list = None):
+        # hashval, the sha256 of the content, lets the response cache answer instead of the engines.  engines,
+        # when given, are the names of the only engines to call, like the ones that are stale for the file.
+        selected = self._select(engines)
+        if self.workers <= 0 or len(selected) == 0:
+            for engine in selected:
+                engine.listeners = list(self.listeners)
+                with self._semaphore(engine):
+                    self._tag(engine, path, temp, ext_id, data, hashval)
+            return
+
+        futures = []
+        for engine in selected:
+            engine.listeners = [self._collector]
+            futures.append(self._get_executor().submit(
+                self._tag_limited, engine, path, temp, ext_id, data, hashval))
+        # Like one engine after another, an engine that fails stops the results of the engines after it
+        # from reaching the listeners
+        for future in futures:
+            for engine, tag_info, tag_ext_id in future.result():
+                for listener in self.listeners:
+                    listener.on_tags(engine, tag_info, tag_ext_id)
+
+    def tag_batch(self, items: list):
+        # tag for each TagRequest, one tag_batch call per engine.  The listeners get the tags of each engine
+        # in turn, like with tag.
+        batches = []
+        for engine in self._select(None):
+            engine_items = [item for item in items if item.engines is None or engine.name in item.engines]
+            if len(engine_items) > 0:
+                batches.append((engine, engine_items))
+        if self.workers <= 0:
+            for engine, engine_items in batches:
+                engine.listeners = list(self.listeners)
+                with self._semaphore(engine):
+                    self._tag_batch(engine, engine_items)
+            return
+
+        futures = []
+        for engine, engine_items in batches:
+            engine.listeners = [self._collector]
+            futures.append(self._get_executor().submit(self._tag_batch_limited, engine, engine_items))
+        for future in futures:
+            for engine, tag_info, tag_ext_id in future.result():
+                for listener in self.listeners:
+                    listener.on_tags(engine, tag_info, tag_ext_id)
+
+    def submit(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None, hashval: str = None,
+               engines: list = None):
+        # tag, or with a batch_size above 1, adds the image to the batch, tagged once it is full or on flush.
+        # The batch keeps data open until then.
+        if self.batch_size <= 1:
+            self.tag(path, temp, ext_id, data, hashval, engines)
+            return
+        if data is not None:
+            data.keep()
+        with self._lock:
+            self._batch.append(TagRequest(path, temp, ext_id, data, hashval, engines))
+            if len(self._batch) < self.batch_size:
+                return
+            items, self._batch = self._batch, []
+        self._tag_items(items)
+
+    def flush(self):
+        # Tags the images submitted but not tagged yet
+        with self._lock:
+            items, self._batch = self._batch, []
+        if len(items) > 0:
+            self._tag_items(items)
+
+    def _tag_items(self, items: list):
+        try:
+            self.tag_batch(items)
+        finally:
+            for item in items:
+                if item.data is not None:
+                    item.data.close()
+
+    def _async_semaphore(self, engine):
+        # asyncio semaphores belong to the loop they are first used on
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._async_semaphores = {}
+            self._async_loop = loop
+        semaphore = self._async_semaphores.get(engine.name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(int(engine.props.get('MAX_CONCURRENCY', 1)))
+            self._async_semaphores[engine.name] = semaphore
+        return semaphore
+
+    async def _atag(self, engine, path: str, temp: str, ext_id: str, data: ImageData, hashval: str):
+        async with self._async_semaphore(engine):
+            if self.cache is None or hashval is None:
+                return await engine.atag(path, temp, ext_id, data)
+            # The cache is a SQLite file, so it is read and written on a thread instead of the loop
+            key = ResponseCache.key(hashval, engine.cache_key())
+            response = await asyncio.to_thread(self.cache.get, key)
+            if response is not None:
+                return self._cached_tag_info(engine, path, response)
+            tag_info = await engine.atag(path, temp, ext_id, data)
+            await asyncio.to_thread(self._cache_tag_info, key, engine, tag_info)
+            return tag_info
+
+    async def atag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None,
+                   hashval: str = None, engines: list = None):
+        # tag for asyncio.  The engines of an image run at the same time and, like with workers, each at most
+        # MAX_CONCURRENCY times at once across every atag running.  The listeners are called on the loop, in
+        # engine order.  Engines without an async client run on threads, and do not call the listeners.
+        selected = self._select(engines)
+        for engine in selected:
+            engine.listeners = []
+        results = await asyncio.gather(
+            *[self._atag(engine, path, temp, ext_id, data, hashval) for engine in selected], return_exceptions=True)
+        for engine, tag_info in zip(selected, results):
+            if isinstance(tag_info, BaseException):
+                raise tag_info
+            if tag_info is not None:
+                for listener in self.listeners:
+                    listener.on_tags(engine, tag_info, ext_id)
+
+    async def aclose(self):
+        for engine in self.engines.values():
+            await engine.aclose()
+
+    def rethreshold(self, persist, keep=None, on_change=None):
+        # Works the tags out again from the engine results persist kept, with the current thresholds of the
+        # enabled engines, then keep when given.  Only the tags that change are written, and passed on to
+        # on_change(engine, location, tags).  Returns how many resource and engine pairs that was.
+        changed = 0
+        for record, current_tags in persist.iter_raw_and_current_tags():
+            engine = self.engines.get(record.engine)
+            if engine is None or not engine.enabled:
+                continue
+            tags = engine.threshold(record.raw_tags)
+            if keep is not None:
+                tags = keep(tags)
+            if set(tags.keys()) == current_tags:
+                continue
+            logger.debug('Rethresholded {} tags of {}'.format(record.engine, record.location))
+            persist.set_resource(record.location, engine=record.engine, tags=tags)
+            if on_change is not None:
+                on_change(engine, record.location, tags)
+            changed += 1
+        return changed
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
 
 
 class EngineManagerBuilder:
@@ -83,6 +401,17 @@ class EnvironmentEngineManagerBuilder(EngineManagerBuilder):
         em = self.engine_manager_klass()
         engine_detect = re.compile('^ENGINE_(?P<engine>[A-Z0-9]*)_NAME')
 
+        if 'RESPONSE_CACHE_PATH' in os.environ:
+            max_bytes = MAX_BYTES
+            if 'RESPONSE_CACHE_MAX_MB' in os.environ:
+                max_bytes = int(os.environ['RESPONSE_CACHE_MAX_MB']) * 1024 * 1024
+            em.cache = ResponseCache(os.environ['RESPONSE_CACHE_PATH'], max_bytes)
+            logger.debug('Caching engine responses in {}'.format(em.cache.path))
+        if 'ENGINE_WORKERS' in os.environ:
+            em.workers = int(os.environ['ENGINE_WORKERS'])
+        if 'ENGINE_BATCH_SIZE' in os.environ:
+            em.batch_size = int(os.environ['ENGINE_BATCH_SIZE'])
+
         # Find and create the engines
         for env_name, env_value in os.environ.items():
             match = engine_detect.match(env_name)
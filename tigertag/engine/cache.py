@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = 512 * 1024 * 1024
+
+
+class ResponseCache:
+    # What engines returned, kept in a SQLite file by (content sha256, engine key), so content that has
+    # been tagged before costs no API call, even after the database is rebuilt.  Values are anything JSON
+    # can hold and are stored compressed.  Once the values take more than max_bytes, the least recently
+    # used ones are evicted.
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS response ('
+                                 'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                                 'last_used INTEGER NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS idx_response_last_used ON response (last_used)')
+        # last_used is a counter rather than a time, so the order survives clock changes
+        self._clock, self._bytes, self._count = self._connection.execute(
+            'SELECT coalesce(max(last_used), 0), coalesce(sum(size), 0), count(*) FROM response').fetchone()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        # Bytes taken by the compressed values
+        return self._bytes
+
+    @staticmethod
+    def key(hashval, engine_key):
+        return '{}:{}'.format(hashval, engine_key)
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            self._connection.execute('UPDATE response SET last_used = ? WHERE key = ?', (self._clock, key))
+            return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, value):
+        data = zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+        with self._lock:
+            self._clock += 1
+            old = self._connection.execute('SELECT size FROM response WHERE key = ?', (key,)).fetchone()
+            self._connection.execute('INSERT OR REPLACE INTO response (key, value, size, last_used) '
+                                     'VALUES (?, ?, ?, ?)', (key, data, len(data), self._clock))
+            if old is None:
+                self._count += 1
+                self._bytes += len(data)
+            else:
+                self._bytes += len(data) - old[0]
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Down to 90% of max_bytes, so a full cache does not evict on every put
+        target = self.max_bytes * 9 // 10
+        evicted = []
+        cursor = self._connection.execute('SELECT key, size FROM response ORDER BY last_used')
+        for key, size in cursor:
+            if self._bytes <= target:
+                break
+            evicted.append((key,))
+            self._bytes -= size
+        cursor.close()
+        self._connection.executemany('DELETE FROM response WHERE key = ?', evicted)
+        self._count -= len(evicted)
+        self.evictions += len(evicted)
+        logger.debug('Evicted {} responses from {}'.format(len(evicted), self.path))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,19 +1,29 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
+import threading
 import traceback
 from requests.exceptions import ConnectionError
 from json.decoder import JSONDecodeError
 
+import requests
 import yaml
 from compreface import CompreFace
+from compreface.config.api_list import RECOGNIZE_API
 from compreface.collections import FaceCollection
 from compreface.collections.face_collections import Subjects
 from compreface.service import RecognitionService
 
 from tigertag.engine import Engine
 from tigertag.engine import TagInfo
-from tigertag.util import create_scaled_image
+from tigertag.util import ImageData
+from tigertag.util import scale_image
+from tigertag.util.aio import HttpSession
+from tigertag.util.aio import aiohttp
+from tigertag.util.retry import awith_tries
+from tigertag.util.retry import with_tries
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +41,8 @@ class ComprefaceEngine(Engine):
     def __init__(self, name, prefix, enabled, tries=5, min_confidence=MIN_CONFIDENCE):
         super().__init__(name, prefix, enabled)
         self.tries = tries
-        self.min_confidence = min_confidence
+        self.min_confidence = min_confidence  # replaced by the MIN_CONFIDENCE property, if set, on first use
+        self._min_confidence_resolved = False
         self.uploaded_faces = False
         self.faces_folder = None
         self.faces_config_file = None
@@ -42,6 +53,9 @@ class ComprefaceEngine(Engine):
         self.compre_recognition: RecognitionService = None
         self.compre_face_collection: FaceCollection = None
         self.compre_subjects: Subjects = None
+        self.faces_digest = None
+        self._faces_lock = threading.Lock()  # with a MAX_CONCURRENCY above 1, the first tags run at once
+        self.http = HttpSession()  # for atag
 
     def _setup_compre_api(self):
         if self.compre_api is None:
@@ -95,70 +109,154 @@ class ComprefaceEngine(Engine):
             'uploaded': uploaded,
         }
 
-    def tag(self, path: str, temp: str = None, ext_id: str = None):
-        tag_response: TagInfo = TagInfo(path, None)
-        try:
+    def _calc_faces_digest(self):
+        # Changes whenever faces.yaml or any of the face images it lists changes
+        h = hashlib.sha256()
+        faces_folder = self.get_prop('FACES_FOLDER')
+        faces_config_file = self.get_prop('FACES_CONFIG')
+        with open(faces_config_file, 'rb') as file:
+            config_bytes = file.read()
+        h.update(config_bytes)
+        for face in yaml.safe_load(config_bytes)['faces']:
+            for image in face['images']:
+                with open(os.path.normpath(os.path.join(faces_folder, image['name'])), 'rb') as image_file_obj:
+                    h.update(hashlib.sha256(image_file_obj.read()).digest())
+        return h.hexdigest()
+
+    def _resolve_min_confidence(self):
+        if not self._min_confidence_resolved:
+            self.min_confidence = float(self.get_prop('MIN_CONFIDENCE', self.min_confidence))
+            self._min_confidence_resolved = True
+
+    def threshold(self, raw_tags: dict) -> dict:
+        self._resolve_min_confidence()
+        tags = {}
+        for tag_name, tag_detail in raw_tags.items():
+            if tag_detail['confidence'] > self.min_confidence:
+                tags[tag_name] = tag_detail
+            else:
+                logger.debug(f'Ignoring {tag_name} tag due to {tag_detail["confidence"]} confidence which is '
+                             f'lower than {self.min_confidence}.')
+        return tags
+
+    def settings(self) -> dict:
+        if self.faces_digest is None:
+            self.faces_digest = self._calc_faces_digest()
+        return {
+            'faces': self.faces_digest,
+        }
+
+    def _upload_faces_once(self):
+        with self._faces_lock:
             if not self.uploaded_faces:
                 self.delete_all_faces()
                 self.upload_faces()
+
+    def _tag_info(self, path, tag_result):
+        if tag_result is not None and 'result' in tag_result:
+            # Every subject of every face, however unlikely, with its best similarity
+            raw_tags = {}
+            for result in tag_result['result']:
+                if 'subjects' in result:
+                    for subject in result['subjects']:
+                        new_tag = self.calc_tag_name(subject['subject'])
+                        confidence = subject['similarity'] * 100  # 0-100 instead of 0-1
+                        if new_tag not in raw_tags or confidence > raw_tags[new_tag]['confidence']:
+                            raw_tags[new_tag] = {
+                                'confidence': confidence
+                            }
+            return TagInfo(path, self.threshold(raw_tags), raw_tags)
+        if tag_result is not None and 'message' in tag_result and \
+                'no face is found' in tag_result['message'].lower():
+            return TagInfo(path, {}, {})
+        return TagInfo(path, None)
+
+    def _log_non_terminating(self, path, e: OSError):
+        # Broken images are logged and tagged with nothing instead of stopping the scan
+        if str(e).lower().startswith('image file is truncated') or \
+           str(e).lower().startswith('broken data stream'):
+            logger.error(
+                f'Non-terminating error.\nFailed to tag {path}.\n\n{e}\n{traceback.format_exc()}'
+            )
+        else:
+            raise e
+
+    def recognize(self, session: requests.Session, image_bytes: bytes):
+        # What compre_recognition.recognize returns, over the session
+        response = session.post(self.get_prop('API_URL') + ':' + self.get_prop('API_PORT') + RECOGNIZE_API,
+                                headers={'x-api-key': self.get_prop('API_KEY')},
+                                files={'file': ('image.jpg', image_bytes)})
+        return response.json()
+
+    def tag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None):
+        return self._tag(path, temp, ext_id, data,
+                         lambda image_bytes: self.compre_recognition.recognize(image_path=image_bytes))
+
+    def tag_batch(self, items: list) -> list:
+        # One session, so one kept-alive connection, for the whole batch.  The SDK opens one per image.
+        with requests.Session() as session:
+            return [self._tag(item.path, item.temp, item.ext_id, item.data,
+                              lambda image_bytes: self.recognize(session, image_bytes)) for item in items]
+
+    def _tag(self, path: str, temp: str, ext_id: str, data: ImageData, recognize):
+        tag_response: TagInfo = TagInfo(path, None)
+        try:
+            self._upload_faces_once()
             tag_path = path if temp is None else temp
 
             logger.info('Tagging {}'.format(tag_path))
-            scaled_image_path = create_scaled_image(tag_path, MAX_SHORT_SIDE)
-            tag_result = None
-            try:
-                # This call below can leave the file open if there is an exception - which will
-                # prevent the os.remove call from completing, throw an exception, and the application
-                # will stop.
-                # tag_result = self.compre_recognition.recognize(image_path=scaled_image_path)
-                image_bytes: bytes = None
-                with open(scaled_image_path, 'rb') as image_file_obj:
-                    image_bytes = image_file_obj.read()
-                attempt = 1
-                success = False
-                while attempt <= self.tries and not success:
-                    try:
-                        tag_result = self.compre_recognition.recognize(image_path=image_bytes)
-                        success = True
-                    except (JSONDecodeError, ConnectionError):
-                        logger.warning('Unable to tag {} try {} of {}.'.format(path, attempt, self.tries))
-                        attempt += 1
-                if attempt > self.tries:
-                    logger.warning('Failed to tag {} after {} tries.'.format(path, self.tries))
-            finally:
-                os.remove(scaled_image_path)
-
-            if tag_result is not None and 'result' in tag_result:
-                tags = {}
-                for result in tag_result['result']:
-                    if 'subjects' in result:
-                        for subject in result['subjects']:
-                            new_tag = self.calc_tag_name(subject['subject'])
-                            confidence = subject['similarity'] * 100  # 0-100 instead of 0-1
-                            if confidence > self.min_confidence:
-                                if new_tag in tags:
-                                    if confidence > tags[new_tag]['confidence']:
-                                        tags[new_tag]['confidence'] = confidence
-                                else:
-                                    tags[new_tag] = {
-                                        'confidence': confidence
-                                    }
-                            else:
-                                logger.debug(f'Ignoring {new_tag} tag due to {confidence} confidence which is '
-                                             f'lower than {self.min_confidence} for {path}.')
-                tag_response = TagInfo(path, tags)
+            if data is None:
+                with ImageData(tag_path) as image_data:
+                    image_bytes = scale_image(image_data, MAX_SHORT_SIDE)
             else:
-                if 'message' in tag_result and 'no face is found' in tag_result['message'].lower():
-                    tag_response = TagInfo(path, {})
+                image_bytes = scale_image(data, MAX_SHORT_SIDE)
+            try:
+                tag_result = with_tries(lambda: recognize(image_bytes), self.tries, 'tag {}'.format(path),
+                                        (JSONDecodeError, ConnectionError))
+            except (JSONDecodeError, ConnectionError):
+                tag_result = None
+            tag_response = self._tag_info(path, tag_result)
         except OSError as e:
-            if str(e).lower().startswith('image file is truncated') or \
-               str(e).lower().startswith('broken data stream'):
-                logger.error(
-                    f'Non-terminating error.\nFailed to tag {path}.\n\n{e}\n{traceback.format_exc()}'
-                )
-            else:
-                raise e
+            self._log_non_terminating(path, e)
 
         for listener in self.listeners:
             listener.on_tags(self, tag_response, ext_id)
         return tag_response
+
+    async def arecognize(self, session, image_bytes: bytes):
+        # What compre_recognition.recognize returns, over the HTTP session
+        form = aiohttp.FormData()
+        form.add_field('file', image_bytes, filename='image.jpg')
+        async with session.post(self.get_prop('API_URL') + ':' + self.get_prop('API_PORT') + RECOGNIZE_API,
+                                headers={'x-api-key': self.get_prop('API_KEY')}, data=form) as response:
+            return await response.json(content_type=None)
+
+    async def atag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None):
+        if aiohttp is None:
+            return await super().atag(path, temp, ext_id, data)
+        tag_response: TagInfo = TagInfo(path, None)
+        try:
+            # Uploading the faces goes through the sync SDK, once
+            if not self.uploaded_faces:
+                await asyncio.to_thread(self._upload_faces_once)
+            tag_path = path if temp is None else temp
+
+            logger.info('Tagging {}'.format(tag_path))
+            if data is None:
+                with await asyncio.to_thread(ImageData, tag_path) as image_data:
+                    image_bytes = await asyncio.to_thread(scale_image, image_data, MAX_SHORT_SIDE)
+            else:
+                image_bytes = await asyncio.to_thread(scale_image, data, MAX_SHORT_SIDE)
+            session = self.http.get()
+            try:
+                tag_result = await awith_tries(lambda: self.arecognize(session, image_bytes), self.tries,
+                                               'tag {}'.format(path), (JSONDecodeError, aiohttp.ClientError))
+            except (JSONDecodeError, aiohttp.ClientError):
+                tag_result = None
+            tag_response = self._tag_info(path, tag_result)
+        except OSError as e:
+            self._log_non_terminating(path, e)
+        return tag_response
+
+    async def aclose(self):
+        await self.http.close()
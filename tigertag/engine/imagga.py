@@ -1,8 +1,10 @@
 import argparse
+import asyncio
+import base64
+import json
 import logging
 import os
 import sys
-import time
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -13,11 +15,38 @@ from tigertag.engine import EngineListener
 from tigertag.engine import TagInfo
 from tigertag.scanner import ScannerListener
 from tigertag.scanner.directory import DirectoryScanner
-from tigertag.util import create_scaled_image
+from tigertag.util import ImageData
+from tigertag.util import scale_image
 from tigertag.util import str2bool
+from tigertag.util.aio import HttpSession
+from tigertag.util.aio import aiohttp
+from tigertag.util.retry import awith_tries
+from tigertag.util.retry import with_tries
 
 logger = logging.getLogger(__name__)
 MAX_SHORT_SIDE = 300
+RETRY_BACKOFF = 2  # seconds between tries, times the number of the failed try
+
+
+class NoResult(KeyError):
+    # Imagga answered without a result, which is worth another try
+    pass
+
+
+def _result(response, status, text, key=None):
+    # The JSON of a response with a result, and key in it when given.  The status is checked before the body
+    # is decoded, since a gateway timeout answers with an HTML page.
+    logger.debug(f'Response status: {status}')
+    if status == 504:
+        raise NoResult('gateway timeout in {}'.format(response))
+    try:
+        response_json = json.loads(text)
+    except ValueError:
+        raise NoResult('no JSON in {}'.format(response))
+    if not isinstance(response_json, dict) or 'result' not in response_json or \
+            (key is not None and key not in response_json['result']):
+        raise NoResult('result not found in {}'.format(response))
+    return response_json
 
 
 class ImaggaEngine(Engine):
@@ -26,56 +55,42 @@ class ImaggaEngine(Engine):
     def __init__(self, name, prefix, enabled, tries=5):
         super().__init__(name, prefix, enabled)
         self.tries = tries
-
-    def upload_image(self, auth, image_path):
-        upload_id = None
-        if not os.path.isfile(image_path):
-            raise ArgumentException(f'Invalid image path {image_path}')
-
-        scaled_image_path = create_scaled_image(image_path, MAX_SHORT_SIDE)
-
-        # Open the desired file
-        with open(scaled_image_path, 'rb') as image_file:
-            current_try = 1
-            success = False
-            while not success and current_try <= self.tries:
-                content_response = requests.post(
-                    '%s/uploads' % self.props['API_URL'],
-                    auth=auth,
-                    files={'image': image_file})
-
-                # Example /uploads response:
-                #    {
-                #      "result": {
-                #        "upload_id": "i05e132196706b94b1d85efb5f3SaM1j"
-                #      },
-                #      "status": {
-                #        "text": "",
-                #        "type": "success"
-                #      }
-                #    }
-                logger.debug(f'Response status: {content_response.status_code}')
-                if content_response.status_code == 504 or 'result' not in content_response.json():
-                    if current_try >= self.tries:
-                        logger.warning('Failed to upload {} as {} after {} tries.'.format(image_path, scaled_image_path, self.tries))
-                        raise KeyError('result not found in {}'.format(content_response))
-                    else:
-                        logger.warning('Unable to upload {} as {} try {} of {}.'.format(
-                            image_path, scaled_image_path, current_try, self.tries))
-                        time.sleep(current_try * 2)
-                        current_try = current_try + 1
-                else:
-                    logger.debug('Uploaded {} as {} after {} tries.'.format(
-                        image_path, scaled_image_path, current_try))
-                    success = True
-                    uploaded_file = content_response.json()['result']
-
-                    # Get the upload id of the uploaded file
-                    upload_id = uploaded_file['upload_id']
-        os.remove(scaled_image_path)
-        return upload_id
-
-    def imagga_tag_api(self, auth, image, upload_id=False, verbose=False, language='en'):
+        self.http = HttpSession()  # for atag
+
+    def upload_image(self, auth, image_path, image_data: ImageData = None, session=requests):
+        # session is a requests.Session to share across calls, or the requests module for none
+        if image_data is None:
+            if not os.path.isfile(image_path):
+                raise ArgumentException(f'Invalid image path {image_path}')
+            with ImageData(image_path) as image_data:
+                return self.upload_image(auth, image_path, image_data, session)
+
+        scaled_image = scale_image(image_data, MAX_SHORT_SIDE)
+        image_name = os.path.basename(image_path)
+
+        def attempt():
+            content_response = session.post(
+                '%s/uploads' % self.props['API_URL'],
+                auth=auth,
+                files={'image': (image_name, scaled_image)})
+
+            # Example /uploads response:
+            #    {
+            #      "result": {
+            #        "upload_id": "i05e132196706b94b1d85efb5f3SaM1j"
+            #      },
+            #      "status": {
+            #        "text": "",
+            #        "type": "success"
+            #      }
+            #    }
+            return _result(content_response, content_response.status_code, content_response.text)
+
+        # Get the upload id of the uploaded file
+        return with_tries(attempt, self.tries, 'upload {}'.format(image_path), NoResult,
+                          RETRY_BACKOFF)['result']['upload_id']
+
+    def imagga_tag_api(self, auth, image, upload_id=False, verbose=False, language='en', session=requests):
         # Using the content id and the content parameter,
         # make a GET request to the /tagging endpoint to get
         # image tags
@@ -84,34 +99,114 @@ class ImaggaEngine(Engine):
             'verbose': verbose,
             'language': language
         }
-        result = {}
-        current_try = 1
-        success = False
-        while not success and current_try <= self.tries:
-            tagging_response = requests.get(
+
+        def attempt():
+            tagging_response = session.get(
                 '%s/tags' % self.props['API_URL'],
                 auth=auth,
                 params=tagging_query
             )
+            return _result(tagging_response, tagging_response.status_code, tagging_response.text, 'tags')
+
+        return with_tries(attempt, self.tries, 'tag {}'.format(image), NoResult, RETRY_BACKOFF)
+
+    def imagga_tag_image(self, auth, image_path, image_data: ImageData = None, verbose=False, language='en',
+                         session=requests):
+        # POSTs the image straight to /tags, one request instead of an upload and a tag request, and
+        # nothing left on Imagga's side
+        if image_data is None:
+            if not os.path.isfile(image_path):
+                raise ArgumentException(f'Invalid image path {image_path}')
+            with ImageData(image_path) as image_data:
+                return self.imagga_tag_image(auth, image_path, image_data, verbose, language, session)
+
+        scaled_image = scale_image(image_data, MAX_SHORT_SIDE)
+        image_name = os.path.basename(image_path)
+        tagging_query = {
+            'verbose': verbose,
+            'language': language
+        }
 
-            logger.debug(f'Response status: {tagging_response.status_code}')
-            tagging_json = tagging_response.json()
-            if tagging_response.status_code == 504 or 'result' not in tagging_json or \
-                    'tags' not in tagging_json['result']:
-                if current_try >= self.tries:
-                    logger.warning('Failed to tag {} after {} tries.'.format(image, self.tries))
-                    raise KeyError('result not found in {}'.format(tagging_response))
-                else:
-                    logger.warning('Unable to tag {} try {} of {}.'.format(image, current_try, self.tries))
-                    time.sleep(current_try * 2)
-                    current_try += 1
-            else:
-                logger.debug('Tagged {} after {} tries.'.format(image, current_try))
-                success = True
-                result = tagging_json
-        return result
+        def attempt():
+            tagging_response = session.post(
+                '%s/tags' % self.props['API_URL'],
+                auth=auth,
+                params=tagging_query,
+                files={'image': (image_name, scaled_image)})
+            return _result(tagging_response, tagging_response.status_code, tagging_response.text, 'tags')
+
+        return with_tries(attempt, self.tries, 'tag {}'.format(image_path), NoResult, RETRY_BACKOFF)
+
+    async def aupload_image(self, session, headers, image_path, image_data: ImageData = None):
+        if image_data is None:
+            if not os.path.isfile(image_path):
+                raise ArgumentException(f'Invalid image path {image_path}')
+            with await asyncio.to_thread(ImageData, image_path) as image_data:
+                return await self.aupload_image(session, headers, image_path, image_data)
+
+        scaled_image = await asyncio.to_thread(scale_image, image_data, MAX_SHORT_SIDE)
+        image_name = os.path.basename(image_path)
+
+        async def attempt():
+            form = aiohttp.FormData()
+            form.add_field('image', scaled_image, filename=image_name)
+            async with session.post('%s/uploads' % self.props['API_URL'], headers=headers,
+                                    data=form) as content_response:
+                return _result(content_response, content_response.status, await content_response.text())
+
+        content_json = await awith_tries(attempt, self.tries, 'upload {}'.format(image_path), NoResult,
+                                         RETRY_BACKOFF)
+        return content_json['result']['upload_id']
+
+    async def aimagga_tag_api(self, session, headers, image, upload_id=False, verbose=False, language='en'):
+        tagging_query = {
+            'image_upload_id' if upload_id else 'image_url': image,
+            'verbose': str(verbose),
+            'language': language
+        }
+
+        async def attempt():
+            async with session.get('%s/tags' % self.props['API_URL'], headers=headers,
+                                   params=tagging_query) as tagging_response:
+                return _result(tagging_response, tagging_response.status, await tagging_response.text(), 'tags')
+
+        return await awith_tries(attempt, self.tries, 'tag {}'.format(image), NoResult, RETRY_BACKOFF)
+
+    async def aimagga_tag_image(self, session, headers, image_path, image_data: ImageData = None, verbose=False,
+                                language='en'):
+        if image_data is None:
+            if not os.path.isfile(image_path):
+                raise ArgumentException(f'Invalid image path {image_path}')
+            with await asyncio.to_thread(ImageData, image_path) as image_data:
+                return await self.aimagga_tag_image(session, headers, image_path, image_data, verbose, language)
+
+        scaled_image = await asyncio.to_thread(scale_image, image_data, MAX_SHORT_SIDE)
+        image_name = os.path.basename(image_path)
+        tagging_query = {
+            'verbose': str(verbose),
+            'language': language
+        }
 
-    def tag(self, path: str, temp: str = None, ext_id: str = None):
+        async def attempt():
+            form = aiohttp.FormData()
+            form.add_field('image', scaled_image, filename=image_name)
+            async with session.post('%s/tags' % self.props['API_URL'], headers=headers, params=tagging_query,
+                                    data=form) as tagging_response:
+                return _result(tagging_response, tagging_response.status, await tagging_response.text(), 'tags')
+
+        return await awith_tries(attempt, self.tries, 'tag {}'.format(image_path), NoResult, RETRY_BACKOFF)
+
+    def single_request(self) -> bool:
+        # The SINGLE_REQUEST prop, default True.  False goes back to /uploads then /tags with the upload id.
+        return str2bool(self.props.get('SINGLE_REQUEST', 'True'))
+
+    def settings(self) -> dict:
+        return {
+            'language': 'en' if 'LANGUAGE' not in self.props else self.props['LANGUAGE'],
+            'verbose': False if 'VERBOSE' not in self.props else str2bool(self.props['VERBOSE']),
+        }
+
+    def tag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None):
         tag_path = path if temp is None else temp
         if 'API_KEY' not in self.props or 'API_SECRET' not in self.props:
             raise ArgumentException('You haven\'t set your API credentials.')
@@ -122,10 +217,75 @@ class ImaggaEngine(Engine):
         verbose = False if 'VERBOSE' not in self.props else str2bool(self.props['VERBOSE'])
 
         logger.info('Tagging {}'.format(tag_path))
-        upload_id = self.upload_image(auth, tag_path)
-        tag_result = self.imagga_tag_api(auth, upload_id, True, verbose, language)
+        if self.single_request():
+            tag_result = self.imagga_tag_image(auth, tag_path, data, verbose, language)
+        else:
+            upload_id = self.upload_image(auth, tag_path, data)
+            tag_result = self.imagga_tag_api(auth, upload_id, True, verbose, language)
+
+        tag_response = self._tag_info(path, tag_result)
+        for listener in self.listeners:
+            listener.on_tags(self, tag_response, ext_id)
+        return tag_response
+
+    def tag_batch(self, items: list) -> list:
+        # One session, so one kept-alive connection, for the batch.  Without SINGLE_REQUEST, every image of
+        # the batch is uploaded before the first /tags request, so Imagga works on them meanwhile.
+        if 'API_KEY' not in self.props or 'API_SECRET' not in self.props:
+            raise ArgumentException('You haven\'t set your API credentials.')
 
-        tag_response: TagInfo = TagInfo(path, None)
+        auth = HTTPBasicAuth(self.props['API_KEY'], self.props['API_SECRET'])
+        settings = self.settings()
+
+        tag_paths = [item.path if item.temp is None else item.temp for item in items]
+        for tag_path in tag_paths:
+            logger.info('Tagging {}'.format(tag_path))
+        with requests.Session() as session:
+            if self.single_request():
+                tag_results = [self.imagga_tag_image(auth, tag_path, item.data, settings['verbose'],
+                                                     settings['language'], session)
+                               for item, tag_path in zip(items, tag_paths)]
+            else:
+                upload_ids = [self.upload_image(auth, tag_path, item.data, session)
+                              for item, tag_path in zip(items, tag_paths)]
+                tag_results = [self.imagga_tag_api(auth, upload_id, True, settings['verbose'], settings['language'],
+                                                   session)
+                               for upload_id in upload_ids]
+
+        tag_responses = []
+        for item, tag_result in zip(items, tag_results):
+            tag_response = self._tag_info(item.path, tag_result)
+            for listener in self.listeners:
+                listener.on_tags(self, tag_response, item.ext_id)
+            tag_responses.append(tag_response)
+        return tag_responses
+
+    async def atag(self, path: str, temp: str = None, ext_id: str = None, data: ImageData = None):
+        if aiohttp is None:
+            return await super().atag(path, temp, ext_id, data)
+        tag_path = path if temp is None else temp
+        if 'API_KEY' not in self.props or 'API_SECRET' not in self.props:
+            raise ArgumentException('You haven\'t set your API credentials.')
+
+        credentials = '{}:{}'.format(self.props['API_KEY'], self.props['API_SECRET']).encode('utf-8')
+        headers = {'Authorization': 'Basic ' + base64.b64encode(credentials).decode('ascii')}
+        settings = self.settings()
+
+        logger.info('Tagging {}'.format(tag_path))
+        session = self.http.get()
+        if self.single_request():
+            tag_result = await self.aimagga_tag_image(session, headers, tag_path, data, settings['verbose'],
+                                                      settings['language'])
+        else:
+            upload_id = await self.aupload_image(session, headers, tag_path, data)
+            tag_result = await self.aimagga_tag_api(session, headers, upload_id, True, settings['verbose'],
+                                                    settings['language'])
+        return self._tag_info(path, tag_result)
+
+    async def aclose(self):
+        await self.http.close()
+
+    def _tag_info(self, path, tag_result):
         if 'result' in tag_result and 'tags' in tag_result['result']:
             tags = {}
             for tag_item in tag_result['result']['tags']:
@@ -133,11 +293,8 @@ class ImaggaEngine(Engine):
                 tags[new_tag] = {
                     'confidence': tag_item['confidence']
                 }
-            tag_response = TagInfo(path, tags)
-
-        for listener in self.listeners:
-            listener.on_tags(self, tag_response, ext_id)
-        return tag_response
+            return TagInfo(path, self.threshold(tags), tags)
+        return TagInfo(path, None)
 
 
 def parse_arguments():
@@ -194,7 +351,7 @@ def main():
     s = DirectoryScanner('directory_scanner', True)
     s.props['PATH'] = args.input[0]
     sl = ScannerListener()
-    sl.on_file = lambda scanner, file_info: en.tag(file_info.path)
+    sl.on_file = lambda scanner, file_info: en.tag(file_info.path, data=file_info.data)
     s.listeners.append(sl)
 
     logger.info('Tagging images started')
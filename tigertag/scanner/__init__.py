@@ -1,6 +1,7 @@
 import logging
 import os
 import re
+import threading
 
 from collections import namedtuple
 from tigertag import Pluggable
@@ -8,7 +9,9 @@ from tigertag.util import str2bool
 
 logger = logging.getLogger(__name__)
 
-FileInfo = namedtuple('FileInfo', 'name path hash temp ext_id')
+# data is the ImageData already read by the scanner, if any.  The scanner closes it once the listeners return.
+FileInfo = namedtuple('FileInfo', 'name path hash temp ext_id size mtime_ns inode data',
+                      defaults=(None, None, None, None))
 
 
 class Scanner(Pluggable):
@@ -19,20 +22,31 @@ class Scanner(Pluggable):
         self.enabled = enabled
         self.props = {}
         self.listeners = []  # ScannerListeners
+        self.persist = None  # Persist, used to look up what is already known about a file
 
     def scan(self):
         raise NotImplementedError('The {} scanner has not implemented the scan method.'.format(self.name))
 
+    def watches(self):
+        return str2bool(self.get_prop('WATCH', 'False'))
+
+    def watch(self, stop_event: threading.Event = None):
+        raise NotImplementedError('The {} scanner has not implemented the watch method.'.format(self.name))
+
 
 class ScannerListener:
     def on_file(self, scanner: Scanner, file_info: FileInfo):
         pass
 
+    def on_delete(self, scanner: Scanner, path: str):
+        pass
+
 
 class ScannerManager:
     def __init__(self):
         self.scanners = {}
         self.listeners = []  # ScannerListener array
+        self.persist = None
 
     def add(self, scanner):
         self.scanners[scanner.name] = scanner
@@ -45,8 +59,29 @@ class ScannerManager:
                 scanner.listeners = []
                 for scanner_listener in self.listeners:
                     scanner.listeners.append(scanner_listener)
+                scanner.persist = self.persist
                 scanner.scan()
 
+    def watch(self, stop_event: threading.Event = None):
+        # Blocks until stop_event is set.  Call scan first so anything changed while not watching is picked up.
+        watchers = [scanner for scanner in self.scanners.values() if scanner.enabled and scanner.watches()]
+        if len(watchers) == 0:
+            logger.warning('No scanners configured to watch.  Please check your configuration')
+            return
+        for scanner in watchers:
+            scanner.listeners = list(self.listeners)
+            scanner.persist = self.persist
+        if len(watchers) == 1:
+            watchers[0].watch(stop_event)
+            return
+        threads = []
+        for scanner in watchers:
+            thread = threading.Thread(target=scanner.watch, args=(stop_event,), name=scanner.name, daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
 
 class ScannerManagerBuilder:
     def __init__(self, scanner_manager_klass):
@@ -1,35 +1,268 @@
-import imghdr
+import hashlib
 import logging
 import os
+import sys
+import threading
+import time
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 
+from tigertag.db import RESCAN
 from tigertag.scanner import Scanner
 from tigertag.scanner import FileInfo
-from tigertag.util import calc_hash
+from tigertag.scanner import inotify
+from tigertag.util import ImageData
+from tigertag.util import str2bool
 
 logger = logging.getLogger(__name__)
 
+WATCH_MASK = inotify.IN_CREATE | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | \
+    inotify.IN_DELETE | inotify.IN_ONLYDIR
+
+# location always ends with a path separator, so it can be used as a prefix of the locations inside it
+DirectorySnapshot = namedtuple('DirectorySnapshot', 'location mtime_ns entry_count digest')
+
 
 class DirectoryScanner(Scanner):
     def __init__(self, name, enabled):
         super().__init__(name, enabled)
         self.path = None
 
-    def scan(self):
+    def _known_hash(self, path, stat):
+        # FAST mode trusts the stored hash when size, mtime and inode have not changed since it was calculated
+        if self.persist is None:
+            return None
+        resource = self.persist.lookup_resource(path)
+        if resource is None or resource['hashval'] == RESCAN:
+            return None
+        if (resource['size'], resource['mtime_ns'], resource['inode']) == \
+                (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return resource['hashval']
+        return None
+
+    @staticmethod
+    def _snapshot(directory, entries):
+        digest = hashlib.sha256()
+        for entry in entries:
+            digest.update(entry.name.encode('utf-8', 'surrogateescape'))
+            digest.update(b'\0')
+        return DirectorySnapshot(
+            os.path.join(directory, ''),
+            os.stat(directory).st_mtime_ns,
+            len(entries),
+            digest.hexdigest())
+
+    def _unchanged(self, snapshot):
+        stored = self.persist.get_directory(snapshot.location)
+        return stored is not None and \
+            (stored['mtime_ns'], stored['entry_count'], stored['digest']) == \
+            (snapshot.mtime_ns, snapshot.entry_count, snapshot.digest)
+
+    def _candidates(self, fast, deep_verify, incremental):
+        # Runs on the scanning thread, so any persist lookups stay on a single thread.  Yields the files
+        # to examine, followed by the DirectorySnapshot of their directory once they have all been yielded.
+        incremental = incremental and not deep_verify and self.persist is not None
+        directories = [self.path]
+        while directories:
+            directory = directories.pop()
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.name)
+            subdirectories = []
+            files = []
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                else:
+                    files.append(entry)
+            # Depth first in name order, the same order os.walk would use with sorted names
+            directories.extend(reversed(subdirectories))
+
+            snapshot = None
+            if incremental:
+                snapshot = self._snapshot(directory, entries)
+                if self._unchanged(snapshot):
+                    logger.debug('Directory unchanged {}'.format(directory))
+                    continue
+
+            for entry in files:
+                full_filename = os.path.normpath(entry.path)
+                stat = entry.stat()
+                file_hash = None
+                if fast and not deep_verify:
+                    file_hash = self._known_hash(full_filename, stat)
+                yield entry.name, full_filename, stat, file_hash
+            if snapshot is not None:
+                yield snapshot
+
+    @staticmethod
+    def _examine(filename, full_filename, stat, file_hash):
+        # Safe to run on a worker thread
+        image_data = None
+        if file_hash is not None:
+            logger.debug('Unchanged {}'.format(full_filename))
+        else:
+            image_data = ImageData(full_filename)
+            if image_data.what() is None:
+                logger.debug('Ignoring {}'.format(full_filename))
+                image_data.close()
+                return None
+            logger.info('Scanning {}'.format(full_filename))
+            file_hash = image_data.hash()
+        return FileInfo(filename, full_filename, file_hash, None, None,
+                        stat.st_size, stat.st_mtime_ns, stat.st_ino, image_data)
+
+    def _notify(self, file_info):
+        if file_info is not None:
+            try:
+                for listener in self.listeners:
+                    listener.on_file(self, file_info)
+            finally:
+                if file_info.data is not None:
+                    file_info.data.close()
+
+    def _deliver(self, item):
+        if isinstance(item, DirectorySnapshot):
+            # Every file of the directory has been through the listeners by now
+            self.persist.set_directory(*item)
+        elif isinstance(item, Future):
+            self._notify(item.result())
+        else:
+            self._notify(self._examine(*item))
+
+    def _setup_path(self):
         if self.path is None and 'PATH' in self.props:
             self.path = self.props['PATH']
         if self.path is None:
             raise ValueError('The path has not been set for the {} ({}.{})'.format(
                 self.name, __name__, type(self).__name__))
         self.path = os.path.abspath(self.path)
-        for root, directories, filenames in os.walk(self.path):
-            for filename in filenames:
-                full_filename = os.path.normpath(os.path.join(root, filename))
-                image_type = imghdr.what(full_filename)
-                if image_type is None:
-                    logger.debug('Ignoring {}'.format(full_filename))
-                else:
-                    logger.info('Scanning {}'.format(full_filename))
-                    file_hash = calc_hash(full_filename)
-                    file_info = FileInfo(filename, full_filename, file_hash, None, None)
-                    for listener in self.listeners:
-                        listener.on_file(self, file_info)
+
+    def scan(self):
+        self._setup_path()
+        fast = str2bool(self.get_prop('FAST', 'False'))
+        deep_verify = str2bool(self.get_prop('DEEP_VERIFY', 'False'))
+        incremental = str2bool(self.get_prop('INCREMENTAL', 'False'))
+        workers = int(self.get_prop('WORKERS', 1))
+        if (fast or incremental) and deep_verify:
+            logger.info('Deep verify requested.  Hashing every file under {}'.format(self.path))
+
+        if workers <= 1:
+            for item in self._candidates(fast, deep_verify, incremental):
+                self._deliver(item)
+            return
+
+        # Files are sniffed and hashed on the pool, but listeners are still called from this thread
+        # in walk order.  MAX_IN_FLIGHT bounds how far the pool may run ahead of the listeners.
+        max_in_flight = max(int(self.get_prop('MAX_IN_FLIGHT', workers * 4)), 1)
+        logger.debug('Scanning {} with {} workers and at most {} files in flight'.format(
+            self.path, workers, max_in_flight))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=self.name) as executor:
+            for item in self._candidates(fast, deep_verify, incremental):
+                if not isinstance(item, DirectorySnapshot):
+                    item = executor.submit(self._examine, *item)
+                pending.append(item)
+                if len(pending) >= max_in_flight:
+                    self._deliver(pending.popleft())
+            while pending:
+                self._deliver(pending.popleft())
+
+    def _add_watches(self, notifier, watched, directory, changed):
+        # Watch directory and everything below it.  Files already inside a directory that was just
+        # created or moved in never raise their own events, so they are marked as changed here.
+        for root, directories, filenames in os.walk(directory):
+            try:
+                watched[notifier.add_watch(root, WATCH_MASK)] = root
+            except OSError as e:
+                logger.warning('Unable to watch {}: {}'.format(root, e))
+            if changed is not None:
+                for filename in filenames:
+                    changed[os.path.normpath(os.path.join(root, filename))] = True
+
+    @staticmethod
+    def _remove_watches(notifier, watched, directory):
+        prefix = os.path.join(directory, '')
+        for wd, watched_directory in list(watched.items()):
+            if watched_directory == directory or watched_directory.startswith(prefix):
+                notifier.rm_watch(wd)
+                del watched[wd]
+
+    def _mark_removed(self, directory, changed):
+        # A directory deleted or moved out of the tree takes its files with it, without an event for each
+        # of them.  The files known below it are reported as removed, unless they show up again.
+        prefix = os.path.join(directory, '')
+        removed = [path for path in changed if path.startswith(prefix)]
+        if self.persist is not None:
+            removed.extend(self.persist.get_locations_under(prefix))
+        for path in removed:
+            changed[path] = False
+
+    def _flush(self, changed):
+        for path in sorted(changed):
+            if changed[path] and os.path.isfile(path):
+                try:
+                    file_info = self._examine(os.path.basename(path), path, os.stat(path), None)
+                except OSError as e:
+                    logger.warning('Unable to scan {}: {}'.format(path, e))
+                    continue
+                self._notify(file_info)
+            elif not os.path.exists(path):
+                logger.info('Removed {}'.format(path))
+                for listener in self.listeners:
+                    listener.on_delete(self, path)
+        changed.clear()
+        if self.persist is not None:
+            # Do not leave the writes of this batch of changes waiting for the next one
+            self.persist.flush()
+
+    def watch(self, stop_event: threading.Event = None):
+        if not sys.platform.startswith('linux'):
+            raise NotImplementedError('The {} scanner can only watch for changes on Linux.'.format(self.name))
+        self._setup_path()
+        # Events are collected until nothing has happened for WATCH_SETTLE seconds (or WATCH_MAX_DELAY
+        # seconds have gone by), so a burst of writes to the same file only reaches the listeners once.
+        settle = float(self.get_prop('WATCH_SETTLE', 2))
+        max_delay = float(self.get_prop('WATCH_MAX_DELAY', 30))
+        changed = {}  # path -> True when changed, False when removed
+        first_change = None
+        with inotify.Inotify() as notifier:
+            watched = {}  # watch descriptor -> directory
+            self._add_watches(notifier, watched, self.path, None)
+            logger.info('Watching {} directories under {}'.format(len(watched), self.path))
+            while stop_event is None or not stop_event.is_set():
+                events = notifier.read_events(settle if changed else 1)
+                for event in events:
+                    if event.mask & inotify.IN_Q_OVERFLOW:
+                        logger.warning('Too many changes under {} to track.  Scanning everything.'.format(self.path))
+                        changed.clear()
+                        self.scan()
+                        if self.persist is not None:
+                            self.persist.flush()
+                        continue
+                    directory = watched.get(event.wd)
+                    if event.mask & inotify.IN_IGNORED:
+                        watched.pop(event.wd, None)
+                        continue
+                    if directory is None or not event.name:
+                        continue
+                    path = os.path.normpath(os.path.join(directory, event.name))
+                    if event.mask & inotify.IN_ISDIR:
+                        if event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                            self._add_watches(notifier, watched, path, changed)
+                        else:
+                            self._remove_watches(notifier, watched, path)
+                            self._mark_removed(path, changed)
+                    elif event.mask & (inotify.IN_CREATE | inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                        changed[path] = True
+                    else:
+                        changed[path] = False
+                if changed:
+                    now = time.monotonic()
+                    if first_change is None:
+                        first_change = now
+                    if not events or now - first_change >= max_delay:
+                        self._flush(changed)
+                        first_change = None
@@ -1,4 +1,3 @@
-import imghdr
 import logging
 import os
 import tempfile
@@ -7,7 +6,7 @@ from plexapi.server import PlexServer
 
 from tigertag.scanner import FileInfo
 from tigertag.scanner import Scanner
-from tigertag.util import calc_hash
+from tigertag.util import ImageData
 
 logger = logging.getLogger(__name__)
 DEFAULT_URL = 'http://127.0.0.1:32400'
@@ -48,14 +47,17 @@ class PlexScanner(Scanner):
                 temp_photo_path = temp_photos[0]
                 filename = os.path.basename(path)
 
-                image_type = imghdr.what(temp_photo_path)
-                if image_type is None:
-                    logger.debug('Ignoring {} temporarily at {}'.format(path, temp_photo_path))
-                else:
-                    logger.info('Scanning {} temporarily at {}'.format(path, temp_photo_path))
-                    file_hash = calc_hash(temp_photo_path)
-                    file_info = FileInfo(filename, path, file_hash, temp_photo_path, ext_id)
-                    for listener in self.listeners:
-                        listener.on_file(self, file_info)
-                        if os.path.exists(temp_photo_path):
-                            os.remove(temp_photo_path)
+                image_data = ImageData(temp_photo_path)
+                try:
+                    if image_data.what() is None:
+                        logger.debug('Ignoring {} temporarily at {}'.format(path, temp_photo_path))
+                    else:
+                        logger.info('Scanning {} temporarily at {}'.format(path, temp_photo_path))
+                        file_hash = image_data.hash()
+                        file_info = FileInfo(filename, path, file_hash, temp_photo_path, ext_id, data=image_data)
+                        for listener in self.listeners:
+                            listener.on_file(self, file_info)
+                finally:
+                    image_data.close()
+                    if os.path.exists(temp_photo_path):
+                        os.remove(temp_photo_path)
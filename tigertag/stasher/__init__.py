@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import re
@@ -20,6 +21,18 @@ class Stasher(Pluggable):
     def stash(self, engine: Engine, path: str, tags: dict, ext_id: str):
         raise NotImplementedError('The {} stasher has not implemented the stash method.'.format(self.name))
 
+    async def astash(self, engine: Engine, path: str, tags: dict, ext_id: str):
+        # stash for asyncio.  Stashers with an async client override it, the others run stash on a thread.
+        await asyncio.to_thread(self.stash, engine, path, tags, ext_id)
+
+    async def aclose(self):
+        pass
+
+    def find_ext_id(self, path: str):
+        # The ext_id a scanner of this stasher's system would give path, or None.  Lets tags kept in the
+        # database be stashed again without scanning.
+        return None
+
 
 class StasherManager:
     def __init__(self):
@@ -35,6 +48,29 @@ class StasherManager:
             if stasher.enabled:
                 stasher.stash(engine, path, tags, ext_id)
 
+    async def astash(self, engine: Engine, path: str, tags: dict, ext_id: str):
+        # The stashers run at the same time.  Like stash, a stasher that fails raises once they are all done.
+        if len(self.stashers) == 0:
+            logger.warning('No stashers configured.  Please check your configuration')
+        results = await asyncio.gather(*[stasher.astash(engine, path, tags, ext_id)
+                                         for stasher in self.stashers.values() if stasher.enabled],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def aclose(self):
+        for stasher in self.stashers.values():
+            await stasher.aclose()
+
+    def find_ext_id(self, path: str):
+        for stasher in self.stashers.values():
+            if stasher.enabled:
+                ext_id = stasher.find_ext_id(path)
+                if ext_id is not None:
+                    return ext_id
+        return None
+
 
 class StasherManagerBuilder:
     def __init__(self, stasher_manager_klass):
@@ -33,6 +33,17 @@ class PlexStasher(Stasher):
         self.plex = None
         self.url = DEFAULT_URL
         self.connected = False
+        self.ext_ids = None  # location -> ratingKey of every photo in the section, loaded on first use
+
+    def find_ext_id(self, path: str):
+        if self.ext_ids is None:
+            if not self.connected:
+                self.connect()
+            self.ext_ids = {}
+            for album in self.plex.library.section(self.section).all():
+                for photo in album.photos():
+                    self.ext_ids[photo.locations[0]] = photo.ratingKey
+        return self.ext_ids.get(path)
 
     def stash(self, engine: Engine, path: str, tags: dict, ext_id: str):
         # currently only the plex scanner sets an ext_id
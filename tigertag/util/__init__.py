@@ -1,13 +1,20 @@
 import hashlib
+import imghdr
+import io
 import logging
+import mmap
 import os
-import shutil
 import tempfile
+import threading
 
 from PIL import Image
 
 logger = logging.getLogger(__name__)
 
+HASH_CHUNK_SIZE = 1024 * 1024
+HEADER_SIZE = 32  # what imghdr needs to tell the image types apart
+MMAP_THRESHOLD = 16 * 1024 * 1024  # files at least this big are mapped instead of read into memory
+
 
 def str2bool(v):
     return str(v).lower() in ("yes", "true", "t", "1")
@@ -17,51 +24,157 @@ def calc_hash(file_path):
     h = hashlib.sha256()
     with open(file_path, 'rb') as file:
         while True:
-            # Reading is buffered, so we can read smaller chunks.
-            chunk = file.read(h.block_size)
+            # Large chunks keep the loop overhead down and let hashlib release the GIL while it works,
+            # so several scanner threads can hash at once.
+            chunk = file.read(HASH_CHUNK_SIZE)
             if not chunk:
                 break
             h.update(chunk)
     return h.hexdigest()
 
 
-def create_temporary_copy(image_path):
-    root, ext = os.path.splitext(image_path)
-    tmp = tempfile.NamedTemporaryFile(suffix=ext, delete=True)
-    tmp.close()
-    shutil.copy2(image_path, tmp.name)
-    return tmp.name
+class ImageData:
+    # The bytes of one file, read from disk once and shared by the type sniffer, the hasher,
+    # Pillow and the engine uploads.  Only the header of a file that is not an image is read, unless
+    # its bytes are asked for.
+    def __init__(self, path, mmap_threshold=MMAP_THRESHOLD):
+        self.path = path
+        self.buffer = None
+        self._hash = None
+        self._dhash = None
+        self._image = None
+        self._image_lock = threading.Lock()
+        self._refs = 1  # close only releases the bytes once everyone that called keep has closed too
+        self.mmap_threshold = mmap_threshold
+        with open(path, 'rb') as file:
+            self._size = os.fstat(file.fileno()).st_size
+            self._header = file.read(HEADER_SIZE)
+            if imghdr.what(None, h=self._header) is not None:
+                self._read(file)
 
+    def _read(self, file):
+        if self._size > 0 and self._size >= self.mmap_threshold:
+            # Only the pages that are actually touched get read
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            file.seek(0)
+            self.buffer = file.read()
 
-def create_scaled_image(image_path, max_short_side):
+    def _body(self):
+        if self.buffer is None:
+            with open(self.path, 'rb') as file:
+                self._read(file)
+        return self.buffer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def size(self):
+        return self._size
+
+    def what(self):
+        return imghdr.what(None, h=self._header)
+
+    def hash(self):
+        if self._hash is None:
+            self._hash = hashlib.sha256(self._body()).hexdigest()
+        return self._hash
+
+    def image(self):
+        # Decoded once and shared, so treat the result as read only
+        with self._image_lock:
+            if self._image is None:
+                self._image = Image.open(io.BytesIO(self._body()))
+                self._image.load()
+            return self._image
+
+    def dhash(self):
+        if self._dhash is None:
+            self._dhash = dhash(self.image())
+        return self._dhash
+
+    def release_image(self):
+        # Drops the decoded image, for data that waits in a queue before anything needs it again
+        with self._image_lock:
+            image, self._image = self._image, None
+        if image is not None:
+            image.close()
+
+    def bytes(self):
+        return bytes(self._body())
+
+    def keep(self):
+        # For a consumer that uses the data after its owner closes it, like a later stage of a pipeline
+        with self._image_lock:
+            self._refs += 1
+        return self
+
+    def close(self):
+        with self._image_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = None
+
+
+def dhash(image, hash_size=8):
+    # Difference hash: one bit per pair of neighbouring pixels of a tiny grey copy, set when the left
+    # one is brighter.  Resizing, recompressing and small edits leave most of the bits alone.
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = small.tobytes()  # one byte per pixel, row by row
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return '{:0{}x}'.format(value, hash_size * hash_size // 4)
+
+
+def _scaled_size(width, height, max_short_side):
     # https://docs.imagga.com/#color-palette-deterministic
     # The API doesn't need more that 300px on the shortest side to provide you
     # with the same great results.
-    result = None
-    need_scale = False
-    old_bytes = os.stat(image_path).st_size
-    with Image.open(image_path) as img:
-        width, height = img.size
-        if width < height and width > max_short_side:
-            new_width = max_short_side
-            percent = new_width/width
-            new_height = int((float(height) * float(percent)))
-            need_scale = True
-        elif width > height and height > max_short_side:
-            new_height = max_short_side
-            percent = new_height / height
-            new_width = int((float(width) * float(percent)))
-            need_scale = True
-
-        scaled_image_path = create_temporary_copy(image_path)
-        if need_scale:
-            img = img.resize((new_width, new_height), Image.ANTIALIAS)
-            img.save(scaled_image_path)
-            new_bytes = os.stat(scaled_image_path).st_size
-            logger.debug(f'Resizing {image_path} as {scaled_image_path} from '
-                         f'({width},{height}) to ({new_width},{new_height}) with old/new bytes '
-                         f'{old_bytes}/{new_bytes}.')
-        else:
-            logger.debug(f'Using original {image_path} as {scaled_image_path} '
-                         f'({width},{height}) with {old_bytes} bytes.')
-        return scaled_image_path
\ No newline at end of file
+    if width < height and width > max_short_side:
+        new_width = max_short_side
+        percent = new_width/width
+        new_height = int((float(height) * float(percent)))
+        return new_width, new_height
+    elif width > height and height > max_short_side:
+        new_height = max_short_side
+        percent = new_height / height
+        new_width = int((float(width) * float(percent)))
+        return new_width, new_height
+    return None
+
+
+def scale_image(image_data: ImageData, max_short_side):
+    img = image_data.image()
+    width, height = img.size
+    new_size = _scaled_size(width, height, max_short_side)
+    if new_size is None:
+        logger.debug(f'Using original {image_data.path} ({width},{height}) with {image_data.size} bytes.')
+        return image_data.bytes()
+    scaled = img.resize(new_size, Image.LANCZOS)
+    out = io.BytesIO()
+    scaled.save(out, format=img.format)
+    logger.debug(f'Resizing {image_data.path} from ({width},{height}) to {new_size} with old/new bytes '
+                 f'{image_data.size}/{out.tell()}.')
+    return out.getvalue()
+
+
+def create_scaled_image(image_path, max_short_side):
+    with ImageData(image_path) as image_data:
+        scaled_bytes = scale_image(image_data, max_short_side)
+    root, ext = os.path.splitext(image_path)
+    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
+        tmp.write(scaled_bytes)
+    return tmp.name
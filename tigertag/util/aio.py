@@ -0,0 +1,28 @@
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:  # the async methods then run the sync ones on threads
+    aiohttp = None
+
+
+class HttpSession:
+    # An aiohttp session, and so a pool of keep-alive connections, for the event loop running.  A session
+    # belongs to the loop it was opened on, so another loop, like another asyncio.run, gets a new one.
+    def __init__(self, limit=100):
+        self.limit = limit  # connections open at once
+        self._session = None
+        self._loop = None
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit))
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and self._loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+        self._loop = None
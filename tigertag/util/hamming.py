@@ -0,0 +1,60 @@
+class HammingIndex:
+    # Multi-index hashing.  The bits are split into max_distance + 1 chunks, so two hashes within
+    # max_distance of each other must agree exactly on at least one chunk (pigeonhole).  A lookup only
+    # compares the hashes that share a chunk with the query, instead of every hash like a scan would.
+    # A BK-tree does the same job, but visits most of its nodes once the distance goes above a few
+    # bits, see benchmarks/hamming_index.py.
+    def __init__(self, max_distance, bits=64):
+        if max_distance < 0 or max_distance >= bits:
+            raise ValueError('The maximum distance must be between 0 and {}, not {}'.format(bits - 1, max_distance))
+        self.max_distance = max_distance
+        self.bits = bits
+        count = max_distance + 1
+        self._chunks = []  # (shift, mask) of each chunk
+        shift = 0
+        for i in range(count):
+            width = bits // count + (1 if i < bits % count else 0)
+            self._chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._chunks]  # chunk value -> values
+        self._hashes = {}  # value -> hash
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, value):
+        return value in self._hashes
+
+    def add(self, value, hash_value):
+        # Replaces the hash the value had before.  The stale table entries are skipped by find.
+        if self._hashes.get(value) == hash_value:
+            return
+        self._hashes[value] = hash_value
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            table.setdefault((hash_value >> shift) & mask, []).append(value)
+
+    def discard(self, value):
+        self._hashes.pop(value, None)
+
+    def find(self, hash_value, distance=None):
+        # [(distance, value)] of every value within distance of hash_value, nearest first
+        if distance is None:
+            distance = self.max_distance
+        elif distance > self.max_distance:
+            raise ValueError('The index only supports distances up to {}, not {}'.format(
+                self.max_distance, distance))
+        seen = set()
+        results = []
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            for value in table.get((hash_value >> shift) & mask, ()):
+                if value in seen:
+                    continue
+                stored = self._hashes.get(value)
+                if stored is None or (stored >> shift) & mask != (hash_value >> shift) & mask:
+                    continue  # discarded, or replaced by a hash that no longer shares this chunk
+                seen.add(value)
+                d = (stored ^ hash_value).bit_count()
+                if d <= distance:
+                    results.append((d, value))
+        results.sort(key=lambda result: result[0])
+        return results
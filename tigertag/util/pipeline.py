@@ -0,0 +1,189 @@
+import asyncio
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+StageMetrics = namedtuple('StageMetrics', 'name workers depth max_depth processed errors busy waited')
+_STOP = object()  # what _take returns once the pipeline stops and the stage is empty
+
+
+async def _acall(function):
+    # Calls a setup or teardown of a coroutine stage, which may be a plain function
+    if function is not None:
+        result = function()
+        if inspect.isawaitable(result):
+            await result
+
+
+class _Stage:
+    def __init__(self, name, handle, workers, queue_size, setup, teardown):
+        self.name = name
+        self.handle = handle
+        self.workers = workers  # threads, or for a coroutine handle, items handled at once on one event loop
+        self.queue_size = queue_size  # 0 for no bound
+        self.setup = setup  # called on each worker thread before its first item, and teardown after its last
+        self.teardown = teardown
+        self.items = deque()
+        self.threads = []
+        self.max_depth = 0
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0  # seconds the workers spent handling items
+        self.waited = 0.0  # seconds producers spent waiting for room in the queue, the backpressure
+
+
+class Pipeline:
+    # Stages of worker threads connected by queues.  An item put into a stage is handed to one of its
+    # workers, whose handle function may put items into other stages.  A full queue blocks whoever puts
+    # into it, so a slow stage slows down the stages feeding it instead of letting items pile up.
+    #
+    # put(..., bounded=False) never blocks.  It is for results going back to an earlier stage, where waiting
+    # for room could deadlock: the earlier stage may itself be waiting for room in the stage putting.
+    #
+    # A stage whose handle is a coroutine function runs on a thread of its own with an event loop, awaiting up
+    # to workers items at once, so thousands of network calls in flight do not take thousands of threads.
+    # Its setup and teardown may be coroutine functions too.  A bounded put from its handle blocks the whole
+    # loop while it waits for room.
+    def __init__(self):
+        self.stages = {}
+        self._condition = threading.Condition()
+        self._pending = 0  # items put but not handled yet, in every stage
+        self._stopping = False
+        self.error = None  # the first exception a handle function raised
+
+    def add(self, name, handle, workers=1, queue_size=100, setup=None, teardown=None):
+        if name in self.stages:
+            raise ValueError('The {} stage already exists.'.format(name))
+        self.stages[name] = _Stage(name, handle, workers, queue_size, setup, teardown)
+
+    def start(self):
+        for stage in self.stages.values():
+            if inspect.iscoroutinefunction(stage.handle):
+                thread = threading.Thread(target=asyncio.run, args=(self._awork(stage),), name=stage.name,
+                                          daemon=True)
+                stage.threads.append(thread)
+                thread.start()
+                continue
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,), name='{}-{}'.format(stage.name, number),
+                                          daemon=True)
+                stage.threads.append(thread)
+                thread.start()
+
+    def feed(self, name, item):
+        # put for whatever feeds the pipeline from outside.  Raises the error of a failed stage, so it stops.
+        with self._condition:
+            if self.error is not None:
+                raise self.error
+        self.put(name, item)
+
+    def put(self, name, item, bounded=True):
+        stage = self.stages[name]
+        with self._condition:
+            if bounded and stage.queue_size > 0 and len(stage.items) >= stage.queue_size:
+                start = time.perf_counter()
+                while len(stage.items) >= stage.queue_size:
+                    self._condition.wait()
+                stage.waited += time.perf_counter() - start
+            stage.items.append(item)
+            stage.max_depth = max(stage.max_depth, len(stage.items))
+            self._pending += 1
+            self._condition.notify_all()
+
+    def _take(self, stage):
+        with self._condition:
+            while len(stage.items) == 0 and not self._stopping:
+                self._condition.wait()
+            if len(stage.items) == 0:
+                return _STOP
+            item = stage.items.popleft()
+            self._condition.notify_all()  # there is room for a producer
+            return item
+
+    def _failed(self, stage, item, e):
+        logger.error('The {} stage failed on {!r}'.format(stage.name, item), exc_info=e)
+        with self._condition:
+            stage.errors += 1
+            if self.error is None:
+                self.error = e
+
+    def _handled(self, stage, start):
+        with self._condition:
+            stage.processed += 1
+            stage.busy += time.perf_counter() - start
+            self._pending -= 1
+            self._condition.notify_all()
+
+    def _work(self, stage):
+        if stage.setup is not None:
+            stage.setup()
+        try:
+            while True:
+                item = self._take(stage)
+                if item is _STOP:
+                    return
+                start = time.perf_counter()
+                try:
+                    stage.handle(item)
+                except Exception as e:
+                    self._failed(stage, item, e)
+                self._handled(stage, start)
+        finally:
+            if stage.teardown is not None:
+                stage.teardown()
+
+    async def _ahandle(self, stage, item, slots):
+        start = time.perf_counter()
+        try:
+            await stage.handle(item)
+        except Exception as e:
+            self._failed(stage, item, e)
+        finally:
+            slots.release()
+        self._handled(stage, start)
+
+    async def _awork(self, stage):
+        await _acall(stage.setup)
+        try:
+            slots = asyncio.Semaphore(stage.workers)
+            tasks = set()
+            while True:
+                await slots.acquire()
+                item = await asyncio.to_thread(self._take, stage)
+                if item is _STOP:
+                    break
+                task = asyncio.create_task(self._ahandle(stage, item, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            await _acall(stage.teardown)
+
+    def join(self):
+        # Waits until every item put so far, and every item those put, has been handled
+        with self._condition:
+            while self._pending > 0:
+                self._condition.wait()
+            if self.error is not None:
+                raise self.error
+
+    def stop(self):
+        # Lets the workers finish the items already queued, then ends them
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for stage in self.stages.values():
+            for thread in stage.threads:
+                thread.join()
+            stage.threads = []
+
+    def metrics(self):
+        with self._condition:
+            return [StageMetrics(stage.name, stage.workers, len(stage.items), stage.max_depth, stage.processed,
+                                 stage.errors, stage.busy, stage.waited)
+                    for stage in self.stages.values()]
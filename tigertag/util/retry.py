@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _give_up(what, current_try, tries):
+    if current_try >= tries:
+        logger.warning('Failed to {} after {} tries.'.format(what, tries))
+        return True
+    logger.warning('Unable to {} try {} of {}.'.format(what, current_try, tries))
+    return False
+
+
+def with_tries(attempt, tries, what, retry_on, backoff=0):
+    # Calls attempt until it returns without raising retry_on, at most tries times, waiting backoff seconds
+    # times the number of the failed try in between.  The last retry_on is raised once they are used up.
+    current_try = 1
+    while True:
+        try:
+            result = attempt()
+        except retry_on:
+            if _give_up(what, current_try, tries):
+                raise
+            time.sleep(backoff * current_try)
+            current_try += 1
+        else:
+            logger.debug('Did {} after {} tries.'.format(what, current_try))
+            return result
+
+
+async def awith_tries(attempt, tries, what, retry_on, backoff=0):
+    # with_tries for a coroutine function attempt
+    current_try = 1
+    while True:
+        try:
+            result = await attempt()
+        except retry_on:
+            if _give_up(what, current_try, tries):
+                raise
+            await asyncio.sleep(backoff * current_try)
+            current_try += 1
+        else:
+            logger.debug('Did {} after {} tries.'.format(what, current_try))
+            return result